@@ -0,0 +1,233 @@
+#!/usr/bin/env python
+""" PTC-Sim's broker connection benchmark. Opens many concurrent, persistent
+    connections to a MsgBroker on localhost - half sending 6000 (loco status)
+    msgs, and half fetching them from the senders' queues - each making its
+    next request as soon as its last is answered. For each broker engine and
+    number of broker shards, reports the requests/sec and p50/p99 request
+    latency achieved, and saves the results as JSON. With shards, each
+    connection is made to the shard owning its queue, as Client's are, and
+    the connections are spread over a number of client processes, so the
+    clients aren't bound to one core either.
+
+    Usage: ./bench_conns.py [-c CONNS] [-d SECS] [-e ENGINE [ENGINE ...]]
+                            [-s SHARDS [SHARDS ...]] [-p PROCS]
+
+    Author: Dustin Fast, 2018
+"""
+
+import json
+import select
+import socket
+import logging
+import argparse
+from time import sleep, time
+from multiprocessing import Pool
+
+from lib_app import broker_log
+from lib_messaging import MsgBroker, Message, FRAME_PREAMBLE, FRAME_LEN
+from lib_messaging import BROKER, SEND_PORT, FETCH_PORT, shard_of, shard_ports
+
+BENCH_QUEUE = 'bench.c'  # Conn n's queue is BENCH_QUEUE + n
+BENCH_WARMUP = 1  # Untimed secs of load before each engine is measured
+BENCH_ENGINES = ('event', 'threaded')
+STATUS = {'sent': 0, 'loco': '1001', 'speed': 25.0, 'heading': 90.0,
+          'direction': 'increasing', 'milepost': 2.0, 'lat': 61.2,
+          'long': -149.9, 'bpp': 90.0, 'conns': {}}
+
+
+class BenchConn(object):
+    """ A benchmark connection to the broker, sending either msgs to, or
+        fetch requests for, its queue. Binary framed.
+    """
+    def __init__(self, n, sending, shards=1):
+        """ n       : (int) The connection's number, naming its queue
+            sending : (bool) True if a sender, else a fetcher
+            shards  : (int) The broker's number of shards
+        """
+        self.n = n
+        self.sending = sending
+        self.queue_name = BENCH_QUEUE + str(n)
+        ports = (SEND_PORT, FETCH_PORT)
+        if shards > 1:
+            ports = shard_ports(shard_of(self.queue_name, shards))
+        self.sock = socket.create_connection(
+            (BROKER, ports[0] if sending else ports[1]))
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.sock.sendall(FRAME_PREAMBLE)
+        self._buff = ''  # Response data received, not yet a full frame
+        self.sent_at = None  # Time the pending request was sent
+
+    def request(self):
+        """ Sends the connection's next request.
+        """
+        if self.sending:
+            frame = Message((6000, 'sim.l.' + str(self.n), self.queue_name,
+                             STATUS)).raw_msg
+        else:
+            frame = self.queue_name
+        self.sent_at = time()
+        self.sock.sendall(FRAME_LEN.pack(len(frame)) + frame)
+
+    def recv_response(self):
+        """ Receives what data is waiting. Returns the response if it is now
+            complete, else None. Raises socket.error if the broker closed the
+            connection.
+        """
+        data = self.sock.recv(65536)
+        if not data:
+            raise socket.error('Connection closed by broker.')
+        self._buff += data
+        if len(self._buff) < FRAME_LEN.size:
+            return None
+        size = FRAME_LEN.unpack_from(self._buff)[0] + FRAME_LEN.size
+        if len(self._buff) < size:
+            return None
+        response, self._buff = self._buff[FRAME_LEN.size:size], self._buff[size:]
+        return response
+
+
+def load(args):
+    """ Opens connections first_conn up to last_conn to the broker, given in
+        args, and keeps each busy with requests for duration secs, after
+        BENCH_WARMUP secs of warm up. Returns (requests, fetched, errors,
+        elapsed secs, request latencies). Intended to run as a Pool task.
+    """
+    first_conn, last_conn, duration, shards = args
+    conns = {}
+    for n in xrange(first_conn, last_conn):
+        conn = BenchConn(n // 2, n % 2 == 0, shards)
+        conns[conn.sock.fileno()] = conn
+
+    poller = select.poll()
+    for fd, conn in conns.items():
+        poller.register(fd, select.POLLIN)
+        conn.request()
+
+    latencies = []
+    requests = fetched = errors = 0
+    start = time() + BENCH_WARMUP
+    stop_at = start + duration
+    while conns:
+        now = time()
+        if now >= stop_at:
+            break
+        for fd, _ in poller.poll(100):
+            conn = conns[fd]
+            try:
+                response = conn.recv_response()
+            except socket.error:
+                errors += 1
+                poller.unregister(fd)
+                del conns[fd]
+                continue
+            if response is None:
+                continue
+
+            now = time()
+            if now >= start:
+                requests += 1
+                latencies.append(now - conn.sent_at)
+                if not conn.sending and response != 'EMPTY':
+                    fetched += 1
+            conn.request()
+
+    elapsed = time() - start
+    for conn in conns.values():
+        conn.sock.close()
+    return requests, fetched, errors, elapsed, latencies
+
+
+def run_load(num_conns, duration, shards=1, procs=1):
+    """ Runs load() over num_conns connections, split between procs client
+        processes, and returns a dict of the combined results.
+    """
+    # Even bounds, so each sender shares a process with its queue's fetcher
+    bounds = [2 * (num_conns * i // (2 * procs)) for i in range(procs)]
+    bounds.append(num_conns)
+    args = [(bounds[i], bounds[i + 1], duration, shards)
+            for i in range(procs)]
+    if procs > 1:
+        pool = Pool(procs)
+        try:
+            loads = pool.map(load, args)
+        finally:
+            pool.terminate()
+    else:
+        loads = [load(args[0])]
+
+    requests = sum(l[0] for l in loads)
+    fetched = sum(l[1] for l in loads)
+    errors = sum(l[2] for l in loads)
+    elapsed = max(l[3] for l in loads)
+    latencies = sorted(t for l in loads for t in l[4])
+
+    def pct(p):
+        if not latencies:
+            return None
+        return latencies[int(p / 100.0 * (len(latencies) - 1))] * 1000
+
+    return {'conns': num_conns,
+            'shards': shards,
+            'procs': procs,
+            'requests': requests,
+            'req_per_sec': requests / elapsed,
+            'fetched_per_sec': fetched / elapsed,
+            'conn_errors': errors,
+            'latency_p50_ms': pct(50),
+            'latency_p99_ms': pct(99),
+            'latency_max_ms': pct(100)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Broker connection benchmark.')
+    parser.add_argument('-c', '--conns', type=int, default=1000,
+                        help='Concurrent connections')
+    parser.add_argument('-d', '--duration', type=float, default=10,
+                        help='Secs per engine')
+    parser.add_argument('-e', '--engines', nargs='+', default=BENCH_ENGINES,
+                        choices=BENCH_ENGINES, help='Broker engines to run')
+    parser.add_argument('-s', '--shards', type=int, nargs='+', default=[1],
+                        help='Broker shard counts to run')
+    parser.add_argument('-p', '--procs', type=int, default=1,
+                        help='Client processes')
+    parser.add_argument('-o', '--outfile', default='bench_conns.json',
+                        help='Results file (JSON)')
+    args = parser.parse_args()
+
+    # Per-request logging would otherwise be measured. Set before the broker
+    # is forked, so it applies there too.
+    broker_log.setLevel(logging.WARN)
+
+    results = {'conns': args.conns,
+               'duration': args.duration,
+               'procs': args.procs,
+               'time': time(),
+               'runs': []}
+    for engine in args.engines:
+        for shards in args.shards:
+            # Unjournaled, so only the engine and shards differ between runs
+            broker = MsgBroker(engine=engine, journal=False, shards=shards)
+            broker.daemon = True
+            broker.start()
+            sleep(.5)  # Allow broker to start listening
+            try:
+                res = run_load(args.conns, args.duration, shards, args.procs)
+            finally:
+                broker.terminate()
+                broker.join()
+            res['engine'] = engine
+            results['runs'].append(res)
+            print('%-9s %2d shards %6d conns: %8.0f req/sec  '
+                  '%8.0f fetched/sec  p50 %7.1f ms  p99 %7.1f ms  '
+                  'errors %d' % (
+                      engine, shards, args.conns, res['req_per_sec'],
+                      res['fetched_per_sec'], res['latency_p50_ms'] or 0,
+                      res['latency_p99_ms'] or 0, res['conn_errors']))
+
+    with open(args.outfile, 'w') as f:
+        json.dump(results, f, indent=2, sort_keys=True)
+    print('Results saved to ' + args.outfile)
+
+
+if __name__ == '__main__':
+    main()
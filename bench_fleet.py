@@ -0,0 +1,280 @@
+#!/usr/bin/env python
+""" PTC-Sim's fleet load generator. Adds N synthetic locos to the Track and
+    sends their 6000 (loco status) msgs through Client to a MsgBroker on
+    localhost, at a rate stepped up until the broker (or, with --bos, the
+    BOS's msg processing) saturates. For each step, reports the achieved send
+    and receive rates, end-to-end delivery latency and msg loss, and saves
+    the results as JSON.
+
+    Usage: ./bench_fleet.py [-n LOCOS] [-r RATE] [-m MAX_RATE] [--bos]
+
+    Author: Dustin Fast, 2018
+"""
+
+import json
+import Queue
+import logging
+import argparse
+from threading import Thread, Lock
+from time import sleep, time
+
+from lib_app import broker_log, track_log
+from lib_track import Track, add_fleet
+from lib_messaging import MsgBroker, Client, get_6000_msg
+from lib_messaging import BOS_EMP
+
+DRAIN_TIMEOUT = 5  # Max secs to wait for msgs in flight after each step
+SATURATION_SHARE = .9  # Min share of target rate sent and received
+SATURATION_LOSS = .001  # Max share of msgs lost
+
+
+class FleetLoad(object):
+    """ Sends the status msgs of a fleet of locos to the broker at a given
+        rate, from a number of sender threads, and receives them from the BOS's
+        queue, by subscription, noting each msg's delivery latency.
+    """
+    def __init__(self, fleet, senders, process_msgs=None):
+        """ fleet        : (list) The Locos sending msgs
+            senders      : (int) Sender threads
+            process_msgs : A function each batch of received raw msgs is
+                           given to, if any, as the BOS's are
+        """
+        self.fleet = fleet
+        self.senders = senders
+        self.process_msgs = process_msgs
+        self._sent = {}  # Msgs in flight: { (SENDER_ADDR, SEQ): SEND_TIME }
+        self._latencies = []
+        self._lock = Lock()
+        self._msgq = Queue.Queue()  # Received msgs awaiting process_msgs
+
+        self.running = True
+        self._threads = [Thread(target=self._receive)]
+        if process_msgs:
+            self._threads.append(Thread(target=self._process))
+        for thread in self._threads:
+            thread.daemon = True
+            thread.start()
+
+    def stop(self):
+        """ Stops receiving msgs.
+        """
+        self.running = False
+        [t.join() for t in self._threads]
+
+    def _receive(self):
+        """ Receives msgs from the BOS's queue, noting their latencies or, if
+            processing them, queueing them for _process.
+        """
+        subscriber = Client().subscribe(BOS_EMP)
+        while self.running:
+            try:
+                msg = subscriber.next_msg(timeout=1)
+            except Queue.Empty:
+                continue
+            except Exception as e:
+                print('Receive failed: ' + str(e))
+                sleep(1)
+                continue
+
+            if self.process_msgs:
+                self._msgq.put(msg)
+            else:
+                self._delivered([msg])
+
+        subscriber.close()
+
+    def _process(self):
+        """ Drains the queued msgs in batches, as BOS.run does, giving each
+            batch to process_msgs before noting its msgs' latencies.
+        """
+        while self.running:
+            try:
+                msgs = [self._msgq.get(timeout=1)]
+            except Queue.Empty:
+                continue
+            try:
+                while True:
+                    msgs.append(self._msgq.get_nowait())
+            except Queue.Empty:
+                pass
+
+            self.process_msgs([msg.raw_msg for msg in msgs])
+            self._delivered(msgs)
+
+    def _delivered(self, msgs):
+        """ Notes the latencies of the given msgs, as of now.
+        """
+        now = time()
+        with self._lock:
+            for msg in msgs:
+                sent = self._sent.pop((msg.sender_addr, msg.seq), None)
+                if sent is not None:
+                    self._latencies.append(now - sent)
+
+    def _send(self, locos, interval, stop_at, errors):
+        """ Sends a status msg for each of the given locos in turn, one every
+            interval secs, until stop_at.
+        """
+        client = Client()
+        next_send = time()
+        while True:
+            for loco in locos:
+                if next_send >= stop_at:
+                    return
+                wait = next_send - time()
+                if wait > 0:
+                    sleep(wait)
+                next_send += interval
+
+                msg = get_6000_msg(loco)
+                with self._lock:
+                    self._sent[(msg.sender_addr, msg.seq)] = time()
+                try:
+                    client.send_msg(msg)
+                except Exception:
+                    with self._lock:
+                        self._sent.pop((msg.sender_addr, msg.seq), None)
+                    errors.append(msg)
+
+    def run_step(self, rate, duration):
+        """ Sends msgs at the given total rate (msgs/sec) for duration secs,
+            then waits up to DRAIN_TIMEOUT secs for those in flight. Returns
+            a dict of the step's results.
+        """
+        self._latencies = []
+        errors = []
+        shares = [self.fleet[i::self.senders] for i in range(self.senders)]
+        shares = [s for s in shares if s]
+        interval = len(shares) / float(rate)  # Between each sender's sends
+        stop_at = time() + duration
+
+        start = time()
+        threads = [Thread(target=self._send,
+                          args=(s, interval, stop_at, errors))
+                   for s in shares]
+        [t.start() for t in threads]
+        [t.join() for t in threads]
+        sent_secs = time() - start
+
+        drain_until = time() + DRAIN_TIMEOUT
+        while self._sent and time() < drain_until:
+            sleep(.05)
+        recv_secs = time() - start
+
+        with self._lock:
+            lost = len(self._sent)
+            self._sent.clear()
+            latencies = sorted(self._latencies)
+        received = len(latencies)
+        sent = received + lost
+
+        def pct(p):
+            if not latencies:
+                return None
+            return latencies[int(p / 100.0 * (received - 1))] * 1000
+
+        return {'target_rate': rate,
+                'sent': sent,
+                'send_errors': len(errors),
+                'received': received,
+                'lost': lost,
+                'send_rate': sent / sent_secs,
+                'recv_rate': received / recv_secs,
+                'latency_p50_ms': pct(50),
+                'latency_p99_ms': pct(99),
+                'latency_max_ms': pct(100)}
+
+
+def saturated(step, max_latency):
+    """ Returns the reason the given step's results show saturation, or None.
+    """
+    expected = step['target_rate'] * SATURATION_SHARE
+    if step['send_rate'] < expected:
+        return 'send rate below target'
+    if step['send_errors']:
+        return 'send errors'
+    if step['lost'] > step['sent'] * SATURATION_LOSS:
+        return 'msgs lost'
+    if step['latency_p99_ms'] and step['latency_p99_ms'] > max_latency:
+        return 'p99 latency over ' + str(max_latency) + ' ms'
+    return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Fleet load generator.')
+    parser.add_argument('-n', '--locos', type=int, default=500,
+                        help='Synthetic locos')
+    parser.add_argument('-r', '--rate', type=float, default=100,
+                        help='Initial total msgs/sec, doubled each step')
+    parser.add_argument('-m', '--max-rate', type=float, default=51200,
+                        help='Max total msgs/sec')
+    parser.add_argument('-d', '--duration', type=float, default=5,
+                        help='Secs per step')
+    parser.add_argument('-s', '--senders', type=int, default=4,
+                        help='Sender threads')
+    parser.add_argument('-l', '--max-latency', type=float, default=1000,
+                        help='Max p99 latency, in ms, before saturation')
+    parser.add_argument('--bos', action='store_true',
+                        help='Process received msgs as the BOS does')
+    parser.add_argument('-o', '--outfile', default='bench_fleet.json',
+                        help='Results file (JSON)')
+    args = parser.parse_args()
+
+    # Per-msg logging would otherwise be measured. Set before the broker is
+    # forked, so it applies there too.
+    broker_log.setLevel(logging.WARN)
+    track_log.setLevel(logging.WARN)
+
+    track = Track()
+    fleet = add_fleet(track, args.locos)
+
+    process_msgs = None
+    if args.bos:
+        from sim_bos import BOS, bos_log  # Requires flask
+        bos_log.setLevel(logging.WARN)
+        bos = BOS()
+        process_msgs = bos._process_msgs
+
+    broker = MsgBroker()
+    broker.daemon = True
+    broker.start()
+    sleep(.5)  # Allow broker to start listening
+
+    results = {'locos': args.locos,
+               'senders': args.senders,
+               'bos': args.bos,
+               'time': time(),
+               'steps': [],
+               'saturated_at': None}
+    load = FleetLoad(fleet, args.senders, process_msgs)
+    try:
+        rate = args.rate
+        while rate <= args.max_rate:
+            step = load.run_step(rate, args.duration)
+            results['steps'].append(step)
+            print('%8.0f msgs/sec: sent %8.0f/sec  recv %8.0f/sec  '
+                  'lost %6d  p50 %8.1f ms  p99 %8.1f ms' % (
+                      rate, step['send_rate'], step['recv_rate'],
+                      step['lost'], step['latency_p50_ms'] or 0,
+                      step['latency_p99_ms'] or 0))
+
+            reason = saturated(step, args.max_latency)
+            if reason:
+                results['saturated_at'] = {'target_rate': rate,
+                                           'reason': reason}
+                print('Saturated at ' + str(rate) + ' msgs/sec: ' + reason)
+                break
+            rate *= 2
+        else:
+            print('Not saturated at up to ' + str(args.max_rate) + ' msgs/sec')
+    finally:
+        load.stop()
+        broker.terminate()
+
+    with open(args.outfile, 'w') as f:
+        json.dump(results, f, indent=2, sort_keys=True)
+    print('Results saved to ' + args.outfile)
+
+
+if __name__ == '__main__':
+    main()
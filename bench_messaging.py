@@ -0,0 +1,172 @@
+#!/usr/bin/env python
+""" PTC-Sim's messaging microbenchmarks. Measures the ops/sec and p50/p99
+    latency of the messaging hot path - EMP encoding and decoding (per msg
+    and in batches), status msg construction, and client/broker round trips
+    against a MsgBroker on localhost - and saves the results as JSON, for
+    comparison between commits.
+
+    Usage: ./bench_messaging.py [-n OPS] [-o OUTFILE] [-c PREV_OUTFILE]
+
+    Author: Dustin Fast, 2018
+"""
+
+import json
+import logging
+import argparse
+import platform
+from time import sleep, time
+from timeit import default_timer
+from subprocess import check_output
+
+from lib_app import broker_log
+from lib_track import Track
+from lib_messaging import Message, MsgBroker, Client, get_6000_msg
+
+BENCH_QUEUE = 'bench.q'  # Broker queue used by round trip benchmarks
+BENCH_PERCENTILES = (50, 99)
+BENCH_WARMUP = 0.1  # Untimed ops run before each benchmark, as a share of ops
+BENCH_BATCH = 100  # Msgs per op of batch codec benchmarks
+
+
+def percentile(sorted_times, pct):
+    """ Returns the given percentile of the given sorted list of times.
+    """
+    i = int(round(pct / 100.0 * (len(sorted_times) - 1)))
+    return sorted_times[i]
+
+
+def bench(func, ops):
+    """ Calls func ops times, timing each call, and returns a dict of the
+        results: ops/sec, and latency percentiles in microseconds. A share of
+        ops are first run untimed, as warm up (see BENCH_WARMUP).
+    """
+    for _ in xrange(int(ops * BENCH_WARMUP)):
+        func()
+
+    times = []
+    start = default_timer()
+    for _ in xrange(ops):
+        t = default_timer()
+        func()
+        times.append(default_timer() - t)
+    elapsed = default_timer() - start
+
+    times.sort()
+    results = {'ops': ops, 'ops_per_sec': ops / elapsed}
+    for pct in BENCH_PERCENTILES:
+        results['p' + str(pct) + '_us'] = percentile(times, pct) * 1e6
+    return results
+
+
+def get_benchmarks():
+    """ Returns a list of (name, func) for each benchmark, where func takes
+        the number of ops to run and returns its results (see bench()).
+    """
+    loco = Track().locos.values()[0]
+    status_msg = get_6000_msg(loco)
+    status_tuple = (status_msg.msg_type,
+                    status_msg.sender_addr,
+                    status_msg.dest_addr,
+                    status_msg.payload)
+    raw_msg = status_msg.raw_msg
+    client = Client()
+
+    # Batch codec benchmarks reuse one buffer, as a caller would
+    status_tuples = [status_tuple] * BENCH_BATCH
+    buff, size = Message.encode_many(status_tuples)
+    batch = str(buff[:size])
+
+    def send_fetch(ops):
+        # Each msg is sent once, as the broker drops resent msgs (by seq)
+        total = ops + int(ops * BENCH_WARMUP)
+        msgs = iter([Message((6000, loco.emp_addr, BENCH_QUEUE,
+                              status_msg.payload)) for _ in xrange(total)])
+
+        def round_trip():
+            client.send_msg(next(msgs))
+            client.fetch_next_msg(BENCH_QUEUE)
+
+        client.fetch_many(BENCH_QUEUE)  # Ensure the queue starts empty
+        return bench(round_trip, ops)
+
+    return [('Message._to_raw', lambda n: bench(
+                lambda: Message._to_raw(status_tuple), n)),
+            ('Message._to_tuple', lambda n: bench(
+                lambda: Message._to_tuple(raw_msg), n)),
+            ('Message.encode_many/' + str(BENCH_BATCH), lambda n: bench(
+                lambda: Message.encode_many(status_tuples, buff), n)),
+            ('Message.decode_many/' + str(BENCH_BATCH), lambda n: bench(
+                lambda: Message.decode_many(batch), n)),
+            ('get_6000_msg', lambda n: bench(
+                lambda: get_6000_msg(loco), n)),
+            ('send_msg/fetch_next_msg', send_fetch)]
+
+
+def compare(results, prev_results):
+    """ Prints the change in each benchmark's ops/sec and p99 latency from
+        the given previous results.
+    """
+    print('\nChange from ' + prev_results['commit'] + ':')
+    prev = prev_results['benchmarks']
+    for name, res in sorted(results['benchmarks'].items()):
+        if name not in prev:
+            continue
+        ops = res['ops_per_sec'] / prev[name]['ops_per_sec'] - 1
+        p99 = res['p99_us'] / prev[name]['p99_us'] - 1
+        print('  %-26s ops/sec %+7.1f%%   p99 %+7.1f%%' % (name,
+                                                        ops * 100,
+                                                        p99 * 100))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Messaging benchmarks.')
+    parser.add_argument('-n', '--ops', type=int, default=10000,
+                        help='Ops per benchmark')
+    parser.add_argument('-o', '--outfile', default='bench_messaging.json',
+                        help='Results file (JSON)')
+    parser.add_argument('-c', '--compare', metavar='PREV_OUTFILE',
+                        help='Previous results file to compare against')
+    parser.add_argument('--logging', action='store_true',
+                        help='Keep broker logging at its configured level')
+    args = parser.parse_args()
+
+    # Broker logging otherwise dominates the round trip. Set before the broker
+    # is forked, so it applies there too.
+    if not args.logging:
+        broker_log.setLevel(logging.WARN)
+
+    try:
+        commit = check_output(['git', 'rev-parse', '--short', 'HEAD']).strip()
+    except Exception:
+        commit = 'unknown'
+
+    broker = MsgBroker()
+    broker.daemon = True
+    broker.start()
+    sleep(.5)  # Allow broker to start listening
+
+    results = {'commit': commit,
+               'time': time(),
+               'python': platform.python_version(),
+               'platform': platform.platform(),
+               'benchmarks': {}}
+    try:
+        for name, func in get_benchmarks():
+            res = func(args.ops)
+            results['benchmarks'][name] = res
+            print('%-28s %10.0f ops/sec   p50 %8.1f us   p99 %8.1f us' % (
+                name, res['ops_per_sec'], res['p50_us'], res['p99_us']))
+    finally:
+        broker.terminate()
+
+    with open(args.outfile, 'w') as f:
+        json.dump(results, f, indent=2, sort_keys=True)
+    print('Results saved to ' + args.outfile)
+
+    if args.compare:
+        with open(args.compare) as f:
+            compare(results, json.load(f))
+
+
+if __name__ == '__main__':
+    main()
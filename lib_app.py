@@ -3,17 +3,145 @@
     Author: Dustin Fast, 2018
 """
 
+import os
 import logging
 import logging.handlers
+from time import sleep
+from threading import Thread, Lock
 from subprocess import check_output
 from ConfigParser import RawConfigParser
 
+CONFIG_FILE = 'config.dat'
+
+# Config values that may be changed while running, by name: (section, type).
+# See AppConfig.
+CONFIG_TUNABLES = {'refresh_time': ('application', int),
+                   'msg_interval': ('messaging', float),
+                   'network_timeout': ('messaging', float),
+                   'msg_expire_time': ('messaging', float),
+                   'max_queue_depth': ('messaging', int),
+                   'queue_overflow': ('messaging', str)}
+
+
+class AppConfig(object):
+    """ PTC-Sim's configuration, as given by config.dat. It's read once per
+        process and shared by all modules (as lib_app.config), and its values
+        are accessed by section and key with get(), getint(), getfloat() and
+        getboolean().
+        The values of CONFIG_TUNABLES are also attributes, by name, of their
+        given types. If watched (see watch()), config.dat is re-read when
+        modified, these attributes are updated, and the listeners (see
+        add_listener()) are given the ones that changed. All other values
+        require a restart.
+    """
+    def __init__(self, path=CONFIG_FILE):
+        """ self.path : (str) The config file's path
+        """
+        self.path = path
+        self._listeners = []
+        self._lock = Lock()
+        self._watcher_pid = None  # PID of the process watching, if any
+        self._mtime = self._modified()
+        self._parser = RawConfigParser()
+        self._parser.read(path)
+        for name, value in self._tunables(self._parser).items():
+            setattr(self, name, value)
+
+    def get(self, section, key):
+        return self._parser.get(section, key)
+
+    def getint(self, section, key):
+        return self._parser.getint(section, key)
+
+    def getfloat(self, section, key):
+        return self._parser.getfloat(section, key)
+
+    def getboolean(self, section, key):
+        return self._parser.getboolean(section, key)
+
+    def _modified(self):
+        """ Returns the config file's modified time, or None if missing.
+        """
+        try:
+            return os.path.getmtime(self.path)
+        except OSError:
+            return None
+
+    @staticmethod
+    def _tunables(parser):
+        """ Returns the CONFIG_TUNABLES values of the given parser, as a dict
+            of their typed values by name.
+        """
+        return {name: typ(parser.get(section, name))
+                for name, (section, typ) in CONFIG_TUNABLES.items()}
+
+    def add_listener(self, listener):
+        """ Registers the given function to be called after each reload that
+            changes tunable values, given a dict of the new values by name.
+        """
+        with self._lock:
+            self._listeners.append(listener)
+
+    def reload(self):
+        """ Re-reads the config file if modified since last read, updating the
+            tunable values and calling the listeners if any changed. Returns a
+            dict of the changed values by name. Raises an exception if the
+            file is malformed, in which case all values are left unchanged.
+        """
+        mtime = self._modified()
+        if mtime == self._mtime:
+            return {}
+
+        with self._lock:
+            parser = RawConfigParser()
+            parser.read(self.path)
+            tunables = self._tunables(parser)
+            self._mtime = mtime  # Only once parsed, so a bad file is retried
+            changed = {k: v for k, v in tunables.items()
+                       if getattr(self, k) != v}
+            self._parser = parser
+            for name, value in changed.items():
+                setattr(self, name, value)
+            listeners = list(self._listeners)
+
+        if changed:
+            for listener in listeners:
+                listener(changed)
+        return changed
+
+    def watch(self, log, interval=None):
+        """ Starts a thread, in the calling process, that reloads the config
+            every interval secs (default config_poll), logging changes to the
+            given Logger. Does nothing if already watched by this process, or
+            the interval is 0.
+        """
+        if interval is None:
+            interval = self.getfloat('application', 'config_poll')
+        with self._lock:
+            if not interval or self._watcher_pid == os.getpid():
+                return
+            self._watcher_pid = os.getpid()
+
+        def _watch():
+            while True:
+                sleep(interval)
+                try:
+                    changed = self.reload()
+                except Exception as e:
+                    log.error('Config reload failed: ' + str(e))
+                    continue
+                if changed:
+                    log.info('Config reloaded: ' + str(changed))
+
+        watcher = Thread(target=_watch)
+        watcher.daemon = True
+        watcher.start()
+
+
 # Import conf data
-config = RawConfigParser()
-config.read('config.dat')
+config = AppConfig()
 
 APP_NAME = config.get('application', 'app_name')
-REFRESH_TIME = int(config.get('application', 'refresh_time'))
 WEB_EXPIRE = int(config.get('application', 'web_expire'))
 
 LOG_LEVEL = int(config.get('logging', 'level'))
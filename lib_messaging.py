@@ -9,41 +9,212 @@
     Author: Dustin Fast, 2018
 """
 
+import os
+import mmap
+import json
+import errno
 import Queue
+import select
 import socket
 import datetime
-from time import sleep
+from time import sleep, time
+from itertools import count
+from random import getrandbits
+from bisect import bisect_left
 from binascii import crc32
-from threading import Thread
-from struct import pack, unpack
-from multiprocessing import Process
-from ConfigParser import RawConfigParser
-
-from lib_app import broker_log
-from lib_app import REFRESH_TIME
+from collections import deque, OrderedDict
+from heapq import heappush, heappop
+from threading import Thread, Lock, BoundedSemaphore, Condition
+from struct import Struct
+from multiprocessing import Process, RawArray
+from multiprocessing import Lock as ProcessLock
+from multiprocessing import Semaphore as ProcessSemaphore
+
+from lib_app import broker_log, dep_install
+from lib_app import config
+
+# Attempt to import 3rd party modules, prompting for install on fail.
+try:
+    import numpy
+except:
+    dep_install('numpy')
 
 # Import conf data
-config = RawConfigParser()
-config.read('config.dat')
 BROKER = config.get('messaging', 'broker')
 BOS_EMP = config.get('messaging', 'bos_emp_addr')
 SEND_PORT = int(config.get('messaging', 'send_port'))
 FETCH_PORT = int(config.get('messaging', 'fetch_port'))
 MAX_MSG_SIZE = int(config.get('messaging', 'max_msg_size'))
 NET_TIMEOUT = float(config.get('messaging', 'network_timeout'))
-MSG_INTERVAL = float(config.get('messaging', 'msg_interval'))
 LOCO_EMP_PREFIX = config.get('messaging', 'loco_emp_prefix')
+POOL_SIZE = int(config.get('messaging', 'pool_size'))
+IDLE_TIMEOUT = float(config.get('messaging', 'idle_timeout'))
+WIRE_FRAMING = config.get('messaging', 'wire_framing')
+BROKER_ENGINE = config.get('messaging', 'broker_engine')
+SUB_WINDOW = int(config.get('messaging', 'sub_window'))
+MSG_EXPIRE = float(config.get('messaging', 'msg_expire_time'))
+MAX_QUEUE_DEPTH = int(config.get('messaging', 'max_queue_depth'))
+QUEUE_OVERFLOW = config.get('messaging', 'queue_overflow')
+JOURNAL = config.getboolean('messaging', 'journal')
+JOURNAL_DIR = config.get('messaging', 'journal_dir')
+JOURNAL_SEGMENT_SIZE = int(config.get('messaging', 'journal_segment_size'))
+JOURNAL_SYNC_INTERVAL = float(config.get('messaging', 'journal_sync_interval'))
+BROKER_SHARDS = int(config.get('messaging', 'broker_shards'))
+SHARD_BASE_PORT = int(config.get('messaging', 'shard_base_port'))
+DEDUP_WINDOW = int(config.get('messaging', 'dedup_window'))
+DEDUP_SENDERS = int(config.get('messaging', 'dedup_senders'))
+MSG_TRANSPORT = config.get('messaging', 'msg_transport')
+SHM_RING_SIZE = int(config.get('messaging', 'shm_ring_size'))
+SHM_CHANNELS = int(config.get('messaging', 'shm_channels'))
+STATUS_MCAST = config.getboolean('messaging', 'status_mcast')
+MCAST_GROUP = config.get('messaging', 'mcast_group')
+MCAST_PORT = int(config.get('messaging', 'mcast_port'))
+MCAST_IFACE = config.get('messaging', 'mcast_iface')
 
 # Set default timeout for all sockets, including importers of this library
 socket.setdefaulttimeout(NET_TIMEOUT)
 
 
+def _apply_config(changed):
+    """ Applies the given changed tunable config values (see AppConfig) to
+        sockets created from now on.
+    """
+    if 'network_timeout' in changed:
+        socket.setdefaulttimeout(changed['network_timeout'])
+
+
+config.add_listener(_apply_config)
+
+# Precompiled EMP formats, noting that
+#   B = unsigned char, 8 bits
+#   H = unsigned short, 16 bits
+#   i = signed int, 32 bits
+# EMP_HEAD is the EMP "Common Header" followed by the fixed portion of the
+# "Variable Header": EMP header version, msg type, msg version, flags, 24 bit
+# body size (packed as a high byte and a low short), variable header size,
+# network TTL and QoS. The variable length addresses follow it, preceded by
+# the msg's sequence number (EMP_SEQ) if flagged by EMP_FLAG_SEQ.
+EMP_HEAD = Struct('>BHBBBHBHH')  # 13 bytes
+EMP_SEQ = Struct('>I')  # The sender's msg sequence number
+EMP_FLAG_SEQ = 0x01
+EMP_CRC = Struct('>i')  # 32 bit CRC, trails the msg body
+EMP_MIN_SIZE = 20  # Min msg size, in bytes
+EMP_MSG_VERSION = 2  # Message version, denotes the binary body encoding
+EMP_TTL = 120  # Default network TTL, in seconds. 0 = none
+EMP_BATCH_SIZE = 65536  # Initial size of an encode_many buffer, in bytes
+EMP_MAX_STRUCTS = 4096  # Max msg Structs cached by encode_many
+
+# EMP QoS values. The low two bits of QoS are the msg's priority, by which the
+# broker serves it. Msg types not in MSG_QOS default to QOS_ROUTINE.
+QOS_ROUTINE = 0
+QOS_ELEVATED = 1
+QOS_URGENT = 2
+QOS_CRITICAL = 3
+QOS_PRIORITY_MASK = 0x3
+QOS_PRIORITIES = 4
+MSG_QOS = {6002: QOS_CRITICAL}  # 6002 = CAD restriction
+
+# Precompiled EMP body formats, noting that (in addition to the above)
+#   I = unsigned int, 32 bits
+#   q = signed long long, 64 bits
+#   d = double, 64 bits
+# Fixed-format msg bodies are a fixed-width section followed by any variable
+# length fields. Strings are prefixed by their length (BODY_STR_LEN) and
+# lists by their element count (BODY_COUNT). See docs/app_messaging_spec.md.
+BODY_STR_LEN = Struct('>B')
+MAX_BODY_STR = 255  # Max length of a string in a fixed-format body
+BODY_COUNT = Struct('>H')
+BODY_6000 = Struct('>IddddddB')  # sent, speed, heading, bpp, milepost, lat,
+                                 # long, direction (an index of DIRECTIONS)
+BODY_SENT = Struct('>I')  # sent (6001, 6002)
+BODY_RESTRICT = Struct('>dd')  # start_mp, end_mp (6002)
+BODY_MP = Struct('>d')  # milepost (6002)
+DIRECTIONS = ('decreasing', 'increasing')
+
+# Numpy equivalent of BODY_6000, for decoding 6000 bodies in batches, and the
+# fields of each decoded msg (see Message.decode_6000_many), less the loco ID
+BODY_6000_DTYPE = numpy.dtype([('sent', '>u4'),
+                               ('speed', '>f8'),
+                               ('heading', '>f8'),
+                               ('bpp', '>f8'),
+                               ('milepost', '>f8'),
+                               ('lat', '>f8'),
+                               ('long', '>f8'),
+                               ('direction', 'u1')])
+STATUS_FIELDS = [('sent', 'u4'),
+                 ('speed', 'f8'),
+                 ('heading', 'f8'),
+                 ('bpp', 'f8'),
+                 ('milepost', 'f8'),
+                 ('lat', 'f8'),
+                 ('long', 'f8'),
+                 ('direction', 'u1')]  # An index of DIRECTIONS
+
+# Typed value encoding, for bodies of msgs w/no fixed format. Each value is a
+# one char type tag followed by its data.
+VALUE_SIZE = Struct('>I')
+VALUE_INT = Struct('>q')
+VALUE_FLOAT = Struct('>d')
+
+# Broker wire framing. Binary framing connections begin with FRAME_PREAMBLE,
+# then each frame is prefixed by its length (FRAME_LEN). All other
+# connections use hex framing. See docs/app_messaging_spec.md.
+FRAMING_HEX = 'hex'
+FRAMING_BINARY = 'binary'
+FRAME_PREAMBLE = '\x00\x01'  # Null marker + binary framing version
+FRAME_LEN = Struct('>I')
+MAX_FRAME_SIZE = 1 << 24  # Max allowed binary frame size, in bytes
+MAX_HEX_FRAME_SIZE = 2 * MAX_FRAME_SIZE  # Max hex frame size, hex encoded
+PIPELINE_DEPTH = 64  # Max requests in flight per connection (see request_many)
+SUB_CLOSE_TIMEOUT = 1  # Max secs a closing Subscriber awaits the broker's close
+
+# Broker journal records. Each is a JRNL_REC header (record kind, payload size
+# and payload CRC) followed by its payload. A kind of 0 denotes the unwritten,
+# zero-filled remainder of a segment.
+JRNL_REC = Struct('>BIi')
+JRNL_MSG = Struct('>QdB')  # Msg seq, enqueue time, dest addr len (+ addr, msg)
+JRNL_OFFSET = Struct('>QB')  # Last consumed msg seq, addr len (+ addr)
+JRNL_ACK = Struct('>Q')  # Consumed msg seq. An ack record holds one or more
+JRNL_MAX_ACKS = 1024  # Max seqs per ack record
+JRNL_KIND_MSG = 1
+JRNL_KIND_OFFSET = 2  # Consumer offsets, no longer written but still read
+JRNL_KIND_ACK = 3
+JRNL_KINDS = (JRNL_KIND_MSG, JRNL_KIND_OFFSET, JRNL_KIND_ACK)
+
+# Broker stats
+STATS_RATE_WINDOW = 10  # Secs over which enqueue/dequeue rates are averaged
+STATS_PERCENTILES = (50, 90, 99)  # Time-in-queue percentiles reported
+
+# Max pooled conns from a sharded broker's router to each of its shards
+ROUTER_POOL_SIZE = 32
+
+# Shared memory transport records. Ring buffer records are prefixed with their
+# length, and requests and responses are prefixed with SHM_REQ's channel, kind
+# (requests only) and seq.
+SHM_REC_LEN = Struct('>I')
+SHM_REQ = Struct('>BBI')  # Channel, request kind, request seq
+SHM_RESP = Struct('>I')  # Request seq
+SHM_SEND = 0
+SHM_FETCH = 1
+SHM_POLL = 0.0005  # Secs between checks for room in a full ring buffer
+
+# Multicast (EMP Class C) datagrams are each one EMP msg, sequenced by its seq
+# (see EMP_FLAG_SEQ). Seqs within MCAST_SEQ_WINDOW behind a sender's last are
+# duplicates, and beyond it (either way) denote a sender restart.
+MCAST_SEQ_WINDOW = 1024
+MAX_DATAGRAM_SIZE = 65507  # Max UDP payload size, in bytes
+
+
 class Message(object):
     """ A representation of a message, including it's raw EMP form. Contains
         static functions for converting between tuple and raw EMP form.
     """
 
-    def __init__(self, msg_content):
+    _seqs = {}  # Msg seqs, by sender: { SENDER_ADDR: count() }
+    _seq_seed = None  # Seed of senders' first seqs, if any. See seed_seqs()
+    _structs = {}  # Msg Structs, see _msg_struct: { (LENGTHS): Struct }
+
+    def __init__(self, msg_content, ttl=EMP_TTL, qos=None, seq=None):
         """ Constructs a message object from the given content - either a
             well-formed EMP msg string, or a tuple of the form:
                 (Message Type - ex: 6000,
@@ -51,15 +222,35 @@ class Message(object):
                  Destination address - ex: 'arr.l.arr.IDNM',
                  Payload - ex: { key: value, ... }
                 )
-                Note: All other EMP fields are static in this implementation.
+                Note: All other EMP fields are static in this implementation,
+                except network TTL (seconds), QoS and sequence number, given
+                by ttl, qos and seq if constructing from a tuple. Qos defaults
+                to MSG_QOS by type, and seq to the sender's next (see
+                next_seq).
+                Payloads of the fixed-format msgs (6000, 6001 and 6002) must
+                contain the keys given in docs/app_messaging_spec.md. All
+                other payloads may contain only None, bool, int, float, str,
+                and lists, tuples, or dicts of them.
         """
         if type(msg_content) == str:
             self.raw_msg = msg_content
             msg_content = self._to_tuple(msg_content)
+            head = EMP_HEAD.unpack_from(self.raw_msg)
+            ttl, qos = head[7:]
+            if head[3] & EMP_FLAG_SEQ:
+                seq = EMP_SEQ.unpack_from(self.raw_msg, EMP_HEAD.size)[0]
         else:
             if type(msg_content) != tuple or len(msg_content) != 4:
                 raise Exception('Msg content is an unexpected type or length.')
-            self.raw_msg = self._to_raw(msg_content)
+            if qos is None:
+                qos = MSG_QOS.get(msg_content[0], QOS_ROUTINE)
+            if seq is None:
+                seq = Message.next_seq(msg_content[1])
+            self.raw_msg = self._to_raw(msg_content, ttl, qos, seq)
+
+        self.ttl = ttl
+        self.qos = qos
+        self.seq = seq  # None if the msg has no seq
 
         self.msg_type = msg_content[0]
         self.sender_addr = msg_content[1]
@@ -67,93 +258,779 @@ class Message(object):
         self.payload = msg_content[3]
 
     @staticmethod
-    def _to_raw(msg_tuple):
-        """ Given a msg in tuple form, returns a well-formed EMP msg string.
+    def next_seq(sender_addr):
+        """ Returns the next sequence number of the given sender's msgs. Each
+            sender's seqs start at random, so a restarted sender's msgs
+            aren't mistaken for duplicates of its msgs before the restart,
+            unless seeded (see seed_seqs()).
         """
-        msg_type = msg_tuple[0]
-        sender_addr = msg_tuple[1]
-        dest_addr = msg_tuple[2]
-        payload = msg_tuple[3]
-        payload_str = str(payload)
-
-        # Calculate body size (i.e. payload length + room for the 32 bit CRC)
-        body_size = 4 + len(payload_str)
+        seqs = Message._seqs.get(sender_addr)
+        if not seqs:
+            if Message._seq_seed is None:
+                first = getrandbits(32)
+            else:
+                first = crc32(str(Message._seq_seed) + sender_addr)
+            seqs = Message._seqs.setdefault(sender_addr,
+                                            count(first & 0xFFFFFFFF))
+        return next(seqs) & 0xFFFFFFFF
 
-        # Calculate size of variable portion of the "Variable Header",
-        # i.e. len(source and destination strings) + null terminators.
-        var_headsize = len(sender_addr) + len(dest_addr) + 2
+    @staticmethod
+    def seed_seqs(seed):
+        """ Restarts every sender's seqs, each from a first seq derived from
+            the given seed and its address, so that the same senders' msgs
+            are given the same seqs from run to run (e.g. for a reproducible
+            scenario). If seed is None, they again start at random.
+            Note: Not for senders to a live broker, which would drop a
+            restarted sender's msgs as duplicates.
+        """
+        Message._seq_seed = seed
+        Message._seqs.clear()
 
-        # Build the raw msg msg using struct.pack, noting that
-        #   B = unsigned char, 8 bits
-        #   H = unsigned short, 16 bits
-        #   I = unsigned int, 32 bits
-        #   i = signed int, 32 bits
-        try:
-            # Pack EMP "Common Header"
-            raw_msg = pack(">B", 4)  # 8 bit EMP header version
-            raw_msg += pack(">H", msg_type)  # 16 bit message type/ID
-            raw_msg += pack(">B", 1)  # 8 bit message version
-            raw_msg += pack(">B", 0)  # 8 bit flag, all zeroes here.
-            raw_msg += pack(">I", body_size)[1:]  # 24 bit msg body size
-
-            # Pack EMP "Variable Header"
-            # 8 bit variable header size
-            raw_msg += pack(">B", var_headsize)
-            raw_msg += pack(">H", 120)  # 16 bit network TTL (seconds)
-            raw_msg += pack(">H", 0)  # 16 bit QoS, 0 = no preference
-            raw_msg += sender_addr  # 64 byte (max) msg source addr string
-            raw_msg += '\x00'  # null terminate msg source address
-            raw_msg += dest_addr  # 64 byte (max) msg dest addr string
-            raw_msg += '\x00'  # null terminate destination address
-
-            # Pack msg body
-            raw_msg += payload_str  # Variable size
-            raw_msg += pack(">i", crc32(raw_msg))  # 32 bit CRC
+    @staticmethod
+    def _to_raw(msg_tuple, ttl=EMP_TTL, qos=None, seq=None):
+        """ Given a msg in tuple form, returns a well-formed EMP msg string
+            with the given network TTL, QoS (default by msg type) and
+            sequence number (if any).
+        """
+        try:
+            head_fields, var_part = Message._layout(msg_tuple, ttl, qos, seq)
+            raw_msg = EMP_HEAD.pack(*head_fields) + var_part
         except:
             raise Exception("Msg format is invalid")
 
-        return raw_msg
+        return raw_msg + EMP_CRC.pack(crc32(raw_msg))  # 32 bit CRC
 
     @staticmethod
     def _to_tuple(raw_msg):
         """ Returns a tuple representation of the msg contained in raw_msg.
         """
         # Validate raw_msg
-        if not raw_msg or len(raw_msg) < 20:  # 20 byte min msg size
+        if not raw_msg or len(raw_msg) < EMP_MIN_SIZE:
             raise Exception("Invalid message format")
 
-        # Ensure good CRC
-        msg_crc = unpack(">i", raw_msg[-4::])[0]  # last 4 bytes
-        raw_crc = crc32(raw_msg[:-4])
-
-        if msg_crc != raw_crc:
-            raise Exception("CRC Mismatch - message may be corrupt.")
+        return Message._decode(raw_msg)
 
-        # Unpack msg fields, noting that unpack returns results as a tuple
-        msg_type = unpack('>H', raw_msg[1:3])[0]  # bytes 1-2
-        vhead_size = unpack('>B', raw_msg[8:9])[0]  # byte 8
+    @staticmethod
+    def _decode(buff, offset=0, size=None):
+        """ Returns a tuple representation of the EMP msg of the given size at
+            buff[offset] (see _unpack), decoded in place.
+        """
+        msg_type, msg_version, sender_addr, dest_addr, body_start, body_end = \
+            Message._unpack(buff, offset, size)
 
-        # Extract sender, destination, and playload based on var header size
-        vhead_end = 13 + vhead_size
-        vhead = raw_msg[13:vhead_end]
-        vhead = vhead.split('\x00')  # split on terminators for easy extract
-        sender_addr = vhead[0]
-        dest_addr = vhead[1]
-        payload = raw_msg[vhead_end:len(raw_msg) - 4]  # -4 moves before CRC
+        if msg_version != EMP_MSG_VERSION:
+            raise Exception('Unsupported msg version: ' + str(msg_version))
 
-        # Turn the payload into a python dictionary
+        # Turn the body into a python dictionary
+        unpack_body = BODY_CODECS.get(msg_type, BODY_DEFAULT)[1]
         try:
-            payload = eval(payload)
-        except:
-            raise Exception('Msg payload not of form { key: value, ... }')
+            payload, pos = unpack_body(buff, body_start)
+        except Exception:
+            pos = None
+        if pos != body_end:
+            raise Exception('Msg body malformed for msg type ' + str(msg_type))
 
         return (msg_type, sender_addr, dest_addr, payload)
 
+    @staticmethod
+    def _layout(msg_tuple, ttl=EMP_TTL, qos=None, seq=None):
+        """ Given a msg in tuple form, returns the field values for EMP_HEAD
+            and the variable length remainder of the msg (i.e. the seq, if
+            any, and the null terminated source and destination addresses,
+            followed by the payload), less the CRC. QoS defaults by msg type,
+            see MSG_QOS.
+        """
+        msg_type, sender_addr, dest_addr, payload = msg_tuple
+        if qos is None:
+            qos = MSG_QOS.get(msg_type, QOS_ROUTINE)
+        payload_str = BODY_CODECS.get(msg_type, BODY_DEFAULT)[0](payload)
+
+        # Calculate body size (i.e. payload length + room for the 32 bit CRC)
+        body_size = len(payload_str) + EMP_CRC.size
+
+        # Calculate size of variable portion of the "Variable Header",
+        # i.e. len(source and destination strings) + null terminators.
+        var_headsize = len(sender_addr) + len(dest_addr) + 2
+        flags = 0
+        seq_str = ''
+        if seq is not None:
+            flags |= EMP_FLAG_SEQ
+            seq_str = EMP_SEQ.pack(seq)
+            var_headsize += EMP_SEQ.size
+
+        head_fields = (4,                   # EMP header version
+                       msg_type,            # Message type/ID
+                       EMP_MSG_VERSION,     # Message version
+                       flags,               # Flags, see EMP_FLAG_SEQ
+                       body_size >> 16,     # 24 bit msg body size
+                       body_size & 0xFFFF,  # ...
+                       var_headsize,        # Variable header size
+                       ttl,                 # Network TTL (seconds)
+                       qos)                 # QoS, see MSG_QOS
+        var_part = ''.join((seq_str,
+                            sender_addr, '\x00',
+                            dest_addr, '\x00',
+                            payload_str))
+
+        return head_fields, var_part
+
+    @staticmethod
+    def _msg_struct(lengths):
+        """ Returns a Struct packing a msg with a seq, less its CRC: The
+            EMP_HEAD fields, the seq and the null terminated addresses,
+            followed by the body. Lengths is either (sender_len, dest_len,
+            body_len), for a body packed as a str, or (sender_len, dest_len,
+            loco_id_len, conns_len) for a 6000 body, packed field by field.
+            Structs are compiled once per lengths, up to EMP_MAX_STRUCTS.
+        """
+        msg_struct = Message._structs.get(lengths)
+        if not msg_struct:
+            if len(Message._structs) >= EMP_MAX_STRUCTS:
+                Message._structs.clear()
+            fmt = (EMP_HEAD.format + EMP_SEQ.format[1:] +
+                   '%dsx%dsx' % lengths[:2])
+            if len(lengths) == 4:
+                fmt += (BODY_6000.format[1:] + BODY_STR_LEN.format[1:] +
+                        '%ds%ds' % lengths[2:])
+            else:
+                fmt += '%ds' % lengths[2]
+            msg_struct = Struct(fmt)
+            Message._structs[lengths] = msg_struct
+        return msg_struct
+
+    @staticmethod
+    def _unpack(raw_msg, offset=0, size=None):
+        """ Validates the CRC of the EMP msg of the given size at raw_msg[offset]
+            and returns its (msg_type, msg_version, sender_addr, dest_addr,
+            body_start, body_end), where body_start and body_end are the
+            offsets of the msg body (less the CRC) in raw_msg.
+            Size defaults to the remainder of raw_msg.
+        """
+        if size is None:
+            size = len(raw_msg) - offset
+        crc_pos = offset + size - EMP_CRC.size
+
+        # Ensure good CRC
+        msg_crc = EMP_CRC.unpack_from(raw_msg, crc_pos)[0]
+        if msg_crc != crc32(memoryview(raw_msg)[offset:crc_pos]):
+            raise Exception("CRC Mismatch - message may be corrupt.")
+
+        # Unpack msg fields
+        head = EMP_HEAD.unpack_from(raw_msg, offset)
+        vhead_start = offset + EMP_HEAD.size
+        vhead_end = vhead_start + head[6]
+        if head[3] & EMP_FLAG_SEQ:
+            vhead_start += EMP_SEQ.size
+
+        # Extract sender and destination based on var header size
+        sep = raw_msg.find('\x00', vhead_start, vhead_end)
+        if sep < 0:
+            raise Exception("Invalid message format")
+        sender_addr = raw_msg[vhead_start:sep]
+        dest_addr = raw_msg[sep + 1:vhead_end - 1]
+
+        return (head[1], head[2], sender_addr, dest_addr, vhead_end, crc_pos)
+
+    @staticmethod
+    def split_batch(batch):
+        """ Given a str of zero or more concatenated EMP msgs, returns a list
+            of the raw msgs. Each msg's size is given by its header, and its
+            CRC is validated when it's decoded.
+        """
+        raw_msgs = []
+        pos = 0
+        end = len(batch)
+        while pos < end:
+            if end - pos < EMP_MIN_SIZE:
+                raise Exception("Invalid message batch format")
+            head = EMP_HEAD.unpack_from(batch, pos)
+            size = EMP_HEAD.size + head[6] + (head[4] << 16 | head[5])
+            if pos + size > end:
+                raise Exception("Invalid message batch format")
+            raw_msgs.append(batch[pos:pos + size])
+            pos += size
+
+        return raw_msgs
+
+    @staticmethod
+    def encode_many(msg_tuples, buff=None, ttl=EMP_TTL):
+        """ Given a list of msgs in tuple form, packs them (each with its
+            sender's next seq and QoS by msg type) into a single buffer as a
+            batch of concatenated EMP msgs (see split_batch). Returns the
+            buffer, a bytearray, and the batch's size. The buffer is the given
+            buff, if large enough, so a buffer may be reused across calls,
+            else a new one.
+            Each msg but its CRC is packed straight into the buffer by a
+            single pack_into, of a precompiled Struct (see _msg_struct), and
+            its CRC computed over a memoryview of the buffer. 6000 bodies'
+            fields are packed by the same pack_into, rather than by
+            _pack_6000 as a str.
+        """
+        if buff is None:
+            buff = bytearray(EMP_BATCH_SIZE)
+        view = memoryview(buff)
+        structs = Message._structs
+
+        pos = 0
+        for msg_type, sender_addr, dest_addr, payload in msg_tuples:
+            try:
+                if msg_type == 6000:
+                    loco_id = payload['loco']
+                    conns = _pack_str_dict(payload['conns'])
+                    if len(loco_id) > MAX_BODY_STR:
+                        raise ValueError('Loco ID too long.')
+                    lengths = (len(sender_addr), len(dest_addr),
+                               len(loco_id), len(conns))
+                    body = (payload.get('sent') or int(time()),
+                            payload['speed'],
+                            payload['heading'],
+                            payload['bpp'],
+                            payload['milepost'],
+                            payload['lat'],
+                            payload['long'],
+                            DIRECTIONS.index(payload['direction']),
+                            len(loco_id),
+                            loco_id,
+                            conns)
+                else:
+                    packer = BODY_CODECS.get(msg_type, BODY_DEFAULT)[0]
+                    body = (packer(payload),)
+                    lengths = (len(sender_addr), len(dest_addr), len(body[0]))
+                msg_struct = (structs.get(lengths) or
+                              Message._msg_struct(lengths))
+            except:
+                raise Exception("Msg format is invalid")
+
+            # Grow into a new buffer, as needed
+            end = pos + msg_struct.size
+            if end + EMP_CRC.size > len(buff):
+                grown = bytearray(max(2 * len(buff), end + EMP_CRC.size))
+                grown[:pos] = view[:pos]
+                buff = grown
+                view = memoryview(buff)
+
+            var_headsize = lengths[0] + lengths[1] + 2 + EMP_SEQ.size
+            body_size = msg_struct.size - EMP_HEAD.size - var_headsize + \
+                EMP_CRC.size
+            try:
+                msg_struct.pack_into(buff, pos,
+                                     4,  # EMP header version
+                                     msg_type,
+                                     EMP_MSG_VERSION,
+                                     EMP_FLAG_SEQ,
+                                     body_size >> 16,
+                                     body_size & 0xFFFF,
+                                     var_headsize,
+                                     ttl,
+                                     MSG_QOS.get(msg_type, QOS_ROUTINE),
+                                     Message.next_seq(sender_addr),
+                                     sender_addr,
+                                     dest_addr,
+                                     *body)
+            except:
+                raise Exception("Msg format is invalid")
+            EMP_CRC.pack_into(buff, end, crc32(view[pos:end]))
+            pos = end + EMP_CRC.size
+
+        return buff, pos
+
+    @staticmethod
+    def decode_many(batch, size=None):
+        """ Given a batch of concatenated EMP msgs (a str, as from fetch_many
+            requests, or a buffer from encode_many, with the batch's size),
+            returns a list of their tuple representations.
+            Each msg is decoded in place, as by _unpack() and _decode() but
+            inlined, with its header unpacked once and its CRC computed over
+            a memoryview of the batch, rather than first being split into a
+            str of its own. A buffer is first copied to a str, once, as
+            decoded addresses and payload strs are sliced from it.
+        """
+        if size is not None:
+            batch = memoryview(batch)[:size].tobytes()
+        view = memoryview(batch)
+
+        msg_tuples = []
+        pos = 0
+        end = len(batch)
+        while pos < end:
+            if end - pos < EMP_MIN_SIZE:
+                raise Exception("Invalid message batch format")
+            head = EMP_HEAD.unpack_from(batch, pos)
+            vhead_start = pos + EMP_HEAD.size
+            vhead_end = vhead_start + head[6]
+            crc_pos = vhead_end + (head[4] << 16 | head[5]) - EMP_CRC.size
+            if crc_pos + EMP_CRC.size > end:
+                raise Exception("Invalid message batch format")
+
+            if EMP_CRC.unpack_from(batch, crc_pos)[0] != \
+                    crc32(view[pos:crc_pos]):
+                raise Exception("CRC Mismatch - message may be corrupt.")
+            if head[2] != EMP_MSG_VERSION:
+                raise Exception('Unsupported msg version: ' + str(head[2]))
+
+            if head[3] & EMP_FLAG_SEQ:
+                vhead_start += EMP_SEQ.size
+            sep = batch.find('\x00', vhead_start, vhead_end)
+            if sep < 0:
+                raise Exception("Invalid message format")
+
+            unpack_body = BODY_CODECS.get(head[1], BODY_DEFAULT)[1]
+            try:
+                payload, body_end = unpack_body(batch, vhead_end)
+            except Exception:
+                body_end = None
+            if body_end != crc_pos:
+                raise Exception('Msg body malformed for msg type ' +
+                                str(head[1]))
+
+            msg_tuples.append((head[1],
+                               batch[vhead_start:sep],
+                               batch[sep + 1:vhead_end - 1],
+                               payload))
+            pos = crc_pos + EMP_CRC.size
+
+        return msg_tuples
+
+    @staticmethod
+    def msg_type_of(raw_msg):
+        """ Returns the msg type given by the header of the given raw EMP msg,
+            without validating or decoding the msg, or None if too short.
+        """
+        if len(raw_msg) < EMP_HEAD.size:
+            return None
+        return EMP_HEAD.unpack_from(raw_msg)[1]
+
+    @staticmethod
+    def decode_6000_many(raw_msgs):
+        """ Given a list of raw 6000 (loco status) msgs, returns a numpy
+            structured array of their payloads, one row per msg, in order: The
+            loco ID (as 'loco') and the fields of STATUS_FIELDS. Also returns
+            a list of each row's conns. Msgs that fail CRC validation or are
+            otherwise malformed, or that aren't 6000s, are dropped.
+            Headers and fixed-width body fields are decoded for all msgs at
+            once, rather than msg by msg as Message does. Only CRCs, loco IDs
+            and conns, being variable length, are decoded msg by msg.
+        """
+        n = len(raw_msgs)
+        sizes = numpy.fromiter((len(r) for r in raw_msgs), numpy.int64, n)
+        starts = numpy.cumsum(sizes) - sizes
+        joined = ''.join(raw_msgs)
+        buff = numpy.frombuffer(joined, numpy.uint8)
+
+        # Unpack the EMP_HEAD fields needed, see EMP_HEAD's layout, of the
+        # msgs long enough to hold a 6000 body
+        fixed_size = (EMP_HEAD.size + BODY_6000.size + BODY_STR_LEN.size +
+                      BODY_COUNT.size + EMP_CRC.size)
+        ok = sizes >= fixed_size
+        starts, sizes = starts[ok], sizes[ok]
+        msg_type = buff[starts + 1].astype(numpy.int64) << 8 | buff[starts + 2]
+        body_size = (buff[starts + 5].astype(numpy.int64) << 16 |
+                     buff[starts + 6].astype(numpy.int64) << 8 |
+                     buff[starts + 7])
+        vhead_size = buff[starts + 8].astype(numpy.int64)
+        body_start = starts + EMP_HEAD.size + vhead_size
+        crc_pos = starts + sizes - EMP_CRC.size
+        id_pos = body_start + BODY_6000.size
+        direction = buff[numpy.minimum(id_pos - 1, len(buff) - 1)]  # Last
+
+        ok = ((msg_type == 6000) &
+              (buff[starts + 3] == EMP_MSG_VERSION) &
+              (EMP_HEAD.size + vhead_size + body_size == sizes) &
+              (id_pos + BODY_STR_LEN.size + BODY_COUNT.size <= crc_pos) &
+              (direction < len(DIRECTIONS)))
+
+        # Validate CRCs and decode the loco IDs and conns, msg by msg
+        view = memoryview(joined)
+        good = []
+        loco_ids = []
+        conns = []
+        for i in numpy.flatnonzero(ok).tolist():
+            start, end = int(starts[i]), int(crc_pos[i])
+            if crc32(view[start:end]) != EMP_CRC.unpack_from(joined, end)[0]:
+                continue
+            try:
+                loco_id, pos = _unpack_str(joined, int(id_pos[i]))
+                msg_conns, pos = _unpack_str_dict(joined, pos)
+            except Exception:
+                continue
+            if pos != end:
+                continue
+            good.append(i)
+            loco_ids.append(loco_id)
+            conns.append(msg_conns)
+
+        # Gather the fixed-width body fields of the good msgs
+        good = numpy.array(good, numpy.int64)
+        idxs = body_start[good, None] + numpy.arange(BODY_6000.size)
+        fields = buff[idxs].view(BODY_6000_DTYPE).ravel()
+
+        id_width = max([len(l) for l in loco_ids] + [1])
+        status = numpy.empty(len(good),
+                             [('loco', 'S' + str(id_width))] + STATUS_FIELDS)
+        status['loco'] = loco_ids
+        for name, _ in STATUS_FIELDS:
+            status[name] = fields[name]
+        return status, conns
+
+
+######################
+# EMP Body Encodings #
+######################
+
+def _pack_str(string):
+    """ Returns the given string (255 chars max) packed with its length prefix.
+    """
+    if len(string) > MAX_BODY_STR:
+        raise ValueError('String exceeds ' + str(MAX_BODY_STR) + ' chars.')
+    return BODY_STR_LEN.pack(len(string)) + string
+
+
+def _unpack_str(buff, pos):
+    """ Returns the length prefixed string at buff[pos] and the position
+        following it.
+    """
+    end = pos + BODY_STR_LEN.size + BODY_STR_LEN.unpack_from(buff, pos)[0]
+    if end > len(buff):
+        raise ValueError('String exceeds buffer.')
+    return buff[pos + BODY_STR_LEN.size:end], end
+
+
+def _pack_str_dict(str_dict):
+    """ Returns the given dict of strings to strings, packed. String lengths
+        are packed with chr(), as BODY_STR_LEN is a single byte.
+    """
+    parts = [BODY_COUNT.pack(len(str_dict))]
+    for k, v in str_dict.iteritems():
+        if len(k) > MAX_BODY_STR or len(v) > MAX_BODY_STR:
+            raise ValueError('String exceeds ' + str(MAX_BODY_STR) + ' chars.')
+        parts += (chr(len(k)), k, chr(len(v)), v)
+    return ''.join(parts)
+
+
+def _unpack_str_dict(buff, pos):
+    """ Returns the packed dict of strings to strings at buff[pos] and the
+        position following it. String lengths are unpacked with ord(), see
+        _pack_str_dict().
+    """
+    str_dict = {}
+    count = BODY_COUNT.unpack_from(buff, pos)[0]
+    pos += BODY_COUNT.size
+    for _ in xrange(count):
+        end = pos + BODY_STR_LEN.size + ord(buff[pos])
+        k = buff[pos + BODY_STR_LEN.size:end]
+        pos = end + BODY_STR_LEN.size + ord(buff[end])
+        str_dict[k] = buff[end + BODY_STR_LEN.size:pos]
+    if pos > len(buff):
+        raise ValueError('String exceeds buffer.')
+    return str_dict, pos
+
+
+def _pack_6000(payload):
+    """ Returns the binary body of a 6000 (loco status) msg w/the given payload.
+    """
+    return ''.join((BODY_6000.pack(payload.get('sent') or int(time()),
+                                   payload['speed'],
+                                   payload['heading'],
+                                   payload['bpp'],
+                                   payload['milepost'],
+                                   payload['lat'],
+                                   payload['long'],
+                                   DIRECTIONS.index(payload['direction'])),
+                    _pack_str(payload['loco']),
+                    _pack_str_dict(payload['conns'])))
+
+
+def _unpack_6000(buff, pos):
+    """ Returns the payload of the 6000 (loco status) msg body at buff[pos] and
+        the position following it.
+    """
+    fields = BODY_6000.unpack_from(buff, pos)
+    loco_id, pos = _unpack_str(buff, pos + BODY_6000.size)
+    conns, pos = _unpack_str_dict(buff, pos)
+
+    payload = {'sent': fields[0],
+               'loco': loco_id,
+               'speed': fields[1],
+               'heading': fields[2],
+               'direction': DIRECTIONS[fields[7]],
+               'milepost': fields[4],
+               'lat': fields[5],
+               'long': fields[6],
+               'bpp': fields[3],
+               'conns': conns}
+
+    return payload, pos
+
+
+def _pack_6001(payload):
+    """ Returns the binary body of a 6001 (wayside status) msg w/the given
+        payload.
+    """
+    return ''.join((BODY_SENT.pack(payload.get('sent') or int(time())),
+                    _pack_str(payload['ID']),
+                    _pack_str_dict(payload['Children'])))
+
+
+def _unpack_6001(buff, pos):
+    """ Returns the payload of the 6001 (wayside status) msg body at buff[pos]
+        and the position following it.
+    """
+    sent = BODY_SENT.unpack_from(buff, pos)[0]
+    wayside_id, pos = _unpack_str(buff, pos + BODY_SENT.size)
+    children, pos = _unpack_str_dict(buff, pos)
+
+    return {'sent': sent, 'ID': wayside_id, 'Children': children}, pos
+
+
+def _pack_6002(payload):
+    """ Returns the binary body of a 6002 (CAD to loco) msg w/the given payload.
+    """
+    restrict = payload['Children'].get('Restrict', [])
+    locate = payload['Children'].get('LocoLocate', [])
+
+    parts = [BODY_SENT.pack(payload.get('sent') or int(time())),
+             _pack_str(payload['ID']),
+             BODY_COUNT.pack(len(restrict))]
+    parts.extend(BODY_RESTRICT.pack(*r) for r in restrict)
+    parts.append(BODY_COUNT.pack(len(locate)))
+    parts.extend(BODY_MP.pack(mp) for mp in locate)
+
+    return ''.join(parts)
+
+
+def _unpack_6002(buff, pos):
+    """ Returns the payload of the 6002 (CAD to loco) msg body at buff[pos] and
+        the position following it.
+    """
+    sent = BODY_SENT.unpack_from(buff, pos)[0]
+    loco_id, pos = _unpack_str(buff, pos + BODY_SENT.size)
+
+    restrict = []
+    count = BODY_COUNT.unpack_from(buff, pos)[0]
+    pos += BODY_COUNT.size
+    for _ in xrange(count):
+        restrict.append(BODY_RESTRICT.unpack_from(buff, pos))
+        pos += BODY_RESTRICT.size
+
+    locate = []
+    count = BODY_COUNT.unpack_from(buff, pos)[0]
+    pos += BODY_COUNT.size
+    for _ in xrange(count):
+        locate.append(BODY_MP.unpack_from(buff, pos)[0])
+        pos += BODY_MP.size
+
+    children = {'Restrict': restrict, 'LocoLocate': locate}
+    return {'sent': sent, 'ID': loco_id, 'Children': children}, pos
+
+
+def _pack_value(value, parts):
+    """ Appends the typed binary encoding of the given value to parts, a list.
+        Value may be None, bool, int, float, str, unicode, or a list, tuple or
+        dict of them.
+    """
+    if value is None:
+        parts.append('N')
+    elif value is True:
+        parts.append('T')
+    elif value is False:
+        parts.append('F')
+    elif isinstance(value, (int, long)):
+        parts.append('i' + VALUE_INT.pack(value))
+    elif isinstance(value, float):
+        parts.append('d' + VALUE_FLOAT.pack(value))
+    elif isinstance(value, str):
+        parts.append('s' + VALUE_SIZE.pack(len(value)))
+        parts.append(value)
+    elif isinstance(value, unicode):
+        value = value.encode('utf-8')
+        parts.append('u' + VALUE_SIZE.pack(len(value)))
+        parts.append(value)
+    elif isinstance(value, (list, tuple)):
+        tag = 'l' if isinstance(value, list) else 't'
+        parts.append(tag + VALUE_SIZE.pack(len(value)))
+        for v in value:
+            _pack_value(v, parts)
+    elif isinstance(value, dict):
+        parts.append('m' + VALUE_SIZE.pack(len(value)))
+        for k, v in value.iteritems():
+            _pack_value(k, parts)
+            _pack_value(v, parts)
+    else:
+        raise TypeError('Unsupported payload type: ' + type(value).__name__)
+
+
+def _unpack_value(buff, pos):
+    """ Returns the typed binary encoded value at buff[pos] and the position
+        following it.
+    """
+    tag = buff[pos]
+    pos += 1
+
+    if tag == 'N':
+        return None, pos
+    elif tag == 'T':
+        return True, pos
+    elif tag == 'F':
+        return False, pos
+    elif tag == 'i':
+        return VALUE_INT.unpack_from(buff, pos)[0], pos + VALUE_INT.size
+    elif tag == 'd':
+        return VALUE_FLOAT.unpack_from(buff, pos)[0], pos + VALUE_FLOAT.size
+
+    size = VALUE_SIZE.unpack_from(buff, pos)[0]
+    pos += VALUE_SIZE.size
+
+    if tag in 'su':
+        if pos + size > len(buff):
+            raise ValueError('String exceeds buffer.')
+        value = buff[pos:pos + size]
+        if tag == 'u':
+            value = value.decode('utf-8')
+        return value, pos + size
+    elif tag in 'lt':
+        values = []
+        for _ in xrange(size):
+            v, pos = _unpack_value(buff, pos)
+            values.append(v)
+        if tag == 't':
+            values = tuple(values)
+        return values, pos
+    elif tag == 'm':
+        values = {}
+        for _ in xrange(size):
+            k, pos = _unpack_value(buff, pos)
+            values[k], pos = _unpack_value(buff, pos)
+        return values, pos
+
+    raise ValueError('Unknown value type tag: ' + repr(tag))
+
+
+def _pack_values(payload):
+    """ Returns the typed binary body for a msg w/no fixed format.
+    """
+    parts = []
+    _pack_value(payload, parts)
+    return ''.join(parts)
+
+
+# Body (packer, unpacker) functions, by msg type. Unpackers accept the raw msg
+# and the position of the body in it, returning (payload, end_position).
+BODY_DEFAULT = (_pack_values, _unpack_value)
+BODY_CODECS = {6000: (_pack_6000, _unpack_6000),
+               6001: (_pack_6001, _unpack_6001),
+               6002: (_pack_6002, _unpack_6002)}
+
+
+class TimeoutService(Thread):
+    """ Fires the callbacks of timers that expire, for any number of timers,
+        from a single thread. Timers are kept in a heap by deadline, and a
+        keep_alive() only updates its timer's deadline: A timer is rescheduled
+        to its current deadline when the heap's entry for it comes due, so
+        each costs O(log n) per timeout period, however often it's kept alive.
+        Each key has at most one timer, and a timer at most one live heap
+        entry, however often it's rescheduled or cancelled.
+        Connections share one TimeoutService, see get_shared().
+    """
+    _shared = None  # The shared TimeoutService
+    _shared_lock = Lock()
+
+    def __init__(self):
+        Thread.__init__(self)
+        self.daemon = True
+        # { KEY: [DEADLINE, TIMEOUT, CALLBACK, ENTRY_DEADLINE] }, where
+        # CALLBACK is None if cancelled, and ENTRY_DEADLINE is the deadline
+        # of the timer's live heap entry.
+        self._timers = {}
+        self._heap = []  # Heap of (DEADLINE, SEQ, KEY, TIMER)
+        self._seq = count()  # Heap tie-breaker
+        self._cond = Condition()
+
+    @staticmethod
+    def get_shared():
+        """ Returns the shared TimeoutService, starting it if need be.
+        """
+        with TimeoutService._shared_lock:
+            if not TimeoutService._shared:
+                TimeoutService._shared = TimeoutService()
+                TimeoutService._shared.start()
+        return TimeoutService._shared
+
+    def schedule(self, key, timeout, callback):
+        """ Calls callback, with no args, once timeout secs pass without a
+            keep_alive() for the given key (any hashable). Replaces any timer
+            for the key, in place if its heap entry comes due no later than
+            the new deadline (as is usual), else with a new entry.
+        """
+        deadline = time() + timeout
+        with self._cond:
+            timer = self._timers.get(key)
+            if timer and timer[3] <= deadline:
+                timer[:3] = [deadline, timeout, callback]
+                return
+
+            timer = [deadline, timeout, callback, deadline]
+            self._timers[key] = timer
+            heappush(self._heap, (deadline, next(self._seq), key, timer))
+            if self._heap[0][3] is timer:
+                self._cond.notify()  # Now the first due
+
+    def keep_alive(self, key):
+        """ Restarts the given key's timer, if any. O(1).
+        """
+        with self._cond:
+            timer = self._timers.get(key)
+            if timer and timer[2]:
+                timer[0] = time() + timer[1]
+
+    def cancel(self, key):
+        """ Cancels the given key's timer, if any. It's kept until its heap
+            entry comes due, for reuse if the key is rescheduled before then.
+        """
+        with self._cond:
+            timer = self._timers.get(key)
+            if timer:
+                timer[2] = None
+
+    def __len__(self):
+        with self._cond:
+            return len([t for t in self._timers.values() if t[2]])
+
+    def run(self):
+        while True:
+            with self._cond:
+                if not self._heap:
+                    self._cond.wait()
+                    continue
+
+                deadline, _, key, timer = self._heap[0]
+                now = time()
+                if deadline > now:
+                    self._cond.wait(deadline - now)
+                    continue
+                heappop(self._heap)
+
+                if self._timers.get(key) is not timer or timer[3] != deadline:
+                    continue  # Replaced, so not the timer's live entry
+                if not timer[2]:
+                    del self._timers[key]  # Cancelled
+                    continue
+                if timer[0] > now:  # Kept alive since scheduled
+                    timer[3] = timer[0]
+                    entry = (timer[0], next(self._seq), key, timer)
+                    heappush(self._heap, entry)
+                    continue
+                del self._timers[key]
+
+            try:
+                timer[2]()
+            except Exception as e:
+                broker_log.error('Timeout callback failed: ' + str(e))
+
 
 class Connection(object):
     """ An abstraction of a communication interface. Ex: A 220 MHz radio
-        connection. Contains a messaging client and a thread that disconnects
-        on timeout.
+        connection. Contains a messaging client, and disconnects on timeout
+        (see TimeoutService).
         Note: This class is nominal and for sim purposes only at this point -
         no actual TCP/IP or EMP addressing here.
     """
@@ -164,8 +1041,8 @@ class Connection(object):
             self.Receiver       : (Receiver) Incoming TCP/IP connection watcher
             self.conn_to   : (TrackDevice) Active connection partner
 
-            self._timeout_seconds: (int) Seconds of inactivity before timeout
-            self._timeout_watcher: A thread. Updates self.active on timeout
+            self._timeout : (int) Seconds of inactivity before timeout,
+                            or 0 for none
         """
         # Properties
         self.ID = ID
@@ -179,8 +1056,8 @@ class Connection(object):
 
         # Timeout
         self._timeout = timeout
-        self.timeout_watcher = Thread(target=self._timeoutwatcher)
-        # self.timeout_watcher.start()
+        self._lock = Lock()  # Guards the above against the TimeoutService
+        self._conn_count = 0  # Connects so far, identifying each timeout
 
     def __str__(self):
         """ Returns a string representation of the base station """
@@ -200,21 +1077,33 @@ class Connection(object):
         """ Fetches the next message from the given queue at the broker and
             returns it. Also updates keep alive.
         """
-        self.client.fetch_next_msg(queue_name)
+        msg = self.client.fetch_next_msg(queue_name)
         self.keep_alive()
+        return msg
 
     def keep_alive(self):
         """ Update the last activity time to prevent timeout.
         """
-        self.active = True
-        self.last_activity = datetime.datetime.now()
+        with self._lock:
+            self.active = True
+            self.last_activity = datetime.datetime.now()
+            if self._timeout and self.conn_to:
+                TimeoutService.get_shared().keep_alive(self)
 
     def connect(self, obj):
         """ Establishes the connection (nominally, at this point), to the
-            given TrackDevice.
+            given TrackDevice. It's disconnected after timeout secs without
+            activity.
         """
-        self.conn_to = obj
-        self.keep_alive()
+        with self._lock:
+            self.conn_to = obj
+            self.active = True
+            self.last_activity = datetime.datetime.now()
+            self._conn_count += 1
+            if self._timeout:
+                conn_count = self._conn_count
+                TimeoutService.get_shared().schedule(
+                    self, self._timeout, lambda: self._timed_out(conn_count))
 
     def connected(self):
         """ Returns True if connection is connected, else returns False
@@ -226,53 +1115,577 @@ class Connection(object):
     def disconnect(self):
         """ "Terminates" the nominal connection
         """
-        self.conn_to = None
+        with self._lock:
+            self.conn_to = None
+            if self._timeout:
+                TimeoutService.get_shared().cancel(self)
+
+    def _timed_out(self, conn_count):
+        """ Disconnects, and resets the connection's 'active' flag, unless
+            reconnected since the given connect (by count), whose timeout
+            this is. Called by the TimeoutService, from its thread.
+        """
+        with self._lock:
+            if conn_count != self._conn_count:
+                return  # Timed out as the connection was re-established
+            self.active = False
+            self.conn_to = None
 
-    def _timeoutwatcher(self):
-        """ Resets the connections 'active' flag if timeout elapses
-            Intended to run as a thread.
+
+def msg_to_frame(raw_msg, binary):
+    """ Returns the given raw EMP msg as frame content for the given framing.
+    """
+    return raw_msg if binary else raw_msg.encode('hex')
+
+
+def frame_to_msg(frame, binary):
+    """ Returns the raw EMP msg contained in the given frame content.
+    """
+    return frame if binary else frame.decode('hex')
+
+
+class MsgSocket(object):
+    """ A TCP/IP socket exchanging frames, allowing any number of requests and
+        responses over a single connection. Frames are either:
+            Hex: Newline-terminated. Frame content must not contain newlines,
+                 so EMP msgs are sent hex encoded.
+            Binary: Length prefixed. EMP msgs are sent as-is.
+        The connecting side chooses the framing. The accepting side detects it
+        from the first bytes received.
+    """
+    def __init__(self, sock, framing=None):
+        """ self.sock   : (socket) The underlying, connected socket
+            self.binary : (bool) True if binary framing, False if hex framing,
+                          None until detected (if accepting side)
+            self.fresh  : (bool) True until the socket has been used once
+            self.subscription: (Subscription) The broker-side subscription
+                          this socket delivers, if any
+            framing     : FRAMING_HEX or FRAMING_BINARY if the connecting
+                          side, else None.
+        """
+        self.sock = sock
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.binary = None
+        self.fresh = True
+        self.subscription = None
+        self._buff = ''  # Received hex framing data not yet returned
+        self._rbuff = None  # Binary framing receive buffer, a bytearray
+        self._rview = None  # memoryview of _rbuff
+
+        if framing == FRAMING_BINARY:
+            self._set_binary()
+            self.sock.sendall(FRAME_PREAMBLE)
+        elif framing == FRAMING_HEX:
+            self.binary = False
+
+    def _set_binary(self):
+        """ Switches to binary framing, preallocating the receive buffer.
+        """
+        self.binary = True
+        self._rbuff = bytearray(MAX_MSG_SIZE)
+        self._rview = memoryview(self._rbuff)
+
+    def peer_closed(self):
+        """ Returns True if the peer has closed (or reset) the connection,
+            without blocking. For checking an idle connection before reuse.
+        """
+        try:
+            if not select.select([self.sock], [], [], 0)[0]:
+                return False  # Nothing to read, so not closed
+            return not self.sock.recv(1, socket.MSG_PEEK)
+        except (socket.error, select.error):
+            return True
+
+    def send_frame(self, frame):
+        """ Sends the given frame (a str).
+        """
+        if self.binary:
+            self.sock.sendall(FRAME_LEN.pack(len(frame)) + frame)
+        else:
+            self.sock.sendall(frame + '\n')
+
+    def recv_frame(self):
+        """ Returns the next frame received, blocking until one arrives or the
+            socket times out. Returns None if the peer closed the connection.
+        """
+        if self.binary is None:
+            # Detect framing from the first byte, keeping it if hex framing
+            first = self.sock.recv(1)
+            if not first:
+                return None
+            elif first == FRAME_PREAMBLE[0]:
+                if not self._recv_into(len(FRAME_PREAMBLE) - 1):
+                    return None
+                if self._rbuff[0] != ord(FRAME_PREAMBLE[1]):
+                    raise socket.error('Unsupported binary framing version.')
+                self._set_binary()
+            else:
+                self.binary = False
+                self._buff = first
+
+        if self.binary:
+            if not self._recv_into(FRAME_LEN.size):
+                return None
+            size = FRAME_LEN.unpack_from(self._rbuff)[0]
+            if size > MAX_FRAME_SIZE:
+                raise socket.error('Frame exceeds MAX_FRAME_SIZE.')
+            if not self._recv_into(size, True):
+                return None
+            return self._rview[:size].tobytes()
+
+        while True:
+            end = self._buff.find('\n')
+            if end >= 0:
+                frame = self._buff[:end]
+                self._buff = self._buff[end + 1:]
+                return frame
+
+            if len(self._buff) > MAX_HEX_FRAME_SIZE:
+                raise socket.error('Frame exceeds MAX_HEX_FRAME_SIZE.')
+            data = self.sock.recv(MAX_MSG_SIZE)
+            if not data:
+                return None
+            self._buff += data
+
+    def _recv_into(self, size, in_frame=False):
+        """ Receives exactly size bytes into the start of the receive buffer,
+            growing it if needed. Returns False if the peer closed the
+            connection first. A timeout raises socket.timeout if no bytes
+            were received yet (and not in_frame), else socket.error, as the
+            stream is then out of sync.
+        """
+        if self._rbuff is None or size > len(self._rbuff):
+            self._rbuff = bytearray(max(size, MAX_MSG_SIZE))
+            self._rview = memoryview(self._rbuff)
+
+        pos = 0
+        while pos < size:
+            try:
+                n = self.sock.recv_into(self._rview[pos:size], size - pos)
+            except socket.timeout:
+                if pos or in_frame:
+                    raise socket.error('Timed out mid-frame.')
+                raise
+            if not n:
+                return False
+            pos += n
+
+        return True
+
+    def close(self):
+        """ Closes the underlying socket.
+        """
+        try:
+            self.sock.close()
+        except:
+            pass
+
+
+class ConnPool(object):
+    """ A bounded pool of persistent TCP/IP connections (as MsgSockets) to a
+        single broker address. Connections are opened as needed, up to
+        max_size at once, and kept open for reuse after each request.
+        Note: Pools are per-process. Use get_pool() rather than instantiating.
+    """
+    _pools = {}  # All pools: { (PID, (HOST, PORT), FRAMING): ConnPool }
+    _pools_lock = Lock()
+
+    def __init__(self, address, framing=WIRE_FRAMING, max_size=POOL_SIZE):
+        """ self.address    : (tuple) The broker address, as (host, port)
+            self.framing    : FRAMING_HEX or FRAMING_BINARY
+            self.binary     : (bool) True iff binary framing
+        """
+        self.address = address
+        self.framing = framing
+        self.binary = framing == FRAMING_BINARY
+        self._idle = []  # Idle MsgSockets, most recently used last
+        self._lock = Lock()
+        self._slots = BoundedSemaphore(max_size)
+
+    @staticmethod
+    def get_pool(address, framing=WIRE_FRAMING, max_size=POOL_SIZE):
+        """ Returns this process's pool for the given (host, port) and framing,
+            creating it with the given max_size if needed. Keying by process
+            ensures sockets are never shared with a forked child.
+        """
+        key = (os.getpid(), address, framing)
+        pool = ConnPool._pools.get(key)
+        if not pool:
+            with ConnPool._pools_lock:
+                pool = ConnPool._pools.setdefault(
+                    key, ConnPool(address, framing, max_size))
+        return pool
+
+    def acquire(self):
+        """ Returns an idle connection from the pool, or a new one if none are
+            idle. Blocks while max_size connections are already in use.
+        """
+        self._slots.acquire()
+        msock = None
+        while not msock:
+            with self._lock:
+                msock = self._idle.pop() if self._idle else None
+            if not msock:
+                break
+            if msock.peer_closed():
+                msock.close()  # Ex: The broker closed it while idle
+                msock = None
+
+        if not msock:
+            try:
+                sock = socket.create_connection(self.address)
+                msock = MsgSocket(sock, self.framing)
+            except:
+                self._slots.release()
+                raise
+        return msock
+
+    def release(self, msock, discard=False):
+        """ Returns the given connection to the pool, or closes it if discard.
+        """
+        if discard:
+            msock.close()
+        else:
+            msock.fresh = False
+            with self._lock:
+                self._idle.append(msock)
+        self._slots.release()
+
+    def request(self, frame):
+        """ Sends the given frame over a pooled connection and returns the
+            response frame. If a reused connection fails before the frame is
+            sent (ex: the broker closed it while idle), the request is retried
+            over a new connection. Once sent, the broker may have acted on
+            it, so any failure is raised rather than retried.
         """
         while True:
-            if not self.last_activity:
-                self.disconnect()
-            elif self._timeout != 0:
-                delta = datetime.timedelta(seconds=self._timeout)
-                if delta < datetime.datetime.now() - self.last_activity:
-                    self.disconnect()
-            sleep(REFRESH_TIME)
+            msock = self.acquire()
+            sent = False
+            try:
+                msock.send_frame(frame)
+                sent = True
+                resp = msock.recv_frame()
+                if resp is None:
+                    raise socket.error('Connection closed by broker.')
+            except:
+                self.release(msock, discard=True)
+                if msock.fresh or sent:
+                    raise
+                continue  # Reconnect and retry
+
+            self.release(msock)
+            return resp
+
+    def request_many(self, frames):
+        """ Sends the given frames over one pooled connection and returns a
+            list of their response frames, in order. Requests are pipelined,
+            up to PIPELINE_DEPTH at a time, rather than each awaiting the last
+            one's response. If a reused connection fails before any frame is
+            sent, the requests are retried over a new connection. If it fails
+            once frames are sent, the responses received so far are returned
+            (fewer than the frames given), as the broker may have acted on
+            the rest. Raises if the connection fails before any response.
+        """
+        responses = []
+        while True:
+            msock = self.acquire()
+            sent = False
+            try:
+                for i in xrange(0, len(frames), PIPELINE_DEPTH):
+                    chunk = frames[i:i + PIPELINE_DEPTH]
+                    for frame in chunk:
+                        msock.send_frame(frame)
+                        sent = True
+                    for _ in chunk:
+                        resp = msock.recv_frame()
+                        if resp is None:
+                            raise socket.error('Connection closed by broker.')
+                        responses.append(resp)
+            except:
+                self.release(msock, discard=True)
+                if responses:
+                    return responses
+                if msock.fresh or sent:
+                    raise
+                continue  # Reconnect and retry
+
+            self.release(msock)
+            return responses
+
+
+class ShmRing(object):
+    """ A ring buffer of records (strs) in shared memory, for passing records
+        between processes. Records are put by any number of producers and got
+        by a single consumer, in order.
+        Note: Must be created before the processes sharing it are forked.
+    """
+    def __init__(self, size=SHM_RING_SIZE):
+        """ self.size : (int) The ring's capacity, in bytes
+        """
+        self.size = size
+        self._data = RawArray('c', size)
+        self._idx = RawArray('L', 2)  # Total bytes ever put, and ever got
+        self._put_lock = ProcessLock()
+        self._records = ProcessSemaphore(0)  # Records put but not yet got
+
+    def put(self, record, timeout):
+        """ Puts the given record, waiting up to timeout seconds for room if
+            the ring is full. Raises Queue.Full if there is none by then.
+        """
+        record = SHM_REC_LEN.pack(len(record)) + record
+        if len(record) > self.size:
+            raise ValueError('Record exceeds shm_ring_size.')
+
+        with self._put_lock:
+            head = self._idx[0]
+            give_up = time() + timeout
+            while head + len(record) - self._idx[1] > self.size:
+                if time() >= give_up:
+                    raise Queue.Full
+                sleep(SHM_POLL)
+            self._write(head, record)
+            self._idx[0] = head + len(record)
+        self._records.release()
+
+    def get(self, timeout=None):
+        """ Returns the next record, waiting up to timeout seconds (or forever,
+            if None) for one. Raises Queue.Empty if none.
+        """
+        if not self._records.acquire(True, timeout):
+            raise Queue.Empty
+
+        tail = self._idx[1]
+        size = SHM_REC_LEN.unpack(self._read(tail, SHM_REC_LEN.size))[0]
+        record = self._read(tail + SHM_REC_LEN.size, size)
+        self._idx[1] = tail + SHM_REC_LEN.size + size
+        return record
+
+    def _write(self, pos, data):
+        """ Copies data into the ring at pos, wrapping around its end.
+        """
+        start = pos % self.size
+        split = min(len(data), self.size - start)
+        self._data[start:start + split] = data[:split]
+        if split < len(data):
+            self._data[:len(data) - split] = data[split:]
+
+    def _read(self, pos, size):
+        """ Returns size bytes from the ring at pos, wrapping around its end.
+        """
+        start = pos % self.size
+        split = min(size, self.size - start)
+        data = self._data[start:start + split]
+        if split < size:
+            data += self._data[:size - split]
+        return data
+
+
+class ShmTransport(object):
+    """ A shared memory transport between broker clients and an (unsharded)
+        MsgBroker on the same host, in place of TCP/IP. Requests from all
+        clients share one ShmRing, served in order by the broker's ShmServer,
+        and each of a fixed number of channels has its own response ShmRing.
+        A channel carries one request at a time. Frames are binary framed.
+        Subscriptions are not supported, see Client.subscribe().
+        Note: Must be created before the broker and client processes are
+        forked, and given to both. See MsgBroker and Client.
+    """
+    def __init__(self, channels=SHM_CHANNELS, ring_size=SHM_RING_SIZE):
+        """ self.requests   : (ShmRing) Requests, from all channels
+            self.max_response: (int) Max response frame size, in bytes
+        """
+        self.requests = ShmRing(ring_size)
+        self.max_response = ring_size - SHM_REC_LEN.size - SHM_RESP.size
+        self._responses = [ShmRing(ring_size) for _ in range(channels)]
+        self._locks = [ProcessLock() for _ in range(channels)]
+        self._seqs = RawArray('L', channels)  # Last seq, by channel
+
+    def _acquire(self):
+        """ Returns the index of a channel, locked for the caller's use.
+            Blocks while all are in use.
+        """
+        for i, lock in enumerate(self._locks):
+            if lock.acquire(False):
+                return i
+        i = hash(os.getpid()) % len(self._locks)
+        self._locks[i].acquire()
+        return i
+
+    def request(self, frame, sending):
+        """ Sends the given request frame, to the broker's send or fetch side,
+            and returns the response frame.
+        """
+        chan = self._acquire()
+        try:
+            # In shared memory, so seqs stay unique across forked clients
+            seq = (self._seqs[chan] + 1) & 0xFFFFFFFF
+            self._seqs[chan] = seq
+            kind = SHM_SEND if sending else SHM_FETCH
+            try:
+                self.requests.put(SHM_REQ.pack(chan, kind, seq) + frame,
+                                  config.network_timeout)
+            except Queue.Full:
+                raise socket.timeout('Shared memory request ring full.')
+
+            # Responses to requests that timed out are skipped
+            while True:
+                try:
+                    resp = self._responses[chan].get(config.network_timeout)
+                except Queue.Empty:
+                    raise socket.timeout('Shared memory request timed out.')
+                if SHM_RESP.unpack_from(resp)[0] == seq:
+                    return resp[SHM_RESP.size:]
+        finally:
+            self._locks[chan].release()
+
+    def respond(self, chan, seq, frame):
+        """ Sends the given response frame to the request of the given seq
+            over the given channel, without waiting. Raises Queue.Full if the
+            channel's response ring is full, i.e. its requester is gone.
+        """
+        self._responses[chan].put(SHM_RESP.pack(seq) + frame, 0)
+
+    def endpoint(self, sending):
+        """ Returns a ShmEndpoint to the broker's send or fetch side.
+        """
+        return ShmEndpoint(self, sending)
+
+
+class ShmEndpoint(object):
+    """ The send or fetch side of a ShmTransport, with the request interface of
+        a ConnPool.
+    """
+    binary = True
+
+    def __init__(self, transport, sending):
+        self.transport = transport
+        self.sending = sending
+
+    def request(self, frame):
+        """ Sends the given frame to the broker and returns the response frame.
+        """
+        return self.transport.request(frame, self.sending)
+
+    def request_many(self, frames):
+        """ Sends the given frames to the broker, in turn, and returns a list
+            of their response frames. As ConnPool.request_many(), a failure
+            returns the responses received so far, if any, else raises.
+        """
+        responses = []
+        for frame in frames:
+            try:
+                responses.append(self.transport.request(frame, self.sending))
+            except:
+                if responses:
+                    return responses
+                raise
+        return responses
+
+
+def shard_of(address, num_shards):
+    """ Returns the index of the broker shard owning the given address's queue,
+        given the number of shards.
+    """
+    return (crc32(address) & 0xffffffff) % num_shards
+
+
+def shard_ports(shard, base_port=SHARD_BASE_PORT):
+    """ Returns the (send_port, fetch_port) of the given broker shard.
+    """
+    return base_port + 2 * shard, base_port + 2 * shard + 1
 
 
 class Client(object):
     """ Exposes send_msg() and fetch_msg() interfaces to broker clients.
+        Requests are made over persistent, pooled broker connections.
+        If the broker is sharded (see MsgBroker), requests are made to the
+        shard owning the queue in question directly, rather than through the
+        broker's router. The broker's shard map is requested again after any
+        failed request, in case the broker restarted.
+        If given a transport (a ShmTransport), or Client.default_transport is
+        set, requests are made over it instead of TCP/IP.
     """
+    _shard_maps = {}  # { (HOST, FETCH_PORT): (NUM_SHARDS, SHARD_BASE_PORT) }
+    default_transport = None  # Transport of Clients not given one
 
     def __init__(self,
                  broker=BROKER,
                  broker_send_port=SEND_PORT,
-                 broker_fetch_port=FETCH_PORT):
-        """
+                 broker_fetch_port=FETCH_PORT,
+                 framing=WIRE_FRAMING,
+                 transport=None):
+        """ framing: Wire framing, either FRAMING_BINARY or FRAMING_HEX
+            transport: A ShmTransport, or None for TCP/IP
         """
         self.broker = broker
         self.send_port = broker_send_port
         self.fetch_port = broker_fetch_port
+        self.framing = framing
+        self.transport = transport or Client.default_transport
+
+    def _ports(self, queue_name):
+        """ Returns the (send_port, fetch_port) serving the given queue: Those
+            of its shard, if the broker is sharded, else the broker's own. The
+            broker's shard map is cached per process, see _forget_shards().
+        """
+        key = (self.broker, self.fetch_port)
+        shard_map = Client._shard_maps.get(key)
+        if not shard_map:
+            pool = ConnPool.get_pool(key, self.framing)
+            resp = pool.request('SHARDS')
+            try:
+                _, num_shards, base_port = resp.split(' ')
+                shard_map = (int(num_shards), int(base_port))
+            except ValueError:
+                shard_map = (1, None)  # Broker predates sharding
+            Client._shard_maps[key] = shard_map
+
+        num_shards, base_port = shard_map
+        if num_shards < 2:
+            return self.send_port, self.fetch_port
+        return shard_ports(shard_of(queue_name, num_shards), base_port)
+
+    def _forget_shards(self):
+        """ Drops the broker's cached shard map, e.g. after a failed request.
+        """
+        Client._shard_maps.pop((self.broker, self.fetch_port), None)
+
+    def _pool(self, queue_name, sending):
+        """ Returns the ConnPool (or transport endpoint) serving requests for
+            the given queue, to the broker's send or fetch side.
+        """
+        if self.transport:
+            return self.transport.endpoint(sending)
+
+        send_port, fetch_port = self._ports(queue_name)
+        port = send_port if sending else fetch_port
+        return ConnPool.get_pool((self.broker, port), self.framing)
+
+    def _pool_groups(self, queue_names, sending):
+        """ Groups requests for the given queues by the ConnPool (or
+            transport endpoint) serving them. Returns a list of (pool, idxs),
+            where idxs are the indexes into queue_names of its requests.
+        """
+        groups = {}
+        for i, queue_name in enumerate(queue_names):
+            key = None if self.transport else self._ports(queue_name)
+            groups.setdefault(key, []).append(i)
+
+        return [(self._pool(queue_names[idxs[0]], sending), idxs)
+                for idxs in groups.values()]
 
     def send_msg(self, message):
-        """ Sends the given message (of type Message) over TCP/IP to the 
-            broker. The msg will wait at the broker in the queue specified by
-            the message to be fetched by other broker clients.
+        """ Sends the given message (of type Message) to the broker. The msg
+            will wait at the broker in the queue specified by the message to be
+            fetched by other broker clients.
             Returns True if msg sent succesfully, else raises an issue-
             specific exception.
         """
         try:
-            # Init socket and connect to broker
-            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            sock.connect((self.broker, self.send_port))
-
-            # Send message and wait for a response
-            sock.send(message.raw_msg.encode('hex'))
-            response = sock.recv(MAX_MSG_SIZE).decode()
-            sock.close()
+            pool = self._pool(message.dest_addr, True)
+            response = pool.request(msg_to_frame(message.raw_msg, pool.binary))
         except:
+            self._forget_shards()
             raise Exception('Send Error: Could not connect to broker.')
 
         if response == 'OK':
@@ -283,161 +1696,2114 @@ class Client(object):
             err_str = 'Send Error: Unhandled response received from broker.'
             raise Exception(err_str)
 
+    def send_many(self, messages):
+        """ Sends the given messages (a list of Message) to the broker, with
+            requests pipelined over one connection per broker port (see
+            ConnPool.request_many), rather than each awaiting a response.
+            Returns a list of the msgs not sent, either for lack of a broker
+            connection or response, or as the broker responded with FAIL,
+            which is empty on success. As each msg keeps its seq, resending
+            them is safe.
+        """
+        failed = []
+        try:
+            groups = self._pool_groups([m.dest_addr for m in messages], True)
+        except:
+            self._forget_shards()
+            return list(messages)
+
+        for pool, idxs in groups:
+            group = [messages[i] for i in idxs]
+            frames = [msg_to_frame(m.raw_msg, pool.binary) for m in group]
+            try:
+                resps = pool.request_many(frames)
+            except:
+                resps = []
+            if len(resps) < len(group):
+                self._forget_shards()
+            failed.extend(m for m, r in zip(group, resps) if r != 'OK')
+            failed.extend(group[len(resps):])  # Those without a response
+
+        return failed
+
     def fetch_next_msg(self, queue_name):
         """ Fetches the next msg from queue_name from the broker and returns it,
             Raises Queue.Empty if specified queue is empty.
         """
         try:
-            # Establish socket connection
-            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            sock.connect((self.broker, self.fetch_port))
-
-            # Send queue name and wait for response
-            sock.send(queue_name.encode())
-            resp = sock.recv(MAX_MSG_SIZE)
+            pool = self._pool(queue_name, False)
+            resp = pool.request(queue_name)
         except:
+            self._forget_shards()
             raise Exception('Fetch Error: Could not connect to broker.')
 
-        msg = None
         if resp == 'EMPTY':
             raise Queue.Empty  # No msg available to fetch
-        else:
-            msg = Message(resp.decode('hex'))  # Response is the msg
-
-        sock.close()
-
-        return msg
 
+        return Message(frame_to_msg(resp, pool.binary))  # Response is the msg
 
-def get_6000_msg(loco):
-        """ Returns a well-formed 6000 (loco status) msg for the given loco.
+    def fetch_next_msgs(self, queue_names):
+        """ Fetches the next msg from each of the given queues from the
+            broker, with requests pipelined (see send_many()). Returns a list
+            of each queue's msg, or None where a queue is empty or its request
+            failed. Msgs fetched before any failure are always returned, and
+            failed requests aren't retried, as the broker may have served
+            them. Raises only if no request could be made at all.
         """
-        con_str = str({k: v.conn_to.ID for (k, v)
-                       in loco.conns.iteritems()
-                       if v.connected() is True})
-                       
-        status = {'loco': loco.ID,
-                  'speed': loco.speed,
-                  'heading': loco.heading,
-                  'direction': loco.direction,
-                  'milepost': loco.coords.marker,
-                  'lat': loco.coords.lat,
-                  'long': loco.coords.long,
-                  'bpp': loco.bpp,
-                  'conns': con_str}
+        msgs = [None] * len(queue_names)
+        answered = 0
+        try:
+            groups = self._pool_groups(queue_names, False)
+        except:
+            self._forget_shards()
+            raise Exception('Fetch Error: Could not connect to broker.')
 
-        msg_type = 6000
-        msg_source = loco.emp_addr
-        msg_dest = BOS_EMP
-        payload = status
+        for pool, idxs in groups:
+            try:
+                resps = pool.request_many([queue_names[i] for i in idxs])
+            except:
+                resps = []
+            if len(resps) < len(idxs):
+                self._forget_shards()
+            answered += len(resps)
+            for i, resp in zip(idxs, resps):
+                if resp == 'EMPTY':
+                    continue
+                try:
+                    msgs[i] = Message(frame_to_msg(resp, pool.binary))
+                except Exception as e:
+                    broker_log.error('Fetched msg malformed: ' + str(e))
 
-        status_msg = Message((msg_type,
-                              msg_source,
-                              msg_dest,
-                              payload))
+        if queue_names and not answered:
+            raise Exception('Fetch Error: Could not connect to broker.')
+        return msgs
 
-        return status_msg
+    def fetch_many(self, queue_name, max_n=0):
+        """ Fetches up to max_n msgs from queue_name from the broker in a single
+            request and returns them as a list, which is empty if the queue
+            is. If max_n is 0, the queue is drained.
+        """
+        try:
+            pool = self._pool(queue_name, False)
+            resp = pool.request('MANY ' + queue_name + ' ' + str(max_n))
+        except:
+            self._forget_shards()
+            raise Exception('Fetch Error: Could not connect to broker.')
 
+        if resp == 'EMPTY':
+            return []
+        elif resp == 'FAIL':
+            raise Exception('Fetch Error: Broker responded with FAIL.')
 
-class Receiver(Thread):
-    """ Watches for incoming EMP messages over TCP/IP on the interface and port 
-        specified and adds them to the given list of queues (a list)
+        batch = frame_to_msg(resp, pool.binary)
+        return [Message(raw_msg) for raw_msg in Message.split_batch(batch)]
+
+    def fetch_stats(self):
+        """ Fetches and returns the broker's stats, as a dict of the form given
+            by BrokerCore.stats().
+        """
+        try:
+            if self.transport:
+                pool = self.transport.endpoint(False)
+            else:
+                pool = ConnPool.get_pool((self.broker, self.fetch_port),
+                                         self.framing)
+            resp = pool.request('STATS')
+        except:
+            raise Exception('Fetch Error: Could not connect to broker.')
+
+        return json.loads(resp)
+
+    def subscribe(self, queue_name, window=SUB_WINDOW):
+        """ Returns a Subscriber to queue_name at the broker, to which msgs are
+            pushed as they are enqueued, up to window msgs at a time.
+            Note: Subscriptions are always over TCP/IP, whatever the transport.
+        """
+        try:
+            _, fetch_port = self._ports(queue_name)
+        except:
+            fetch_port = self.fetch_port  # Subscriber retries on its own
+        return Subscriber(queue_name,
+                          window,
+                          self.broker,
+                          fetch_port,
+                          self.framing)
+
+
+class Subscriber(object):
+    """ A subscription to a broker queue. The broker pushes msgs from the queue
+        as they are enqueued, over a dedicated persistent connection, with at
+        most window msgs unacknowledged at a time. Msgs are acknowledged as
+        they are received by next_msg(), and those unacknowledged when the
+        connection is lost are redelivered.
     """
-    def __init__(self, outgoing_queues):
-        Thread.__init__(self)
-        self.outgoing_queues = outgoing_queues
+    def __init__(self,
+                 queue_name,
+                 window=SUB_WINDOW,
+                 broker=BROKER,
+                 broker_fetch_port=FETCH_PORT,
+                 framing=WIRE_FRAMING):
+        """ queue_name  : (str) The queue (i.e. EMP address) subscribed to
+            window      : (int) Max msgs in flight from the broker
+        """
+        self.queue_name = queue_name
+        self.window = window
+        self.broker = broker
+        self.fetch_port = broker_fetch_port
+        self.framing = framing
+        self._msock = None
+        self._unacked = 0  # Msgs received but not yet acknowledged
 
-    def run(self):
-        # Init TCP/IP listener
-        sock = socket.socket()
-        sock.bind((BROKER, SEND_PORT))
-        sock.listen(1)
+    def _subscribe(self):
+        """ Connects to the broker and subscribes to the queue.
+        """
+        sock = socket.create_connection((self.broker, self.fetch_port))
+        msock = MsgSocket(sock, self.framing)
+        try:
+            msock.send_frame('SUB ' + self.queue_name + ' ' + str(self.window))
+            resp = msock.recv_frame()
+        except:
+            msock.close()
+            raise
 
-        while True:
-            # Block until timeout or a send request is received
+        if resp != 'OK':
+            msock.close()
+            raise Exception('Subscribe Error: Broker refused subscription.')
+
+        self._msock = msock
+        self._unacked = 0
+
+    def next_msg(self, timeout=None):
+        """ Returns the next msg pushed by the broker, waiting up to timeout
+            seconds for one (or indefinitely, if None). Raises Queue.Empty on
+            timeout. Subscribes (or re-subscribes, after a connection
+            failure) as needed.
+        """
+        raw_msg = self.next_raw_msg(timeout)
+        try:
+            return Message(raw_msg)
+        except Exception as e:
+            raise Exception('Subscribe Error: Malformed msg received: ' +
+                            str(e))
+
+    def next_raw_msg(self, timeout=None):
+        """ As next_msg(), but returns the raw EMP msg, undecoded (e.g. for
+            decoding in batches, see Message.decode_6000_many).
+        """
+        try:
+            if not self._msock:
+                self._subscribe()
+            self._msock.sock.settimeout(timeout)
+            frame = self._msock.recv_frame()
+            if frame is None:
+                raise socket.error('Connection closed by broker.')
+        except socket.timeout:
+            raise Queue.Empty
+        except:
+            self.close()
+            raise Exception('Subscribe Error: Connection to broker lost.')
+
+        # Acknowledge msgs in batches of half the window, to keep it open.
+        # Counted before decoding, so a malformed msg still frees its credit.
+        binary = self._msock.binary
+        self._unacked += 1
+        if self._unacked >= max(1, self.window / 2):
+            self._ack()
+
+        try:
+            return frame_to_msg(frame, binary)
+        except Exception as e:
+            raise Exception('Subscribe Error: Malformed msg received: ' +
+                            str(e))
+
+    def _ack(self):
+        """ Acknowledges the msgs received since the last ACK. Closes the
+            subscription if the ACK can't be sent.
+        """
+        try:
+            self._msock.send_frame('ACK ' + str(self._unacked))
+            self._unacked = 0
+        except:
+            self.close()
+
+    def close(self):
+        """ Ends the subscription, first acknowledging the msgs received. The
+            broker redelivers those it pushed that weren't acknowledged.
+            Msgs pushed but unread are drained until the broker closes its
+            end, as closing with them unread would reset the connection,
+            losing the ACK.
+        """
+        if self._msock:
+            sock = self._msock.sock
             try:
-                conn, client = sock.accept()
+                if self._unacked:
+                    self._msock.send_frame('ACK ' + str(self._unacked))
+                sock.shutdown(socket.SHUT_WR)
+                deadline = time() + SUB_CLOSE_TIMEOUT
+                while deadline > time():
+                    sock.settimeout(deadline - time())
+                    if not sock.recv(65536):
+                        break  # Broker closed its end, having read the ACK
             except:
+                pass
+            self._msock.close()
+            self._msock = None
+            self._unacked = 0
+
+
+class McastSender(object):
+    """ Broadcasts EMP msgs to an IP multicast group (i.e. EMP Class C), for
+        receipt by any number of McastListeners, one datagram per msg. Msgs
+        must have a seq (see Message.next_seq), by which listeners detect lost
+        msgs in place of TCP's reliability.
+    """
+    def __init__(self, group=MCAST_GROUP, port=MCAST_PORT, iface=MCAST_IFACE):
+        """ group : (str) The multicast group's IP address
+            iface : (str) The IP address of the interface to send over
+        """
+        self.group = group
+        self.port = port
+        self._sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self._sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, 1)
+        self._sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_LOOP, 1)
+        self._sock.setsockopt(socket.IPPROTO_IP,
+                              socket.IP_MULTICAST_IF,
+                              socket.inet_aton(iface))
+
+    def send_msg(self, message):
+        """ Broadcasts the given message (of type Message) to the group and
+            returns its sequence number.
+        """
+        if message.seq is None:
+            raise Exception('Send Error: Msg has no seq.')
+        if len(message.raw_msg) > MAX_DATAGRAM_SIZE:
+            raise Exception('Send Error: Msg exceeds max datagram size.')
+        self._sock.sendto(message.raw_msg, (self.group, self.port))
+        return message.seq
+
+    def close(self):
+        self._sock.close()
+
+
+class McastListener(object):
+    """ A member of an IP multicast group, receiving the EMP msgs broadcast to
+        it by McastSenders. Msgs are received at most once and in order, per
+        sender: A gap in a sender's sequence numbers counts as that many lost
+        msgs, and a msg older than the last received from its sender is
+        dropped as a duplicate or out of order.
+    """
+    def __init__(self, log, group=MCAST_GROUP, port=MCAST_PORT,
+                 iface=MCAST_IFACE):
+        """ self.log        : (Logger) The listener's log, e.g. its process's
+            self.received   : (int) Msgs received
+            self.lost       : (int) Msgs detected as lost, by sequence gaps
+            self.dropped    : (int) Msgs dropped as malformed, duplicate, or
+                              out of order
+        """
+        self.log = log
+        self.group = group
+        self.port = port
+        self.received = 0
+        self.lost = 0
+        self.dropped = 0
+        self._next_seqs = {}  # { SENDER_ADDR: Next expected seq }
+
+        self._sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self._sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if hasattr(socket, 'SO_REUSEPORT'):
+            self._sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        self._sock.bind(('', port))
+        membership = socket.inet_aton(group) + socket.inet_aton(iface)
+        self._sock.setsockopt(socket.IPPROTO_IP,
+                              socket.IP_ADD_MEMBERSHIP,
+                              membership)
+
+    def next_msg(self, timeout=None):
+        """ Returns the next msg broadcast to the group, waiting up to timeout
+            seconds for one (or indefinitely, if None). Raises Queue.Empty on
+            timeout, or an exception if the msg's body is malformed.
+        """
+        return Message(self.next_raw_msg(timeout))
+
+    def next_raw_msg(self, timeout=None):
+        """ As next_msg(), but returns the raw EMP msg, with its CRC and header
+            validated but its body not decoded (e.g. for decoding in batches,
+            see Message.decode_6000_many).
+        """
+        self._sock.settimeout(timeout)
+        while True:
+            try:
+                datagram = self._sock.recv(MAX_DATAGRAM_SIZE)
+            except socket.timeout:
+                raise Queue.Empty
+
+            try:
+                sender_addr = Message._unpack(datagram)[2]
+                if not EMP_HEAD.unpack_from(datagram)[3] & EMP_FLAG_SEQ:
+                    raise Exception('Msg has no seq.')
+                seq = EMP_SEQ.unpack_from(datagram, EMP_HEAD.size)[0]
+            except Exception:
+                self.dropped += 1
+                self.log.warn('Malformed multicast msg dropped.')
                 continue
 
-            # Receive the msg from sender, responding with either OK or FAIL
-            log_str = 'Incoming msg from ' + str(client[0]) + ' gave: '
+            if self._sequence(sender_addr, seq):
+                self.received += 1
+                return datagram
+
+    def _sequence(self, sender_addr, seq):
+        """ Notes the given seq as received from the given sender, returning
+            False if the msg is to be dropped. A seq far behind the sender's
+            last is taken to mean the sender restarted.
+        """
+        expected = self._next_seqs.get(sender_addr)
+        if expected is not None:
+            behind = (expected - seq) & 0xFFFFFFFF
+            if 0 < behind <= MCAST_SEQ_WINDOW:
+                self.dropped += 1  # Duplicate or out of order
+                return False
+
+            ahead = (seq - expected) & 0xFFFFFFFF
+            if 0 < ahead <= MCAST_SEQ_WINDOW:
+                self.lost += ahead
+                self.log.warn('Lost ' + str(ahead) + ' multicast msg(s) ' +
+                              'from ' + sender_addr)
+
+        self._next_seqs[sender_addr] = (seq + 1) & 0xFFFFFFFF
+        return True
+
+    def close(self):
+        self._sock.close()
+
+
+def get_6000_msg(loco, sent=None):
+        """ Returns a well-formed 6000 (loco status) msg for the given loco,
+            sent at the given Unix time (e.g. a sim time), else now.
+        """
+        conns = {k: v.conn_to.ID for (k, v)
+                 in loco.conns.iteritems()
+                 if v.connected() is True}
+
+        status = {'sent': int(time() if sent is None else sent),
+                  'loco': loco.ID,
+                  'speed': loco.speed,
+                  'heading': loco.heading,
+                  'direction': loco.direction,
+                  'milepost': loco.coords.marker,
+                  'lat': loco.coords.lat,
+                  'long': loco.coords.long,
+                  'bpp': loco.bpp,
+                  'conns': conns}
+
+        msg_type = 6000
+        msg_source = loco.emp_addr
+        msg_dest = BOS_EMP
+        payload = status
+
+        status_msg = Message((msg_type,
+                              msg_source,
+                              msg_dest,
+                              payload))
+
+        return status_msg
+
+
+class MsgQueue(object):
+    """ A broker queue of msgs for a single address, served highest priority
+        (i.e. QoS, see MSG_QOS) first, then oldest first. Msgs expire ttl
+        seconds after they are enqueued, or after their own network TTL if
+        sooner, and are dropped rather than dequeued after.
+        If max_depth, a full queue either drops its oldest msg of the lowest
+        priority on put, or rejects the put, depending on overflow
+        ('drop_oldest' or 'reject'). A put of lower priority than all msgs
+        in a full queue is always rejected.
+        Thread-safe.
+    """
+    def __init__(self,
+                 ttl=MSG_EXPIRE,
+                 max_depth=MAX_QUEUE_DEPTH,
+                 overflow=QUEUE_OVERFLOW):
+        """ self.ttl        : (float) Msg time-to-live in seconds. 0 = forever
+            self.max_depth  : (int) Max msgs in queue. 0 = unlimited
+            self.overflow   : (str) Full queue policy, 'drop_oldest'/'reject'
+            self.stats      : (QueueStats) The queue's counters
+        """
+        self.ttl = ttl
+        self.max_depth = max_depth
+        self.overflow = overflow
+        self.stats = QueueStats()
+        # Queued msgs by priority, each as (expire_time, enqueued, msg)
+        self._msgs = [deque() for _ in range(QOS_PRIORITIES)]
+        self._depth = 0
+        self._cond = Condition(Lock())
+
+    def __len__(self):
+        return self._depth
+
+    def _expire_time(self, msg, enqueued):
+        """ Returns the time the given msg, enqueued at the given time, expires,
+            or None if never.
+        """
+        ttls = [ttl for ttl in (self.ttl, msg.ttl) if ttl]
+        return enqueued + min(ttls) if ttls else None
+
+    def put(self, msg, enqueued=None, journal=None):
+        """ Enqueues the given msg, as of the given enqueue time (default now).
+            Returns its expire time (or None if it never expires) and the msg
+            dropped to make room for it, if any.
+            Raises Queue.Full if the queue is full and overflow is 'reject'.
+            If a MsgJournal is given, the msg is journaled once accepted, so
+            journal order matches queue order. If journaling raises, the
+            queue is left unchanged.
+        """
+        enqueued = enqueued or time()
+        expire_at = self._expire_time(msg, enqueued)
+        priority = msg.qos & QOS_PRIORITY_MASK
+        dropped = None
+
+        with self._cond:
+            lowest = None
+            if self.max_depth and self._depth >= self.max_depth:
+                lowest = next(i for i, msgs in enumerate(self._msgs) if msgs)
+                if self.overflow == 'reject' or lowest > priority:
+                    self.stats.rejected += 1
+                    raise Queue.Full
+            if journal:
+                msg.journal_seq = journal.append(msg, enqueued)  # May raise
+            if lowest is not None:
+                dropped = self._msgs[lowest].popleft()[2]
+                self._depth -= 1
+                self.stats.dropped += 1
+            self._msgs[priority].append((expire_at, enqueued, msg))
+            self._depth += 1
+            self.stats.enqueued += 1
+            self._cond.notify()
+
+        return expire_at, dropped
+
+    def get(self, timeout=0):
+        """ Dequeues and returns the next unexpired msg by priority, discarding
+            any expired ones before it, waiting up to timeout seconds for one.
+            Raises Queue.Empty if none.
+        """
+        with self._cond:
+            end = None
+            while True:
+                now = time()
+                for msgs in reversed(self._msgs):
+                    while msgs:
+                        expire_at, enqueued, msg = msgs.popleft()
+                        self._depth -= 1
+                        if expire_at and expire_at <= now:
+                            self.stats.expired += 1
+                            continue
+
+                        msg.enqueued = enqueued
+                        msg.wait_time = now - enqueued
+                        self.stats.dequeued += 1
+                        self.stats.wait_times.add(msg.wait_time)
+                        return msg
+
+                if end is None:
+                    end = now + timeout
+                if now >= end:
+                    raise Queue.Empty
+                self._cond.wait(end - now)
+
+    def requeue(self, msg):
+        """ Returns the given msg, previously dequeued, to the queue's head.
+            Its dequeue is uncounted, and its time in queue is counted from
+            its original enqueue time when next dequeued.
+        """
+        expire_at = self._expire_time(msg, time())
+        with self._cond:
+            self._msgs[msg.qos & QOS_PRIORITY_MASK].appendleft(
+                (expire_at, msg.enqueued, msg))
+            self._depth += 1
+            self.stats.dequeued -= 1
+            self.stats.wait_times.remove(msg.wait_time)
+            self._cond.notify()
+
+    def expire(self, msg):
+        """ Removes the given msg iff it's at the head of its priority's msgs.
+            Returns True iff removed. Note: As msg TTLs vary, an expired msg
+            may be behind an unexpired one, in which case it's instead
+            dropped when reached by get().
+        """
+        with self._cond:
+            msgs = self._msgs[msg.qos & QOS_PRIORITY_MASK]
+            if msgs and msgs[0][2] is msg:
+                msgs.popleft()
+                self._depth -= 1
+                self.stats.expired += 1
+                return True
+        return False
+
+
+class Histogram(object):
+    """ A histogram of durations, in buckets of exponentially increasing size
+        (from 0.1 ms up to about 14 min), so adding a sample is O(log n) in
+        the number of buckets and its memory use is constant.
+        Not thread-safe.
+    """
+    _bounds = [0.0001 * 2 ** i for i in range(24)]  # Bucket upper bounds
+
+    def __init__(self):
+        self.counts = [0] * (len(self._bounds) + 1)  # Last is overflow bucket
+        self.total = 0
+
+    def add(self, secs):
+        """ Counts the given duration, in seconds.
+        """
+        self.counts[bisect_left(self._bounds, secs)] += 1
+        self.total += 1
+
+    def remove(self, secs):
+        """ Uncounts the given duration, in seconds, previously added.
+        """
+        self.counts[bisect_left(self._bounds, secs)] -= 1
+        self.total -= 1
+
+    def percentile(self, pct):
+        """ Returns the upper bound, in seconds, of the bucket containing the
+            given percentile, or None if no samples.
+        """
+        if not self.total:
+            return None
+
+        target = self.total * pct / 100.0
+        seen = 0
+        for i, n in enumerate(self.counts):
+            seen += n
+            if seen >= target:
+                break
+        return self._bounds[min(i, len(self._bounds) - 1)]
+
+
+class QueueStats(object):
+    """ A MsgQueue's running counters, updated under the queue's lock.
+    """
+    def __init__(self):
+        """ self.enqueued   : (int) Msgs accepted
+            self.dequeued   : (int) Msgs fetched or pushed
+            self.rejected   : (int) Msgs rejected due to a full queue
+            self.dropped    : (int) Msgs dropped to make room for newer ones
+            self.expired    : (int) Msgs expired before being dequeued
+            self.wait_times : (Histogram) Time in queue of each dequeued msg
+        """
+        self.enqueued = 0
+        self.dequeued = 0
+        self.rejected = 0
+        self.dropped = 0
+        self.expired = 0
+        self.wait_times = Histogram()
+
+
+class JournalSegment(object):
+    """ A MsgJournal segment file's in-memory index.
+    """
+    def __init__(self, fname, first_seq=None):
+        """ self.fname      : (str) The segment's file name
+            self.first_seq  : (int) Seq of its first msg, or of the msg it
+                               would begin with, if none
+            self.end_seq    : (int) Seq of the next segment's first msg, or
+                               None if this is the active segment
+            self.live       : (set) Seqs of its msgs not yet consumed
+            self.acks       : (set) Seqs of earlier segments' msgs it acks
+            self.last_time  : (float) Enqueue time of its last msg
+        """
+        self.fname = fname
+        self.first_seq = first_seq
+        self.end_seq = None
+        self.live = set()
+        self.acks = set()
+        self.last_time = 0
+
+    def holds(self, seq):
+        """ Returns True iff the msg of the given seq was journaled here.
+        """
+        return self.first_seq <= seq and \
+            (self.end_seq is None or seq < self.end_seq)
+
+
+class MsgJournal(object):
+    """ An append-only, memory-mapped log of the msgs accepted by the broker
+        and of acks of those consumed (fetched, pushed or dropped), allowing
+        queued msgs to survive a restart. Msgs are acked individually, as
+        queues serve msgs by priority and not in the order they arrived.
+        The log is a directory of fixed-size segment files, numbered in order.
+        Appends are copies into the active segment's mmap, which is synced to
+        disk every sync_interval seconds, along with any acks made since the
+        last sync. So msgs accepted within sync_interval of an OS crash may be
+        lost, and msgs consumed within it may be delivered again.
+        Sealed segments are deleted once all their msgs are consumed or
+        expired, with any acks they hold of msgs in remaining segments first
+        carried forward to the active one.
+        Thread-safe.
+    """
+    def __init__(self,
+                 path=JOURNAL_DIR,
+                 segment_size=JOURNAL_SEGMENT_SIZE,
+                 sync_interval=JOURNAL_SYNC_INTERVAL,
+                 ttl=MSG_EXPIRE):
+        """ self.path           : (str) The journal's directory
+            self.segment_size   : (int) Segment file size, in bytes
+            self.sync_interval  : (float) Secs between syncs. 0 = every write
+            self.ttl            : (float) Msg time-to-live in seconds
+        """
+        self.path = path
+        self.segment_size = segment_size
+        self.sync_interval = sync_interval
+        self.ttl = ttl
+        self._segments = []  # JournalSegments, oldest first
+        self._file = None  # Active (i.e. last) segment's file
+        self._map = None  # Active segment's mmap
+        self._pos = 0  # Active segment's write position
+        self._seq = 1  # Next msg seq
+        self._acks = []  # Seqs of consumed msgs not yet acked in the journal
+        self._unsynced = False  # Active segment written since last sync
+        self._lock = Lock()
+
+        self._syncer = Thread(target=self._sync_loop)
+        self._syncer.daemon = True
+
+    def recover(self):
+        """ Scans the journal's segments, oldest first, then opens the journal
+            for appends. Returns its unconsumed msgs, oldest first, as a list
+            of (seq, enqueue_time, dest_addr, raw_msg).
+        """
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+
+        msgs = []
+        acked = set()
+        offsets = {}  # Consumer offsets, as journaled by earlier versions
+        end = 0
+        for fname in sorted(f for f in os.listdir(self.path)
+                            if f.endswith('.log')):
+            segment = JournalSegment(os.path.join(self.path, fname))
+            records, end = self._scan(segment.fname)
+
+            for kind, payload in records:
+                if kind == JRNL_KIND_MSG:
+                    seq, enqueued, addr_len = JRNL_MSG.unpack_from(payload)
+                    addr_end = JRNL_MSG.size + addr_len
+                    addr = payload[JRNL_MSG.size:addr_end]
+                    msgs.append((seq, enqueued, addr, payload[addr_end:]))
+                    if segment.first_seq is None:
+                        segment.first_seq = seq
+                    segment.live.add(seq)
+                    segment.last_time = enqueued
+                    self._seq = seq + 1
+                elif kind == JRNL_KIND_ACK:
+                    for pos in xrange(0, len(payload), JRNL_ACK.size):
+                        seq, = JRNL_ACK.unpack_from(payload, pos)
+                        acked.add(seq)
+                        if segment.first_seq is None or \
+                                seq < segment.first_seq:
+                            segment.acks.add(seq)
+                else:
+                    seq, _ = JRNL_OFFSET.unpack_from(payload)
+                    addr = payload[JRNL_OFFSET.size:]
+                    offsets[addr] = max(seq, offsets.get(addr, 0))
+
+            if segment.first_seq is None:
+                segment.first_seq = self._seq
+            if self._segments:
+                self._segments[-1].end_seq = segment.first_seq
+            self._segments.append(segment)
+
+        # Offsets ack all msgs to their address up to them. They're rewritten
+        # as acks, as the segments holding them may soon be deleted.
+        migrated = [m[0] for m in msgs
+                    if m[0] not in acked and m[0] <= offsets.get(m[2], 0)]
+        acked.update(migrated)
+        for segment in self._segments:
+            segment.live -= acked
+
+        if self._segments:
+            self._open_segment(self._segments[-1].fname, end)
+        else:
+            self._new_segment()
+        if migrated:
+            self._write_acks(migrated)
+        self._syncer.start()
+
+        return [m for m in msgs if m[0] not in acked]
+
+    @staticmethod
+    def _scan(fname):
+        """ Returns the records of the given segment file, as a list of
+            (kind, payload), and the position following the last of them.
+            The scan ends at the first unwritten or torn record.
+        """
+        with open(fname, 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            if not size:
+                return [], 0
+            seg = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        records = []
+        pos = 0
+        try:
+            while pos + JRNL_REC.size <= size:
+                kind, length, crc = JRNL_REC.unpack_from(seg, pos)
+                start = pos + JRNL_REC.size
+                end = start + length
+                if kind not in JRNL_KINDS or end > size:
+                    break
+                payload = seg[start:end]
+                if crc32(payload) != crc:
+                    break
+                records.append((kind, payload))
+                pos = end
+        finally:
+            seg.close()
+
+        return records, pos
+
+    def _open_segment(self, fname, pos=0):
+        """ Maps the given segment file, creating it if needed, as the active
+            segment, with writes resuming at pos. Any torn write at pos is
+            zeroed so it isn't mistaken for a record by later scans. If this
+            raises, the active segment is unchanged.
+        """
+        mode = 'r+b' if os.path.exists(fname) else 'w+b'
+        seg_file = open(fname, mode)
+        try:
+            # Zero-filled, not truncated, so disk space is allocated now. A
+            # full disk then raises here, not SIGBUS on a write to the mmap.
+            size = os.fstat(seg_file.fileno()).st_size
+            if size < self.segment_size:
+                seg_file.seek(size)
+                zeros = '\x00' * (1 << 20)
+                while size < self.segment_size:
+                    n = min(len(zeros), self.segment_size - size)
+                    seg_file.write(zeros[:n])
+                    size += n
+                seg_file.flush()
+                os.fsync(seg_file.fileno())
+            seg = mmap.mmap(seg_file.fileno(), 0)
+        except:
+            seg_file.close()
+            raise
+
+        if seg[pos:pos + 1] not in ('', '\x00'):
+            seg[pos:] = '\x00' * (len(seg) - pos)
+            seg.flush()
+
+        self._file = seg_file
+        self._map = seg
+        self._pos = pos
+
+    def _close_segment(self):
+        """ Syncs and unmaps the active segment.
+        """
+        self._map.flush()
+        self._map.close()
+        self._file.close()
+
+    def _new_segment(self):
+        """ Seals the active segment, if any, and starts a new one.
+        """
+        num = 0
+        if self._segments:
+            num = int(os.path.basename(self._segments[-1].fname)[:-4]) + 1
+            self._map.flush()
+            prev = self._file, self._map
+
+        # Open the new segment first, so on failure the active one remains
+        fname = os.path.join(self.path, '%010d.log' % num)
+        self._open_segment(fname)
+        if self._segments:
+            prev[1].close()
+            prev[0].close()
+            self._segments[-1].end_seq = self._seq
+        self._segments.append(JournalSegment(fname, self._seq))
+
+    def _write(self, kind, payload):
+        """ Appends a record of the given kind and payload to the active
+            segment, first starting a new segment if it won't fit.
+        """
+        end = self._pos + JRNL_REC.size + len(payload)
+        if end > len(self._map):
+            if self._pos == 0:
+                raise Exception('Journal record exceeds journal_segment_size.')
+            self._new_segment()
+            return self._write(kind, payload)
+
+        JRNL_REC.pack_into(self._map, self._pos, kind, len(payload),
+                           crc32(payload))
+        self._map[self._pos + JRNL_REC.size:end] = payload
+        self._pos = end
+
+        if self.sync_interval:
+            self._unsynced = True
+        else:
+            self._map.flush()
+
+    def _write_acks(self, seqs):
+        """ Appends ack records of the given msg seqs to the active segment.
+        """
+        for i in xrange(0, len(seqs), JRNL_MAX_ACKS):
+            batch = seqs[i:i + JRNL_MAX_ACKS]
+            self._write(JRNL_KIND_ACK,
+                        ''.join(JRNL_ACK.pack(seq) for seq in batch))
+            segment = self._segments[-1]  # Written to, if _write rolled over
+            segment.acks.update(s for s in batch if s < segment.first_seq)
+
+    def _segment_of(self, seq):
+        """ Returns the JournalSegment holding the msg of the given seq, or
+            None if that segment was deleted.
+        """
+        for segment in reversed(self._segments):
+            if segment.holds(seq):
+                return segment
+            if seq >= segment.first_seq:
+                break
+        return None
+
+    def append(self, msg, enqueued):
+        """ Journals the given Message, enqueued at the given time. Returns
+            the msg's seq.
+        """
+        addr = msg.dest_addr
+        with self._lock:
+            seq = self._seq
+            head = JRNL_MSG.pack(seq, enqueued, len(addr))
+            self._write(JRNL_KIND_MSG, ''.join((head, addr, msg.raw_msg)))
+            self._seq += 1
+
+            segment = self._segments[-1]
+            segment.live.add(seq)
+            segment.last_time = enqueued
+        return seq
+
+    def consumed(self, seq):
+        """ Acks the msg of the given seq, i.e. marks it consumed.
+        """
+        with self._lock:
+            segment = self._segment_of(seq)
+            if not segment or seq not in segment.live:
+                return
+            segment.live.discard(seq)
+            if self.sync_interval:
+                self._acks.append(seq)
+            else:
+                self._write_acks([seq])
+
+    def sync(self):
+        """ Journals the acks made since the last sync, syncs the active
+            segment to disk, and deletes the sealed segments no longer needed.
+        """
+        with self._lock:
+            if self._acks:
+                self._write_acks(self._acks)
+                self._acks = []
+            seg_map = self._map if self._unsynced else None
+            self._unsynced = False
+            self._purge()
+
+        # Sync outside the lock, so appends aren't blocked meanwhile
+        if seg_map:
             try:
-                raw_msg = conn.recv(MAX_MSG_SIZE).decode()
-                msg = Message(raw_msg.decode('hex'))
-                conn.send('OK'.encode())
-                conn.close()
+                seg_map.flush()
+            except ValueError:
+                pass  # Sealed and closed meanwhile, which syncs it
+
+    def _purge(self):
+        """ Deletes each sealed segment whose msgs are all consumed or expired,
+            first carrying forward the acks it holds that are still needed.
+        """
+        expired = time() - self.ttl if self.ttl else 0
+        for segment in self._segments[:-1]:
+            if segment.live and segment.last_time >= expired:
+                continue
+            carried = sorted(s for s in segment.acks if self._segment_of(s))
+            if carried:
+                self._write_acks(carried)  # May seal the active segment
+            try:
+                os.remove(segment.fname)
+            except OSError as e:
+                broker_log.error('Journal segment delete failed: ' + str(e))
+                continue
+            self._segments.remove(segment)
+            broker_log.info('Journal segment deleted: ' + segment.fname)
+
+    def _sync_loop(self):
+        """ Syncs the journal every sync_interval seconds (or every second if
+            every write is synced), until the process exits.
+        """
+        while True:
+            sleep(self.sync_interval or 1)
+            try:
+                self.sync()
             except Exception as e:
-                log_str += 'Msg recv failed due to ' + str(e)
-                broker_log.error(log_str)
+                broker_log.error('Journal sync failed: ' + str(e))
 
-                try:
-                    conn.send('FAIL'.encode())
-                except:
-                    pass
 
-                conn.close()
+class Subscription(object):
+    """ A broker-side subscription to a queue. Msgs are delivered by calling
+        push(raw_msg) while the subscription has credit (i.e. room in its
+        in-flight window), which is granted by the subscriber's ACKs. Pushed
+        msgs stay in flight until acked, and are returned to the queue if the
+        subscription ends first.
+    """
+    def __init__(self, queue_name, push):
+        """ self.queue_name : (str) The queue subscribed to
+            self.push       : A function accepting a raw EMP msg to deliver
+            self.credit     : (int) Msgs that may be pushed before an ACK
+            self.outbox     : (deque) Msgs dequeued for it, not yet pushed
+            self.inflight   : (deque) Msgs pushed, not yet acked
+            self.closed     : (bool) True once unsubscribed
+        """
+        self.queue_name = queue_name
+        self.push = push
+        self.credit = 0
+        self.outbox = deque()
+        self.inflight = deque()
+        self.closed = False
+        self.push_lock = Lock()  # Serializes pushes, keeping msgs in order
+
+
+class DedupIndex(object):
+    """ The seqs of the msgs most recently received from each sender, by which
+        the broker drops duplicate msgs (e.g. a msg sent again over another
+        radio after its first send wasn't acknowledged). Holds up to window
+        seqs for each of up to max_senders senders, evicting the oldest seq
+        and the least recently heard from sender, respectively.
+    """
+    def __init__(self, window=DEDUP_WINDOW, max_senders=DEDUP_SENDERS):
+        self.window = window
+        self.max_senders = max_senders
+        self._senders = OrderedDict()  # { SENDER_ADDR: (set, deque) }
+        self._lock = Lock()
+
+    def seen(self, sender_addr, seq):
+        """ Returns True if the given sender's msg of the given seq was seen
+            already, else notes it as seen and returns False.
+        """
+        with self._lock:
+            entry = self._senders.pop(sender_addr, None)
+            if entry is None:
+                entry = (set(), deque())
+                if len(self._senders) >= self.max_senders:
+                    self._senders.popitem(last=False)
+            self._senders[sender_addr] = entry  # Now most recent
+
+            seqs, order = entry
+            if seq in seqs:
+                return True
+            seqs.add(seq)
+            order.append(seq)
+            if len(order) > self.window:
+                seqs.discard(order.popleft())
+            return False
+
+    def forget(self, sender_addr, seq):
+        """ Un-notes the given sender's msg of the given seq as seen, e.g.
+            because it was rejected, so that it may be resent.
+        """
+        with self._lock:
+            entry = self._senders.get(sender_addr)
+            if entry and seq in entry[0]:
+                seqs, order = entry
+                seqs.discard(seq)
+                if order[-1] == seq:
+                    order.pop()  # The usual case, as just seen
+                else:
+                    order.remove(seq)
+
+
+class BrokerCore(object):
+    """ The message broker's outgoing msg queues, by address, and its handling
+        of client send, fetch and subscribe requests. Shared by the broker's
+        network engines (see MsgBroker).
+        Expired msgs are evicted by expire_msgs(), via a heap of expire times,
+        so queues that are never fetched from don't grow without bound.
+        If a MsgJournal is attached (see attach_journal), accepted msgs are
+        journaled and consumed msgs are recorded in it.
+        Duplicate msgs, by sender and seq, are dropped (see DedupIndex).
+        Queue stats are served in response to STATS requests, see stats().
+    """
+    def __init__(self,
+                 ttl=MSG_EXPIRE,
+                 max_depth=MAX_QUEUE_DEPTH,
+                 overflow=QUEUE_OVERFLOW):
+        """ ttl, max_depth, overflow: Settings for each MsgQueue
+        """
+        self.outgoing_queues = {}  # Outbound msg queues: { ADDRESS: MsgQueue }
+        self.subscriptions = {}  # Queue subscriptions: { ADDRESS: [Sub, ...] }
+        self.queue_args = (ttl, max_depth, overflow)
+        self._sub_lock = Lock()
+        self._expiry = []  # Heap of (EXPIRE_TIME, SEQ, ADDRESS, MSG)
+        self._expiry_lock = Lock()
+        self._expiry_seq = count()  # Heap tie-breaker
+        self.journal = None  # MsgJournal, if durable
+        self.failed = 0  # Malformed or oversize msgs received
+        self.duplicates = 0  # Duplicate msgs received
+        self.dedup = DedupIndex() if DEDUP_WINDOW else None
+        self.started = time()
+        self._stats_lock = Lock()
+        self._samples = deque(maxlen=STATS_RATE_WINDOW + 1)  # See sample()
+
+    def retune(self, changed):
+        """ Applies the given changed tunable config values (see AppConfig) to
+            the broker's queues. A shorter msg_expire_time applies to msgs
+            enqueued from now on.
+        """
+        ttl, max_depth, overflow = self.queue_args
+        ttl = changed.get('msg_expire_time', ttl)
+        max_depth = changed.get('max_queue_depth', max_depth)
+        overflow = changed.get('queue_overflow', overflow)
+        self.queue_args = (ttl, max_depth, overflow)
+
+        for queue in self.outgoing_queues.values():
+            with queue._cond:
+                queue.ttl = ttl
+                queue.max_depth = max_depth
+                queue.overflow = overflow
+
+    def attach_journal(self, journal):
+        """ Restores the unconsumed, unexpired msgs in the given MsgJournal to
+            their queues, then journals all msgs accepted from now on to it.
+        """
+        ttl, max_depth, overflow = self.queue_args
+        now = time()
+        recovered = journal.recover()
+
+        # Msgs that would be dropped on restore aren't worth decoding, and are
+        # simply marked consumed
+        if max_depth and overflow != 'reject':
+            depths = {}
+            for i in xrange(len(recovered) - 1, -1, -1):
+                seq, _, addr, _ = recovered[i]
+                depths[addr] = depths.get(addr, 0) + 1
+                if depths[addr] > max_depth:
+                    journal.consumed(seq)
+                    recovered[i] = None
+
+        restored = 0
+        for entry in recovered:
+            if not entry or (ttl and entry[1] + ttl <= now):
                 continue
+            seq, enqueued, addr, raw_msg = entry
+            try:
+                msg = Message(raw_msg)
+            except Exception as e:
+                broker_log.error('Journaled msg restore failed: ' + str(e))
+                continue
+            msg.journal_seq = seq
 
-            # Add msg to outgoing queue dict, keyed by dest_addr
-            if not self.outgoing_queues.get(msg.dest_addr):
-                self.outgoing_queues[msg.dest_addr] = Queue.Queue()
-            self.outgoing_queues[msg.dest_addr].put(msg)
-            log_str = 'Msg served: ' + msg.sender_addr + ' '
-            log_str += 'to ' + msg.dest_addr
+            queue = self.outgoing_queues.get(addr)
+            if queue is None:
+                queue = MsgQueue(*self.queue_args)
+                self.outgoing_queues[addr] = queue
+            try:
+                expire_at, _ = queue.put(msg, enqueued)
+            except Queue.Full:
+                continue
+            if expire_at:
+                entry = (expire_at, next(self._expiry_seq), addr, msg)
+                heappush(self._expiry, entry)
+            restored += 1
+
+        self.journal = journal
+        broker_log.info('Journal opened: ' + str(restored) + ' msgs restored.')
+
+    def handle_send(self, request, binary, client):
+        """ Enqueues the msg in the given send request (a frame, in binary or
+            hex framing) from the given client, a (host, port) tuple.
+            Returns the response, either OK or FAIL.
+        """
+        try:
+            msg = Message(frame_to_msg(request, binary))
+            if len(msg.raw_msg) > MAX_MSG_SIZE:
+                raise Exception('Msg exceeds max_msg_size.')
+        except Exception as e:
+            log_str = 'Incoming msg from ' + str(client[0]) + ' gave: '
+            log_str += 'Msg recv failed due to ' + str(e)
+            broker_log.error(log_str)
+            with self._stats_lock:
+                self.failed += 1
+            return 'FAIL'
+
+        # Duplicates were accepted already, so are acknowledged but dropped
+        dedup = self.dedup if msg.seq is not None else None
+        if dedup and dedup.seen(msg.sender_addr, msg.seq):
+            broker_log.info('Duplicate msg dropped: ' + msg.sender_addr +
+                            ' seq ' + str(msg.seq))
+            with self._stats_lock:
+                self.duplicates += 1
+            return 'OK'
+
+        # Add msg to outgoing queue dict, keyed by dest_addr
+        queue = self.outgoing_queues.get(msg.dest_addr)
+        if queue is None:
+            queue = self.outgoing_queues.setdefault(msg.dest_addr,
+                                                    MsgQueue(*self.queue_args))
+        try:
+            expire_at, dropped = queue.put(msg, journal=self.journal)
+        except Queue.Full:
+            broker_log.warn('Msg rejected: Queue full for ' + msg.dest_addr)
+            if dedup:
+                dedup.forget(msg.sender_addr, msg.seq)
+            return 'FAIL'
+        except Exception as e:
+            # Ex: Journal I/O failed. The msg wasn't accepted, so a resend
+            # mustn't be taken as a duplicate.
+            broker_log.error('Msg rejected: Journal failed: ' + str(e))
+            if dedup:
+                dedup.forget(msg.sender_addr, msg.seq)
+            with self._stats_lock:
+                self.failed += 1
+            return 'FAIL'
+
+        if expire_at:
+            entry = (expire_at, next(self._expiry_seq), msg.dest_addr, msg)
+            with self._expiry_lock:
+                heappush(self._expiry, entry)
+        if dropped:
+            broker_log.warn('Oldest msg dropped: Queue full for ' +
+                            msg.dest_addr)
+            if self.journal:
+                self.journal.consumed(dropped.journal_seq)
+
+        log_str = 'Msg served: ' + msg.sender_addr + ' '
+        log_str += 'to ' + msg.dest_addr
+        broker_log.info(log_str)
+
+        if msg.dest_addr in self.subscriptions:
+            self._deliver(msg.dest_addr)
+
+        return 'OK'
+
+    def handle_fetch(self, request, binary, client, timeout=0,
+                     max_size=MAX_FRAME_SIZE):
+        """ Returns the response to the given fetch request (a frame) from the
+            given client: The next msg in the queue named by request, or
+            EMPTY if none arrives within timeout seconds.
+            Requests of the form 'MANY queue_name max_n' are instead responded
+            to with a batch of up to max_size bytes of msgs, a request of
+            STATS with the broker's stats, as JSON, and a request of SHARDS
+            with 'SHARDS 1 port' (see Router).
+        """
+        if request.startswith('MANY '):
+            return self._fetch_many(request, binary, client, max_size)
+        if request == 'STATS':
+            return json.dumps(self.stats())
+        if request == 'SHARDS':
+            return 'SHARDS 1 ' + str(SHARD_BASE_PORT)  # i.e. Unsharded
+
+        queue_name = request
+        log_str = 'Fetch request from ' + str(client[0]) + ' '
+        log_str += 'for ' + queue_name + ' gave: '
+
+        msg = None
+        try:
+            msg = self.outgoing_queues[queue_name].get(timeout)
+        except (KeyError, Queue.Empty):
+            log_str += 'Queue empty.'
             broker_log.info(log_str)
+            return 'EMPTY'
 
-        # Do cleanup
-        sock.close()
+        if self.journal:
+            self.journal.consumed(msg.journal_seq)
 
+        log_str += 'Msg served.'
+        broker_log.info(log_str)
+        return msg_to_frame(msg.raw_msg, binary)
 
-class MsgServer(Thread):
-    """ Watches for incoming TCP/IP msg requests (ex, A loco or the BOS
-        checking its msg queue) and serves them from the given list of queues 
-        by address.
-        After a msg is served it's removed from the queue.
+    def _fetch_many(self, request, binary, client, max_size=MAX_FRAME_SIZE):
+        """ Responds to a request of the form 'MANY queue_name max_n' with up to
+            max_n msgs (or all, if max_n is 0) from the named queue, as a batch
+            of concatenated EMP msgs, or EMPTY. Batches are capped at max_size
+            bytes.
+        """
+        try:
+            _, queue_name, max_n = request.split(' ')
+            max_n = int(max_n)
+        except ValueError:
+            return 'FAIL'
+
+        log_str = 'Fetch many request from ' + str(client[0]) + ' '
+        log_str += 'for ' + queue_name + ' gave: '
+
+        raw_msgs = []
+        batch_size = 0
+        if not binary:
+            max_size /= 2
+        queue = self.outgoing_queues.get(queue_name)
+        while queue and (not max_n or len(raw_msgs) < max_n):
+            try:
+                msg = queue.get()
+            except Queue.Empty:
+                break
+
+            if self.journal:
+                self.journal.consumed(msg.journal_seq)
+            raw_msgs.append(msg.raw_msg)
+            batch_size += len(msg.raw_msg)
+            if batch_size + MAX_MSG_SIZE > max_size:
+                break  # Another msg may not fit
+
+        if not raw_msgs:
+            log_str += 'Queue empty.'
+            broker_log.info(log_str)
+            return 'EMPTY'
+
+        log_str += str(len(raw_msgs)) + ' msgs served.'
+        broker_log.info(log_str)
+        return msg_to_frame(''.join(raw_msgs), binary)
+
+    @staticmethod
+    def parse_subscribe(request):
+        """ Given a request of the form 'SUB queue_name window', returns
+            (queue_name, window), or None if the request is malformed.
+        """
+        try:
+            _, queue_name, window = request.split(' ')
+            window = int(window)
+        except ValueError:
+            return None
+        if window < 1:
+            return None
+        return queue_name, window
+
+    @staticmethod
+    def parse_ack(request):
+        """ Given a request of the form 'ACK n', returns n, or None if the
+            request is malformed.
+        """
+        try:
+            _, n = request.split(' ')
+            return max(int(n), 0)
+        except ValueError:
+            return None
+
+    def subscribe(self, queue_name, push, client):
+        """ Registers and returns a Subscription to queue_name for the given
+            client, delivering via push. It has no credit until acked.
+        """
+        sub = Subscription(queue_name, push)
+        with self._sub_lock:
+            self.subscriptions.setdefault(queue_name, []).append(sub)
+        broker_log.info('Subscribe request from ' + str(client[0]) + ' ' +
+                        'for ' + queue_name + ' accepted.')
+        return sub
+
+    def unsubscribe(self, sub):
+        """ Removes the given Subscription, returning its msgs not yet acked
+            to the head of the queue, in order, for its other subscribers or
+            later fetches.
+        """
+        with self._sub_lock:
+            if sub.closed:
+                return
+            sub.closed = True
+            subs = self.subscriptions.get(sub.queue_name, [])
+            if sub in subs:
+                subs.remove(sub)
+            if not subs:
+                self.subscriptions.pop(sub.queue_name, None)
+            unacked = list(sub.inflight) + list(sub.outbox)
+            sub.inflight.clear()
+            sub.outbox.clear()
+
+        queue = self.outgoing_queues.get(sub.queue_name)
+        if not unacked or queue is None:
+            return
+        for msg in reversed(unacked):
+            queue.requeue(msg)
+        broker_log.info(str(len(unacked)) + ' unacked msgs requeued for ' +
+                        sub.queue_name + '.')
+        if sub.queue_name in self.subscriptions:
+            self._deliver(sub.queue_name)
+
+    def ack(self, sub, n):
+        """ Acks the given Subscription's oldest n msgs in flight and grants it
+            credit for n more msgs, then delivers any waiting msgs.
+        """
+        with self._sub_lock:
+            acked = [sub.inflight.popleft()
+                     for _ in xrange(min(n, len(sub.inflight)))]
+            sub.credit += n
+
+        if self.journal:
+            for msg in acked:
+                self.journal.consumed(msg.journal_seq)
+        self._deliver(sub.queue_name)
+
+    def _deliver(self, queue_name):
+        """ Dequeues waiting msgs from the given queue to its subscribers with
+            credit, round-robin, then pushes them. Pushes are made after
+            releasing the subscriptions lock, so a slow subscriber doesn't
+            stall other requests. A subscription whose push fails is removed.
+        """
+        pending = []  # Subscriptions given msgs to push
+        with self._sub_lock:
+            subs = self.subscriptions.get(queue_name)
+            queue = self.outgoing_queues.get(queue_name)
+            while subs and queue:
+                ready = [i for i, s in enumerate(subs) if s.credit > 0]
+                if not ready:
+                    break
+
+                try:
+                    msg = queue.get()
+                except Queue.Empty:
+                    break
+
+                # Next subscriber with credit, rotated to the back of the list
+                sub = subs.pop(ready[0])
+                subs.append(sub)
+                sub.credit -= 1
+                sub.outbox.append(msg)
+                if sub not in pending:
+                    pending.append(sub)
+
+        for sub in pending:
+            self._push(sub)
+
+    def _push(self, sub):
+        """ Pushes the given Subscription's outbox, in order, moving each msg
+            in flight. Unsubscribes it if a push fails.
+        """
+        with sub.push_lock:
+            while True:
+                with self._sub_lock:
+                    if not sub.outbox:
+                        return
+                    msg = sub.outbox.popleft()
+                    sub.inflight.append(msg)
+
+                try:
+                    sub.push(msg.raw_msg)
+                except:
+                    broker_log.warn('Push to subscriber of ' +
+                                    sub.queue_name + ' failed.')
+                    self.unsubscribe(sub)
+                    return
+
+                log_str = 'Msg pushed to subscriber of ' + sub.queue_name + '.'
+                broker_log.info(log_str)
+
+    def expire_msgs(self):
+        """ Evicts all queued msgs whose expire time has passed, in O(log n)
+            per msg. Msgs already dequeued are simply dropped from the heap.
+            Returns the number of msgs evicted.
+        """
+        now = time()
+        evicted = 0
+        with self._expiry_lock:
+            while self._expiry and self._expiry[0][0] <= now:
+                _, _, queue_name, msg = heappop(self._expiry)
+                queue = self.outgoing_queues.get(queue_name)
+                if queue and queue.expire(msg):
+                    evicted += 1
+
+        if evicted:
+            broker_log.info('Expired ' + str(evicted) + ' msgs.')
+        return evicted
+
+    def sample(self):
+        """ Notes each queue's enqueued and dequeued counts, for rates. Should
+            be called every second.
+        """
+        counts = dict((addr, (q.stats.enqueued, q.stats.dequeued))
+                      for addr, q in self.outgoing_queues.items())
+        self._samples.append((time(), counts))
+
+    def stats(self):
+        """ Returns the broker's stats as a dict of the form:
+                { 'time': (float) Unix time of stats,
+                  'uptime': (float) Secs since started,
+                  'failed': (int) Malformed or oversize msgs received,
+                  'duplicates': (int) Duplicate msgs received, and dropped,
+                  'max_depth': (int) Max msgs per queue (0 = unlimited),
+                  'queues': { ADDRESS: {
+                        'depth': (int) Msgs waiting,
+                        'subscribers': (int) Subscriptions to the queue,
+                        'enqueued', 'dequeued', 'rejected', 'dropped',
+                        'expired': (int) Msg counts, see QueueStats,
+                        'enqueue_rate', 'dequeue_rate': (float) Msgs per sec,
+                            over the last STATS_RATE_WINDOW secs,
+                        'wait_p50', 'wait_p90', 'wait_p99': (float)
+                            Time-in-queue percentiles, in ms, or None } } }
+        """
+        now = time()
+        then, prev_counts = self._samples[0] if self._samples else (now, {})
+        elapsed = now - then
+
+        queues = {}
+        for addr, queue in self.outgoing_queues.items():
+            qstats = queue.stats
+            prev_enq, prev_deq = prev_counts.get(addr, (0, 0))
+            stats = {'depth': len(queue),
+                     'subscribers': len(self.subscriptions.get(addr, ())),
+                     'enqueued': qstats.enqueued,
+                     'dequeued': qstats.dequeued,
+                     'rejected': qstats.rejected,
+                     'dropped': qstats.dropped,
+                     'expired': qstats.expired,
+                     'enqueue_rate': 0.0,
+                     'dequeue_rate': 0.0}
+            if elapsed > 0:
+                stats['enqueue_rate'] = (qstats.enqueued - prev_enq) / elapsed
+                stats['dequeue_rate'] = (qstats.dequeued - prev_deq) / elapsed
+            for pct in STATS_PERCENTILES:
+                wait = qstats.wait_times.percentile(pct)
+                stats['wait_p' + str(pct)] = wait * 1000 if wait else wait
+            queues[addr] = stats
+
+        return {'time': now,
+                'uptime': now - self.started,
+                'failed': self.failed,
+                'duplicates': self.duplicates,
+                'max_depth': self.queue_args[1],
+                'queues': queues}
+
+
+class Listener(Thread):
+    """ Watches for incoming TCP/IP connections on the given port and serves
+        each in its own thread. Each connection may carry any number of
+        requests, as MsgSocket frames, and is closed by the client or after
+        IDLE_TIMEOUT seconds of inactivity.
+        Child classes implement handle_request().
     """
-    def __init__(self, outgoing_queues):
+    def __init__(self, core, port):
+        """ core: The broker's BrokerCore
+            port: The port to listen on
+        """
         Thread.__init__(self)
-        self.outgoing_queues = outgoing_queues
+        self.core = core
+        self.port = port
 
     def run(self):
-        # Init listener
+        # Init TCP/IP listener
         sock = socket.socket()
-        sock.bind((BROKER, FETCH_PORT))
-        sock.listen(1)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.bind((BROKER, self.port))
+        sock.listen(socket.SOMAXCONN)
 
         while True:
-            # Block until timeout or a send request is received
+            # Block until timeout or a connection is received
             try:
                 conn, client = sock.accept()
             except:
                 continue
 
-            # Process the request
-            log_str = 'Fetch request from ' + str(client[0]) + ' '
+            conn_thread = Thread(target=self._serve, args=(conn, client))
+            conn_thread.daemon = True
+            conn_thread.start()
+
+        # Do cleanup
+        sock.close()
+
+    def _serve(self, conn, client):
+        """ Serves requests from the given connection until it closes or idles
+            out. Intended to run as a thread.
+        """
+        msock = MsgSocket(conn)
+        last_activity = time()
+
+        while True:
             try:
-                queue_name = conn.recv(MAX_MSG_SIZE).decode()
-                log_str += 'for ' + queue_name + ' gave: '
+                request = msock.recv_frame()
+            except socket.timeout:
+                if time() - last_activity > IDLE_TIMEOUT and \
+                        not msock.subscription:
+                    break
+                continue
+            except:
+                break
 
-                msg = None
-                try:
-                    msg = self.outgoing_queues[queue_name].get(timeout=.5)
-                except:
-                    log_str += 'Queue empty.'
-                    conn.send('EMPTY'.encode())
+            if request is None:
+                break  # Client closed the connection
 
-                if msg:
-                    conn.send(msg.raw_msg.encode('hex'))  # Send msg
-                    log_str += 'Msg served.'
+            try:
+                response = self.handle_request(request, msock, client)
+                if response is not None:
+                    msock.send_frame(response)
+            except:
+                break
+            last_activity = time()
 
-                broker_log.info(log_str)
-                conn.close()
+        self.handle_close(msock)
+        msock.close()
+
+    def handle_request(self, request, msock, client):
+        """ Returns the response to the given request (a frame) received over
+            the given MsgSocket from the given client, a (host, port) tuple,
+            or None if no response is to be sent.
+        """
+        raise NotImplementedError
+
+    def handle_close(self, msock):
+        """ Cleans up after the given MsgSocket, which is about to be closed.
+        """
+        if msock.subscription:
+            self.core.unsubscribe(msock.subscription)
+
+
+class Receiver(Listener):
+    """ Watches for incoming EMP messages over TCP/IP on the interface and port 
+        specified and adds them to the broker's outgoing queues.
+    """
+    def __init__(self, core, port=SEND_PORT):
+        Listener.__init__(self, core, port)
+
+    def handle_request(self, request, msock, client):
+        """ Enqueues the msg in request, responding with either OK or FAIL.
+        """
+        return self.core.handle_send(request, msock.binary, client)
+
+
+class MsgServer(Listener):
+    """ Watches for incoming TCP/IP msg requests (ex, A loco or the BOS
+        checking its msg queue) and serves them from the broker's outgoing
+        queues by address.
+        After a msg is served it's removed from the queue.
+    """
+    def __init__(self, core, port=FETCH_PORT):
+        Listener.__init__(self, core, port)
+
+    def handle_request(self, request, msock, client):
+        """ Responds with the next msg in the queue named by request, or EMPTY
+            if the queue is empty, without waiting for one.
+            A request of the form 'SUB queue_name window' subscribes the
+            connection to the queue. Msgs are then pushed to it as they are
+            enqueued and its only requests are of the form 'ACK n'.
+        """
+        if msock.subscription:
+            n = self.core.parse_ack(request)
+            if n is not None:
+                self.core.ack(msock.subscription, n)
+            return None
+
+        if not request.startswith('SUB '):
+            return self.core.handle_fetch(request, msock.binary, client)
+
+        parsed = self.core.parse_subscribe(request)
+        if not parsed:
+            return 'FAIL'
+        queue_name, window = parsed
+
+        send_lock = Lock()  # Pushes may come from any connection's thread
+
+        def push(raw_msg):
+            with send_lock:
+                msock.send_frame(msg_to_frame(raw_msg, msock.binary))
+
+        msock.subscription = self.core.subscribe(queue_name, push, client)
+        with send_lock:
+            msock.send_frame('OK')
+        self.core.ack(msock.subscription, window)
+        return None
+
+
+class Router(Listener):
+    """ A sharded broker's front end. Serves the broker's send or fetch port,
+        forwarding each request to the shard owning the queue in question,
+        over pooled connections, and relaying its response. STATS requests
+        are answered with the stats of all shards combined, and SHARDS
+        requests with 'SHARDS num_shards shard_base_port'.
+        A SUB request gets its own connection to the shard, over which pushed
+        msgs and the subscriber's ACKs are relayed.
+    """
+    def __init__(self, port, num_shards, sending, base_port=SHARD_BASE_PORT):
+        """ port        : The port to listen on
+            num_shards  : (int) The number of broker shards
+            sending     : (bool) True if port is a send port, else fetch port
+            base_port   : The shards' base port, see shard_ports()
+        """
+        Listener.__init__(self, None, port)
+        self.num_shards = num_shards
+        self.sending = sending
+        self.base_port = base_port
+        self.started = time()
+
+    def _pool(self, shard, binary):
+        """ Returns the ConnPool to the given shard's send or fetch port, of
+            the given framing.
+        """
+        port = shard_ports(shard, self.base_port)[0 if self.sending else 1]
+        framing = FRAMING_BINARY if binary else FRAMING_HEX
+        return ConnPool.get_pool((BROKER, port), framing, ROUTER_POOL_SIZE)
+
+    def handle_request(self, request, msock, client):
+        """ Forwards the given request to its shard and returns the response.
+        """
+        if msock.subscription:
+            msock.subscription.send_frame(request)  # ACK, to the shard
+            return None
+
+        if self.sending:
+            try:
+                raw_msg = frame_to_msg(request, msock.binary)
+                queue_name = Message._unpack(raw_msg)[3]
+            except Exception as e:
+                broker_log.error('Incoming msg from ' + str(client[0]) +
+                                 ' not routable due to ' + str(e))
+                return 'FAIL'
+        elif request == 'STATS':
+            return json.dumps(self.stats(msock.binary))
+        elif request == 'SHARDS':
+            return ' '.join(('SHARDS', str(self.num_shards),
+                             str(self.base_port)))
+        else:
+            parts = request.split(' ')
+            queue_name = parts[1] if len(parts) > 1 else request
+            if parts[0] == 'SUB':
+                return self._subscribe(request, queue_name, msock)
+
+        pool = self._pool(shard_of(queue_name, self.num_shards), msock.binary)
+        try:
+            return pool.request(request)
+        except Exception as e:
+            broker_log.error('Shard request failed: ' + str(e))
+            return 'FAIL'
+
+    def _subscribe(self, request, queue_name, msock):
+        """ Subscribes to the given queue at its shard, over a new connection,
+            relaying the shard's pushes to msock from a new thread.
+        """
+        shard = shard_of(queue_name, self.num_shards)
+        port = shard_ports(shard, self.base_port)[1]
+        framing = FRAMING_BINARY if msock.binary else FRAMING_HEX
+        try:
+            sock = socket.create_connection((BROKER, port))
+            upstream = MsgSocket(sock, framing)
+            upstream.send_frame(request)
+            resp = upstream.recv_frame()
+        except Exception as e:
+            broker_log.error('Shard subscribe failed: ' + str(e))
+            return 'FAIL'
+
+        if resp != 'OK':
+            upstream.close()
+            return resp or 'FAIL'
+
+        msock.send_frame('OK')
+        msock.subscription = upstream
+        relay = Thread(target=self._relay, args=(upstream, msock))
+        relay.daemon = True
+        relay.start()
+        return None
+
+    @staticmethod
+    def _relay(upstream, msock):
+        """ Relays frames pushed over upstream to msock until either closes.
+            Intended to run as a thread.
+        """
+        while True:
+            try:
+                frame = upstream.recv_frame()
+            except socket.timeout:
+                continue
+            except:
+                break
+            if frame is None:
+                break
+            try:
+                msock.send_frame(frame)
             except:
+                break
+
+        upstream.close()
+        msock.close()
+
+    def handle_close(self, msock):
+        """ Closes the given MsgSocket's shard subscription, if any.
+        """
+        if msock.subscription:
+            try:
+                # Shut down first, so the relay thread's recv returns. Else
+                # close() would leave the socket open until it times out.
+                msock.subscription.sock.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+            msock.subscription.close()
+
+    def stats(self, binary):
+        """ Returns the stats of all shards combined, in the form given by
+            BrokerCore.stats(). Unreachable shards are omitted.
+        """
+        stats = {'time': time(),
+                 'uptime': time() - self.started,
+                 'failed': 0,
+                 'duplicates': 0,
+                 'max_depth': config.max_queue_depth,
+                 'queues': {}}
+        for shard in range(self.num_shards):
+            try:
+                shard_stats = json.loads(self._pool(shard, binary)
+                                         .request('STATS'))
+            except Exception as e:
+                broker_log.error('Shard stats failed: ' + str(e))
                 continue
+            stats['failed'] += shard_stats['failed']
+            stats['duplicates'] += shard_stats.get('duplicates', 0)
+            stats['queues'].update(shard_stats['queues'])
 
-        # Do cleanup
-        sock.close()
+        return stats
+
+
+class ShmServer(Thread):
+    """ Serves the requests of broker clients over the given ShmTransport, in
+        order. If given an EventServer, requests are handled on its event loop,
+        as handling a send may push the msg to its subscribers' connections,
+        which only the loop may touch. Otherwise they're handled here.
+    """
+    def __init__(self, core, transport, server=None):
+        """ core: The broker's BrokerCore
+            transport: The ShmTransport to serve
+            server: The broker's EventServer, if any
+        """
+        Thread.__init__(self)
+        self.daemon = True
+        self.core = core
+        self.transport = transport
+        self.server = server
+
+    def run(self):
+        while True:
+            request = self.transport.requests.get()
+            if self.server:
+                self.server.call_soon(lambda r=request: self._handle(r))
+            else:
+                self._handle(request)
+
+    def _handle(self, request):
+        """ Handles the given request and responds to it.
+        """
+        chan, kind, seq = SHM_REQ.unpack_from(request)
+        frame = request[SHM_REQ.size:]
+        client = ('shm', chan)
+
+        if kind == SHM_SEND:
+            resp = self.core.handle_send(frame, True, client)
+        elif frame.startswith('SUB '):
+            resp = 'FAIL'  # Subscriptions require a connection
+        else:
+            max_size = self.transport.max_response
+            resp = self.core.handle_fetch(frame, True, client,
+                                          max_size=max_size)
+        try:
+            self.transport.respond(chan, seq, resp)
+        except Queue.Full:
+            broker_log.warn('Shm response dropped: Channel ' + str(chan) +
+                            ' full.')
+
+
+class EventConn(object):
+    """ A non-blocking client connection, as serviced by EventServer. Buffers
+        incoming data until complete frames (in the framing detected from the
+        first bytes received) are available, and outgoing data until the
+        socket is writable.
+    """
+    def __init__(self, sock, client, port):
+        """ self.sock   : (socket) The connection's non-blocking socket
+            self.fd     : (int) The socket's file descriptor
+            self.client : (tuple) The client's (host, port)
+            self.port   : (int) The broker port the client connected to
+            self.binary : (bool) True iff binary framing, None until detected
+            self.inbuf  : (bytearray) Received data not yet consumed
+            self.outbuf : (bytearray) Data not yet sent
+            self.last_activity: (float) Time of last data received
+            self.polling_out: (bool) True while polled for writability
+            self.subscription: (Subscription) The subscription this connection
+                          delivers, if any
+        """
+        self.sock = sock
+        self.fd = sock.fileno()
+        self.client = client
+        self.port = port
+        self.binary = None
+        self.inbuf = bytearray()
+        self.outbuf = bytearray()
+        self.last_activity = time()
+        self.polling_out = False
+        self.subscription = None
+
+    def frames(self):
+        """ Removes each complete frame from inbuf and returns them as a list.
+        """
+        buff = self.inbuf
+        frames = []
+        pos = 0
+
+        if self.binary is None and buff:
+            if buff[0] != ord(FRAME_PREAMBLE[0]):
+                self.binary = False
+            elif len(buff) >= len(FRAME_PREAMBLE):
+                if buff[:len(FRAME_PREAMBLE)] != FRAME_PREAMBLE:
+                    raise socket.error('Unsupported binary framing version.')
+                self.binary = True
+                pos = len(FRAME_PREAMBLE)
+
+        if self.binary:
+            while len(buff) - pos >= FRAME_LEN.size:
+                size = FRAME_LEN.unpack_from(buff, pos)[0]
+                if size > MAX_FRAME_SIZE:
+                    raise socket.error('Frame exceeds MAX_FRAME_SIZE.')
+                end = pos + FRAME_LEN.size + size
+                if end > len(buff):
+                    break
+                frames.append(str(buff[pos + FRAME_LEN.size:end]))
+                pos = end
+        elif self.binary is False:
+            while True:
+                end = buff.find('\n', pos)
+                if end < 0:
+                    break
+                frames.append(str(buff[pos:end]))
+                pos = end + 1
+            if len(buff) - pos > MAX_HEX_FRAME_SIZE:
+                raise socket.error('Frame exceeds MAX_HEX_FRAME_SIZE.')
+
+        if pos:
+            del buff[:pos]
+        return frames
+
+    def queue_frame(self, frame):
+        """ Appends the given frame to outbuf, in the connection's framing.
+        """
+        if self.binary:
+            self.outbuf += FRAME_LEN.pack(len(frame))
+            self.outbuf += frame
+        else:
+            self.outbuf += frame
+            self.outbuf += '\n'
+
+
+class EventServer(Thread):
+    """ Services all broker client connections, on both the send and fetch
+        ports, from a single event loop (over epoll, or poll where epoll is
+        unavailable). No socket operation or queue access ever blocks, so any
+        number of clients are serviced concurrently.
+        Fetches of an empty queue are responded to with EMPTY immediately.
+        Subscribed connections are pushed msgs as they are enqueued.
+        Other threads may run code on the loop via call_soon().
+    """
+    def __init__(self, core, send_port=SEND_PORT, fetch_port=FETCH_PORT):
+        """ core: The broker's BrokerCore
+            send_port, fetch_port: The ports to listen on
+        """
+        Thread.__init__(self)
+        self.core = core
+        self.send_port = send_port
+        self.fetch_port = fetch_port
+        self._listeners = {}  # Listening sockets, by fd: { FD: (sock, port) }
+        self._conns = {}  # Client connections, by fd: { FD: EventConn }
+        self._calls = deque()  # Callables to run on the loop, see call_soon()
+        self._poller = None
+
+        # Wakes the loop from poll when calls are added
+        self._wakeup, self._waker = socket.socketpair()
+        self._wakeup.setblocking(0)
+        self._waker.setblocking(0)
+
+        # Use epoll where available. Event flags are the same for both.
+        if hasattr(select, 'epoll'):
+            self._poller = select.epoll()
+            self._poll_scale = 1  # epoll timeouts are in seconds
+        else:
+            self._poller = select.poll()
+            self._poll_scale = 1000  # poll timeouts are in ms
+
+    def run(self):
+        # Init non-blocking TCP/IP listeners
+        for port in (self.send_port, self.fetch_port):
+            sock = socket.socket()
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            sock.bind((BROKER, port))
+            sock.listen(socket.SOMAXCONN)
+            sock.setblocking(0)
+            self._listeners[sock.fileno()] = (sock, port)
+            self._poller.register(sock.fileno(), select.POLLIN)
+        self._poller.register(self._wakeup.fileno(), select.POLLIN)
+
+        last_sweep = time()
+        while True:
+            try:
+                events = self._poller.poll(self._poll_scale)  # 1 sec timeout
+            except (IOError, select.error):
+                continue  # Interrupted
+
+            for fd, event in events:
+                if fd in self._listeners:
+                    self._accept(*self._listeners[fd])
+                    continue
+                if fd == self._wakeup.fileno():
+                    self._drain_wakeup()
+                    continue
+
+                conn = self._conns.get(fd)
+                if not conn:
+                    continue
+                if event & (select.POLLERR | select.POLLHUP | select.POLLNVAL):
+                    # Handle any requests received before the hangup first
+                    if event & select.POLLIN:
+                        self._read(conn)
+                    if fd in self._conns:
+                        self._close(conn)
+                    continue
+                if event & select.POLLIN:
+                    self._read(conn)
+                if event & select.POLLOUT and fd in self._conns:
+                    self._write(conn)
+
+            while self._calls:
+                try:
+                    self._calls.popleft()()
+                except Exception as e:
+                    broker_log.error('Event loop call failed: ' + str(e))
+
+            # Close idle connections, once per second
+            if time() - last_sweep > 1:
+                last_sweep = time()
+                for conn in self._conns.values():
+                    if last_sweep - conn.last_activity > IDLE_TIMEOUT and \
+                            not conn.subscription:
+                        self._close(conn)
+
+    def call_soon(self, func):
+        """ Has the event loop call the given function, with no args, on its
+            next iteration. Thread-safe.
+        """
+        self._calls.append(func)
+        try:
+            self._waker.send('x')
+        except socket.error:
+            pass  # Buffer full, so a wakeup is already pending
+
+    def _drain_wakeup(self):
+        """ Reads all pending wakeups, see call_soon().
+        """
+        while True:
+            try:
+                if not self._wakeup.recv(4096):
+                    return
+            except socket.error:
+                return
+
+    def _accept(self, sock, port):
+        """ Accepts all pending connections on the given listening socket.
+        """
+        while True:
+            try:
+                conn_sock, client = sock.accept()
+            except socket.error:
+                return  # No more pending connections
+
+            conn_sock.setblocking(0)
+            conn_sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            conn = EventConn(conn_sock, client, port)
+            self._conns[conn.fd] = conn
+            self._poller.register(conn.fd, select.POLLIN)
+
+    def _read(self, conn):
+        """ Reads all available data from the given connection and responds to
+            each complete request received.
+        """
+        closed = False  # True once the client has closed its end
+        while True:
+            try:
+                data = conn.sock.recv(65536)
+            except socket.error as e:
+                if e.args[0] not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    closed = True
+                break
+
+            if not data:
+                closed = True  # Client closed the connection
+                break
+            conn.inbuf += data
+            if len(data) < 65536:
+                break
+
+        conn.last_activity = time()
+        try:
+            frames = conn.frames()
+        except socket.error:
+            self._close(conn)
+            return
+
+        for frame in frames:
+            if conn.port == self.send_port:
+                resp = self.core.handle_send(frame, conn.binary, conn.client)
+            elif conn.subscription or frame.startswith('SUB '):
+                resp = self._handle_subscribe(conn, frame)
+            else:
+                resp = self.core.handle_fetch(frame, conn.binary, conn.client)
+            if resp is not None:
+                conn.queue_frame(resp)
+
+        # Requests received before a close are handled, but not responded to
+        if closed:
+            if conn.fd in self._conns:
+                self._close(conn)
+        elif conn.outbuf and conn.fd in self._conns:
+            self._write(conn)
+
+    def _handle_subscribe(self, conn, request):
+        """ Handles the given subscribe or ACK request from the given
+            connection. Returns the response, or None if there is none.
+        """
+        if conn.subscription:
+            n = self.core.parse_ack(request)
+            if n is not None:
+                self.core.ack(conn.subscription, n)
+            return None
+
+        parsed = self.core.parse_subscribe(request)
+        if not parsed:
+            return 'FAIL'
+        queue_name, window = parsed
+
+        def push(raw_msg):
+            if conn.fd not in self._conns:
+                raise socket.error('Subscriber connection closed.')
+            conn.queue_frame(msg_to_frame(raw_msg, conn.binary))
+            self._write(conn)
+
+        conn.subscription = self.core.subscribe(queue_name, push, conn.client)
+        conn.queue_frame('OK')
+        self.core.ack(conn.subscription, window)
+        return None
+
+    def _write(self, conn):
+        """ Sends as much of the given connection's outbuf as possible, then
+            polls for writability iff any remains.
+        """
+        try:
+            sent = conn.sock.send(conn.outbuf)
+        except socket.error as e:
+            if e.args[0] not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                self._close(conn)
+                return
+            sent = 0
+        del conn.outbuf[:sent]
+
+        if bool(conn.outbuf) != conn.polling_out:
+            conn.polling_out = not conn.polling_out
+            events = select.POLLIN
+            if conn.polling_out:
+                events |= select.POLLOUT
+            self._poller.modify(conn.fd, events)
+
+    def _close(self, conn):
+        """ Closes the given connection, ending its subscription if any.
+        """
+        if conn.subscription:
+            self.core.unsubscribe(conn.subscription)
+        self._conns.pop(conn.fd, None)
+        try:
+            self._poller.unregister(conn.fd)
+        except:
+            pass
+        conn.sock.close()
 
 
 class MsgBroker(Process):
@@ -445,19 +3811,104 @@ class MsgBroker(Process):
     Msgs are received by the broker via TCP/IP and enqued for receipt.
     Recipients request msgs from broker via TCP/IP by address (i.e queue name).
     After a fetch, the msg is removed from the queue.
+    Clients are serviced by the network engine given by BROKER_ENGINE - either
+    'event' (EventServer) or 'threaded' (Receiver and MsgServer).
+    If journal, queued msgs are journaled to journal_dir and restored on start.
+    If shards > 1 (see BROKER_SHARDS), queues are instead partitioned by
+    address (see shard_of) across that many child MsgBrokers, one per process,
+    each on the ports given by shard_ports(), and requests to the broker's own
+    ports are routed to them (see Router).
+    If given a ShmTransport, clients are also served over it (unsharded only).
     """
-    def __init__(self): 
+    def __init__(self,
+                 engine=BROKER_ENGINE,
+                 journal=JOURNAL,
+                 shards=BROKER_SHARDS,
+                 send_port=SEND_PORT,
+                 fetch_port=FETCH_PORT,
+                 journal_dir=JOURNAL_DIR,
+                 transport=None,
+                 shard_base_port=SHARD_BASE_PORT):
+        if transport and shards > 1:
+            raise ValueError('Shared memory transport requires an unsharded ' +
+                             'broker.')
+
         Process.__init__(self)
-        self.outgoing_queues = {}  # Outbound msg queues: { ADDRESS: Queue }
+        self.engine = engine
+        self.journal = journal
+        self.shards = shards
+        self.send_port = send_port
+        self.fetch_port = fetch_port
+        self.journal_dir = journal_dir
+        self.transport = transport
+        self.shard_base_port = shard_base_port
+        self.core = BrokerCore()  # Outbound msg queues and request handling
+        self._workers = []  # The shards' MsgBrokers, if sharded
+
+    def start(self):
+        """ Starts the broker's process, after those of its shards, if any.
+            The shards are started from here, rather than by the broker's
+            process, so that a sharded MsgBroker may be daemonic.
+        """
+        for shard in range(self.shards if self.shards > 1 else 0):
+            send_port, fetch_port = shard_ports(shard, self.shard_base_port)
+            journal_dir = os.path.join(self.journal_dir, 'shard' + str(shard))
+            worker = MsgBroker(self.engine, self.journal, 1,
+                               send_port, fetch_port, journal_dir)
+            worker.daemon = True
+            worker.start()
+            self._workers.append(worker)
+
+        Process.start(self)
+
+    def terminate(self):
+        """ Terminates the broker's process and those of its shards, if any.
+        """
+        Process.terminate(self)
+        for worker in self._workers:
+            worker.terminate()
+            worker.join()
+        self._workers = []
 
-    def run(self):        
-        Receiver(self.outgoing_queues).start()
-        MsgServer(self.outgoing_queues).start()
-        broker_log.info('BOS Started.')
+    def run(self):
+        config.watch(broker_log)
+        config.add_listener(self.core.retune)
+        if self.shards > 1:
+            return self._run_router()
+
+        # Journal is opened here, in the broker's process, so its mmaps are too
+        if self.journal:
+            self.core.attach_journal(MsgJournal(self.journal_dir))
+
+        server = None
+        if self.engine == 'event':
+            server = EventServer(self.core, self.send_port, self.fetch_port)
+            server.start()
+        else:
+            Receiver(self.core, self.send_port).start()
+            MsgServer(self.core, self.fetch_port).start()
+        if self.transport:
+            ShmServer(self.core, self.transport, server).start()
+        broker_log.info('Broker Started (' + self.engine + ' engine, ' +
+                        'port ' + str(self.send_port) + ').')
+
+        # Stay alive, evicting expired msgs and sampling stats every second
+        while True:
+            sleep(1)
+            self.core.expire_msgs()
+            self.core.sample()
+
+    def _run_router(self):
+        """ Routes requests to the broker's ports to its shards, started by
+            start(), until terminated.
+        """
+        Router(self.send_port, self.shards, True, self.shard_base_port).start()
+        Router(self.fetch_port, self.shards, False,
+               self.shard_base_port).start()
+        broker_log.info('Broker Started (' + str(self.shards) + ' shards).')
 
-        # Stay alive (there is likely a better way to do this)
         while True:
-            sleep(10)
+            sleep(config.refresh_time)
 
 
 # debug:
@@ -4,83 +4,74 @@
     Author: Dustin Fast, 2018
 """
 
+import os
+import mmap
 import Queue
+import random
 import multiprocessing
-from time import sleep
+from time import sleep, time
+from heapq import heappush, heappop
+from itertools import count
 from json import loads
+from struct import Struct
 from threading import Thread
 from datetime import datetime
-from ConfigParser import RawConfigParser
-from math import degrees, radians, sin, cos, atan2
+from bisect import bisect_left
 
-from lib_app import track_log
-from lib_app import REFRESH_TIME
-from lib_messaging import Connection, get_6000_msg
-from lib_messaging import MSG_INTERVAL, LOCO_EMP_PREFIX
+from lib_app import track_log, dep_install
+from lib_app import config
+from lib_messaging import Client, Connection, McastSender, get_6000_msg
+from lib_messaging import LOCO_EMP_PREFIX, STATUS_MCAST
+
+# Attempt to import 3rd party modules, prompting for install on fail.
+try:
+    import numpy
+except:
+    dep_install('numpy')
 
 # Import conf data
-config = RawConfigParser()
-config.read('config.dat')
 TRACK_RAILS = config.get('track', 'track_rails')
 TRACK_LOCOS = config.get('track', 'track_locos')
 TRACK_BASES = config.get('track', 'track_bases')
+TRACK_CACHE = config.get('track', 'track_cache')
 SPEED_UNITS = config.get('track', 'speed_units')
 CONN_TIMEOUT = int(config.get('track', 'component_timeout'))
+DIRECTIONS = {'increasing': 1, 'decreasing': -1}  # Loco direction signs
+DIRECTIONS_REV = {1: 'increasing', -1: 'decreasing'}
+FLEET_ID_BASE = 90000  # Synthetic loco IDs are FLEET_ID_BASE + n
+FLEET_SEED = 2018  # Random seed, so fleets are the same from run to run
+
+# Compiled track cache file (see TrackCache). A TRACK_CACHE_HEAD (magic,
+# version, base ID width, rails file mtime and size, bases file mtime and
+# size, and milepost, base and coverage entry counts) followed by the
+# sections of TRACK_CACHE_SECTIONS, in order, each 8 byte aligned.
+TRACK_CACHE_HEAD = Struct('<4sHHdQdQIII')
+TRACK_CACHE_MAGIC = 'PTCT'
+TRACK_CACHE_VERSION = 2
+TRACK_CACHE_SECTIONS = ('markers', 'lats', 'longs', 'bases',
+                        'cov_index', 'cov_bases')
 
 
 ############################
 # Top-Level/Parent Classes #
 ############################
 
-class DeviceSim(object):
-    """ A collection of threads representing a device simulation. Exposes start
-        and stop interfaces.
-        Assumes each thread implements self.running (a bool) as a poison pill.
-    """
-    def __init__(self, device, targets=[]):
-        self.running = False  # Thread kill signal
-        self._thread_targets = targets
-        self._threads = []
-        self.device = device
-        self.label = device.name
-        self.time_icand = 1  # (float) Time speed up/slow down
-        
-    def start(self):
-        """ Starts the simulation threads. 
-        """
-        if not self.running:
-            self.running = True
-            self._threads = [Thread(target=t, args=[self.device]) 
-                             for t in self._thread_targets]
-            [t.start() for t in self._threads]
-
-    def stop(self):
-        """ Stops the simulation threads.
-        """
-        if self.running:
-            print('* Stopped sim thread ' + self.label)
-            self.running = False  # Thread poison pill
-            [t.join(timeout=REFRESH_TIME) for t in self._threads]
-
-
 class TrackDevice(object):
     """ The template class for on-track, communication-enabled devices. I.e., 
-        Locos, Bases, and Waysides. Each devices contains a type-specific,
-        real-time activity and communications simulation for testing and
-        demonstration purposes.
+        Locos, Bases, and Waysides. Their activity and communications are
+        simulated for testing and demonstration purposes - locos' by a
+        FleetEngine.
     """
     def __init__(self, ID, device_type, location=None):
         """ self.ID         : (str) The Device's unique identifier
             self.coords   : (Location) The devices location, as a Location
             self.conns      : (dict) Connection objects - { ID: Connection }
-            self.sim        : The device's simulation. Start w/self.sim.start()
         """
         self.ID = ID
         self.devtype = device_type
         self.name = device_type + ' ' + self.ID
         self.coords = location
         self.conns = {}
-        self.sim = None
 
     def __str__(self):
         """ Returns a string representation of the device """
@@ -108,8 +99,8 @@ class TrackDevice(object):
 #################
 
 class Loco(TrackDevice):
-    """ An abstration of a locomotive. Includes a realtime simulation of its 
-        activity/communications.
+    """ An abstration of a locomotive. Its activity/communications are
+        simulated, with the rest of the fleet's, by a FleetEngine.
     """
     def __init__(self, ID, track):
         """ self.ID         : (str) The Locomotives's unique identifier
@@ -135,10 +126,6 @@ class Loco(TrackDevice):
 
         self.conns = {'Radio 1': Connection('Radio 1', timeout=CONN_TIMEOUT),
                       'Radio 2': Connection('Radio 2', timeout=CONN_TIMEOUT)}
-
-        self.sim = DeviceSim(self, 
-                             [TrackSim.loco_movement,
-                              TrackSim.loco_messaging])
         
     def update(self,
                speed=None,
@@ -167,7 +154,7 @@ class Loco(TrackDevice):
             self.bpp = bpp
         if bases is not None:
             if not bases:
-                [c.disconnect for c in self.conns]
+                self.disconnect()
                 return
             try:
                 for conn_label, base_id in bases.iteritems():
@@ -245,99 +232,417 @@ class TrackSwitch(TrackDevice):
 ##############################
 
 
-class Track(object):
-    """ A representation of the track, including its locations and radio base 
-        stations (contains lists/dicts of these objects in convenient forms).
-    
-        self.locos = A dict of locootives, by loco ID
-            Format: { LOCOID: LOCO_OBJECT }
-        self.bases = A dict of radio base stations, by base ID
-            Format: { BASEID: BASE_OBJECT }
-        self.mileposts = A dict of all track mileposts, by marker number
-            Format: { MP: LOCATIONOBJECT }
-        self.mileposts_sorted = A list of all track mileposts, sorted by marker
-            Format: [ LOCATIONOBJECT_1, ... , LOCATIONOBJECT_N ]
-        self.marker_linear = Numerical milepost markers in ascending order
-            Format: [ MP_1, ... , MP_n ], where MP1 < MPn
-        self.marker_linear_rev = Numerical milepost markers in descending order
-            Format: [ MP_n, ... , MP_1], where MP1 < MPn
-        Note: BASEID/LOCOD = strings, MP = floats
+class CoverageIndex(object):
+    """ An index of (closed) coverage intervals, such as those of base
+        stations, answering which intervals cover a given marker by binary
+        search, in O(log n + k) for k covering intervals.
+
+        The sorted, unique interval boundaries divide the track into slots:
+        slot 2j + 1 is the boundary bounds[j] itself and slot 2j is the gap
+        before it (slot 2m, for m bounds, being the gap after the last). No
+        interval starts or ends within a slot, so each slot's covering
+        intervals are precomputed.
     """
+    def __init__(self, intervals, items=None):
+        """ intervals   : (list) Intervals, as (start, end) tuples
+            items       : (list) The item of each interval, returned by
+                          queries. If None, their indexes are returned.
+            self.bounds = (list) Interval boundaries, ascending
+            self.slots  = (list) The covering items of each slot, as a tuple
+        """
+        if items is None:
+            items = range(len(intervals))
+
+        self.bounds = sorted(set(b for i in intervals for b in i))
+        self._bound_array = numpy.array(self.bounds, float)
+
+        slots = [[] for _ in xrange(len(self.bounds) * 2 + 1)]
+        for (start, end), item in zip(intervals, items):
+            first = 2 * bisect_left(self.bounds, start) + 1
+            last = 2 * bisect_left(self.bounds, end) + 1
+            for slot in xrange(first, last + 1):
+                slots[slot].append(item)
+        self.slots = [tuple(s) for s in slots]
+
+    def covering(self, marker):
+        """ Returns a tuple of the items of the intervals covering the given
+            marker, in the order given.
+        """
+        j = bisect_left(self.bounds, marker)
+        exact = j < len(self.bounds) and self.bounds[j] == marker
+        return self.slots[2 * j + exact]
 
+    def covering_many(self, markers):
+        """ The batch form of covering(). Given an array-like of markers,
+            returns a list of the tuple covering each.
+        """
+        bounds = self._bound_array
+        markers = numpy.asarray(markers, float)
+        slots = self.slots
+        if not len(bounds):
+            return [slots[0]] * len(markers)
+
+        j = numpy.searchsorted(bounds, markers)
+        exact = bounds[numpy.minimum(j, len(bounds) - 1)] == markers
+        return [slots[s] for s in (2 * j + exact).tolist()]
+
+
+class TrackCache(object):
+    """ The track's mileposts and base stations, compiled from their JSON
+        files into a compact binary file that is memory-mapped read-only, so
+        that every process using the track shares one copy of its arrays
+        (through the OS's page cache) rather than each parsing and holding
+        its own. The cache is recompiled whenever it is older than, or was
+        compiled from different versions of, its JSON files.
+
+        self.markers    = Milepost markers, ascending (float64 array)
+        self.lats       = Milepost latitudes, by self.markers index
+        self.longs      = Milepost longitudes, by self.markers index
+        self.bases      = Base stations, in the bases file's order (array of
+                          records: id, cov_start, cov_end, lat, long)
+        self.cov_index  = The self.cov_bases of milepost i are those from
+                          cov_index[i] up to cov_index[i + 1] (uint32 array)
+        self.cov_bases  = Indexes into self.bases of the bases covering each
+                          milepost, ascending, by milepost (uint32 array)
+    """
     def __init__(self,
+                 cache_file=TRACK_CACHE,
                  track_file=TRACK_RAILS,
-                 locos_file=TRACK_LOCOS,
                  bases_file=TRACK_BASES):
-        """ track_file: Track JSON representation
-            locos_file: Locos JSON representation
+        """ cache_file: Compiled track cache file, compiled if stale
+            track_file: Track JSON representation
             bases_file: Base stations JSON representation
         """
-        # On-Track device properties
-        self.locos = {}
-        self.bases = {}
-        self.last_seen = {}     # Last msg recv time, by device:
-                                # { DeviceType: { ID: DateTime } }
+        self._map = None  # The cache file's mmap, backing the arrays
 
-        # Track properties
-        self.mileposts = {}
-        self.mileposts_sorted = []
-        self.marker_linear = []
-        self.marker_linear_rev = []
-        # self.restrictions = {}  # { AUTH_ID: ( START_MILEPOST, END_MILEPOST }
+        if self.is_stale(cache_file, track_file, bases_file):
+            data = self.compile(cache_file, track_file, bases_file)
+        else:
+            with open(cache_file, 'rb') as f:
+                data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            self._map = data
+
+        head = TRACK_CACHE_HEAD.unpack_from(data)
+        for name, (dtype, offset, count) in self._layout(head):
+            arr = numpy.frombuffer(data, dtype, count, offset)
+            setattr(self, name, arr)
 
-        # Populate bases station (self.bases) from base_file
+    @staticmethod
+    def _source_stats(track_file, bases_file):
+        """ Returns the mtime and size of the given JSON files, as they're
+            recorded in the cache's header.
+        """
+        rails = os.stat(track_file)
+        bases = os.stat(bases_file)
+        return rails.st_mtime, rails.st_size, bases.st_mtime, bases.st_size
+
+    @staticmethod
+    def _layout(head):
+        """ Given the cache's unpacked header, returns a list of each section
+            as (name, (numpy dtype, offset, count)), in file order.
+        """
+        id_width = head[2]
+        mp_count, base_count, cov_count = head[7:]
+        base_dtype = numpy.dtype([('id', 'S' + str(id_width)),
+                                  ('cov_start', '<f8'),
+                                  ('cov_end', '<f8'),
+                                  ('lat', '<f8'),
+                                  ('long', '<f8')])
+        sections = {'markers': ('<f8', mp_count),
+                    'lats': ('<f8', mp_count),
+                    'longs': ('<f8', mp_count),
+                    'bases': (base_dtype, base_count),
+                    'cov_index': ('<u4', mp_count + 1),
+                    'cov_bases': ('<u4', cov_count)}
+
+        layout = []
+        offset = TRACK_CACHE_HEAD.size
+        for name in TRACK_CACHE_SECTIONS:
+            dtype, count = sections[name]
+            offset += -offset % 8
+            layout.append((name, (numpy.dtype(dtype), offset, count)))
+            offset += numpy.dtype(dtype).itemsize * count
+
+        return layout
+
+    @classmethod
+    def is_stale(cls, cache_file, track_file, bases_file):
+        """ Returns True if the given cache file is missing, unreadable, of
+            another version, or wasn't compiled from the given JSON files as
+            they are now, else returns False.
+        """
+        try:
+            with open(cache_file, 'rb') as f:
+                head = TRACK_CACHE_HEAD.unpack(f.read(TRACK_CACHE_HEAD.size))
+        except Exception:
+            return True
+
+        if head[:2] != (TRACK_CACHE_MAGIC, TRACK_CACHE_VERSION):
+            return True
+        return head[3:7] != cls._source_stats(track_file, bases_file)
+
+    @classmethod
+    def compile(cls, cache_file, track_file, bases_file):
+        """ Compiles the given JSON files to the given cache file, replacing
+            it atomically, and returns the compiled cache as a string. If the
+            file can't be written, the cache is still returned (but left
+            unshared).
+        """
+        stats = cls._source_stats(track_file, bases_file)
+
+        # Parse bases
         try:
             with open(bases_file) as base_data:
                 bases = loads(base_data.read())
         except Exception as e:
             raise Exception('Error reading ' + bases_file + ': ' + str(e))
 
+        base_recs = []
+        base_ids = set()
         for base in bases:
             try:
-                base_id = str(base['id'])
-                coverage_start = float(base['coverage'][0])
-                coverage_end = float(base['coverage'][1])
-                mp = base_id  # base ids denote location
-                lat = float(base['lat'])
-                lng = float(base['long'])
+                base_recs.append((str(base['id']),
+                                  float(base['coverage'][0]),
+                                  float(base['coverage'][1]),
+                                  float(base['lat']),
+                                  float(base['long'])))
             except ValueError:
                 raise ValueError('Conversion error in ' + bases_file + '.')
             except KeyError:
                 raise Exception('Malformed ' + bases_file + ': Key Error.')
 
-            self.bases[base_id] = Base(base_id, 
-                                       coverage_start,
-                                       coverage_end,
-                                       Location(mp, lat, lng))
+            # Coverage would otherwise index a Base the Track overwrites
+            if base_recs[-1][0] in base_ids:
+                raise Exception('Malformed ' + bases_file +
+                                ': Duplicate base ID ' + base_recs[-1][0])
+            base_ids.add(base_recs[-1][0])
 
-        # Populate milepost objects (self.mileposts) from track_file
+        # Parse mileposts. Of any repeated marker, the last is kept.
         try:
             with open(track_file) as rail_data:
                 locations = loads(rail_data.read())
         except Exception as e:
             raise Exception('Error reading ' + track_file + ': ' + str(e))
 
+        mileposts = {}
         for marker in locations:
             try:
                 mp = float(marker['milemarker'])
-                lat = float(marker['lat'])
-                lng = float(marker['long'])
+                mileposts[mp] = (float(marker['lat']), float(marker['long']))
             except ValueError:
                 raise ValueError('Conversion error in ' + track_file + '.')
             except KeyError:
                 raise Exception('Malformed ' + track_file + ': Key Error.')
 
-            self.mileposts[mp] = Location(mp, lat, lng)
-            coverage = [b for b in self.bases.values() 
-                        if b.covers_location(self.mileposts[mp])]
-            self.mileposts[mp].covered_by = coverage
+        markers = sorted(mileposts.keys())
+        coverage = CoverageIndex([(b[1], b[2]) for b in base_recs])
+        cov_index = [0]
+        cov_bases = []
+        for covering in coverage.covering_many(markers):
+            cov_bases.extend(covering)
+            cov_index.append(len(cov_bases))
+
+        # Build the file
+        id_width = max([len(b[0]) for b in base_recs] + [1])
+        head = (TRACK_CACHE_MAGIC, TRACK_CACHE_VERSION, id_width) + stats
+        head += (len(markers), len(base_recs), len(cov_bases))
+        arrays = {'markers': markers,
+                  'lats': [mileposts[mp][0] for mp in markers],
+                  'longs': [mileposts[mp][1] for mp in markers],
+                  'bases': base_recs,
+                  'cov_index': cov_index,
+                  'cov_bases': cov_bases}
+
+        data = [TRACK_CACHE_HEAD.pack(*head)]
+        size = TRACK_CACHE_HEAD.size
+        for name, (dtype, offset, _) in cls._layout(head):
+            data.append('\x00' * (offset - size))
+            data.append(numpy.array(arrays[name], dtype).tobytes())
+            size = offset + len(data[-1])
+        data = ''.join(data)
+
+        # Write to a temp file then rename, so other processes only ever see
+        # a whole cache, even if compiling it concurrently.
+        tmp_file = cache_file + '.' + str(os.getpid())
+        try:
+            with open(tmp_file, 'wb') as f:
+                f.write(data)
+            os.rename(tmp_file, cache_file)
+            track_log.info('Compiled track cache ' + cache_file)
+        except (IOError, OSError) as e:
+            track_log.warn('Could not write track cache: ' + str(e))
+
+        return data
 
-        # Build the other milepost lists/dicts from self.mileposts
-        self.marker_linear = [m for m in sorted(self.mileposts.keys())]
-        self.marker_linear_rev = self.marker_linear[::-1]
-        sorted_objs = [m for m in 
-                       sorted(self.mileposts.values(), key=lambda x: x.marker)]
-        self.mileposts_sorted = sorted_objs
+
+class TrackMileposts(object):
+    """ The track's mileposts, as Locations, indexed as the arrays of the
+        given TrackCache (i.e. ascending by marker), like a list. Each
+        Location is built from the arrays when first accessed, then kept, so
+        a process only holds the Locations it uses.
+    """
+    def __init__(self, cache, bases):
+        """ cache: The TrackCache to read mileposts from
+            bases: The TrackBases the cache's coverage indexes refer to
+        """
+        self._cache = cache
+        self._bases = bases
+        self._locations = {}  # Those built so far: { INDEX: Location }
+
+    def __len__(self):
+        return len(self._cache.markers)
+
+    def __iter__(self):
+        for i in xrange(len(self)):
+            yield self[i]
+
+    def __getitem__(self, i):
+        """ Returns the Location of the milepost at the given index.
+        """
+        if i < 0:
+            i += len(self)
+        location = self._locations.get(i)
+        if location is None:
+            if not 0 <= i < len(self):
+                raise IndexError('Milepost index out of range.')
+            cache = self._cache
+            start, end = cache.cov_index[i:i + 2].tolist()
+            coverage = [self._bases.at(b)
+                        for b in cache.cov_bases[start:end].tolist()]
+            location = Location(float(cache.markers[i]),
+                                float(cache.lats[i]),
+                                float(cache.longs[i]),
+                                coverage)
+            self._locations[i] = location
+        return location
+
+    def index(self, marker):
+        """ Returns the index of the milepost at the given marker (a float),
+            in O(log n), or -1 if there's none.
+        """
+        markers = self._cache.markers
+        i = int(numpy.searchsorted(markers, marker))
+        if i < len(markers) and markers[i] == marker:
+            return i
+        return -1
+
+
+class TrackBases(object):
+    """ The track's base stations, as Bases, by base ID, like a dict. Each
+        Base is built from the given TrackCache's arrays when first accessed,
+        then kept, so that each has one Base object per process.
+    """
+    def __init__(self, cache):
+        """ cache: The TrackCache to read base stations from
+        """
+        self._cache = cache
+        self._bases = {}  # Those built so far: { INDEX: Base }
+        self._idxs = {}  # { BASEID: INDEX }
+        for i, base_id in enumerate(cache.bases['id'].tolist()):
+            self._idxs[base_id] = i
+
+    def __len__(self):
+        return len(self._idxs)
+
+    def __iter__(self):
+        return iter(self._idxs)
+
+    def __contains__(self, base_id):
+        return base_id in self._idxs
+
+    def __getitem__(self, base_id):
+        """ Returns the Base of the given ID. Raises KeyError if none.
+        """
+        return self.at(self._idxs[base_id])
+
+    def get(self, base_id, default=None):
+        try:
+            return self[base_id]
+        except KeyError:
+            return default
+
+    def values(self):
+        return [self.at(i) for i in xrange(len(self))]
+
+    def at(self, i):
+        """ Returns the Base at the given index into the cache's bases.
+        """
+        base = self._bases.get(i)
+        if base is None:
+            base_id, coverage_start, coverage_end, lat, lng = \
+                self._cache.bases[i].tolist()
+            mp = base_id  # base ids denote location
+            base = Base(base_id,
+                        coverage_start,
+                        coverage_end,
+                        Location(mp, lat, lng))
+            self._bases[i] = base
+        return base
+
+
+class Track(object):
+    """ A representation of the track, including its locations and radio base 
+        stations (contains lists/dicts of these objects in convenient forms).
+    
+        self.locos = A dict of locootives, by loco ID
+            Format: { LOCOID: LOCO_OBJECT }
+        self.bases = The radio base stations, by base ID (a TrackBases)
+            Format: { BASEID: BASE_OBJECT }
+        self.mileposts_sorted = All track mileposts, sorted by marker (a
+            TrackMileposts). See get_location_at() to find one by marker.
+            Format: [ LOCATIONOBJECT_1, ... , LOCATIONOBJECT_N ]
+        self.marker_array = Numerical milepost markers in ascending order (a
+            numpy array). Its indexes are those of self.mileposts_sorted.
+            Format: [ MP_1, ... , MP_n ], where MP1 < MPn
+        self.marker_linear = self.marker_array
+        self.marker_linear_rev = self.marker_array, in descending order
+        self.cache = The TrackCache the above are read from, whose arrays
+            (e.g. self.marker_array) are shared with other processes.
+        self.coverage = A CoverageIndex of the bases' coverage, by index into
+            the cache's bases, for finding the bases covering any marker (see
+            get_coverage())
+        Note: BASEID/LOCOD = strings, MP = floats
+        Note: Only the cache's arrays are shared. Each process builds its own
+            Location and Base objects from them, but only as they're used
+            (see TrackMileposts and TrackBases).
+    """
+
+    def __init__(self,
+                 track_file=TRACK_RAILS,
+                 locos_file=TRACK_LOCOS,
+                 bases_file=TRACK_BASES,
+                 cache_file=TRACK_CACHE):
+        """ track_file: Track JSON representation
+            locos_file: Locos JSON representation
+            bases_file: Base stations JSON representation
+            cache_file: Compiled track cache of track_file and bases_file
+        """
+        # On-Track device properties
+        self.locos = {}
+        self.bases = None
+        self.last_seen = {}     # Last msg recv time, by device:
+                                # { DeviceType: { ID: DateTime } }
+
+        # Track properties
+        self.mileposts_sorted = None
+        self.marker_linear = None
+        self.marker_linear_rev = None
+        self.marker_array = None
+        self.cache = None
+        self.coverage = None
+        # self.restrictions = {}  # { AUTH_ID: ( START_MILEPOST, END_MILEPOST }
+
+        # Base stations and milepost objects are read from the compiled track
+        # cache as they're used
+        self.cache = TrackCache(cache_file, track_file, bases_file)
+        self.bases = TrackBases(self.cache)
+        self.mileposts_sorted = TrackMileposts(self.cache, self.bases)
+        self.marker_array = self.cache.markers
+        self.marker_linear = self.marker_array
+        self.marker_linear_rev = self.marker_array[::-1]
+        bases = self.cache.bases
+        self.coverage = CoverageIndex(zip(bases['cov_start'].tolist(),
+                                          bases['cov_end'].tolist()))
 
         # Populate Locomotive objects (self.locos) from locos_file
         try:
@@ -349,10 +654,8 @@ class Track(object):
         for loco in locos:
             try:
                 mp = loco['lastmilepost']
-                try:
-                    loco_location = self.mileposts[mp]
-                except KeyError:
-                    print(self.mileposts[0])
+                loco_location = self.get_location_at(mp)
+                if not loco_location:
                     raise Exception('Invalid milepost encountered: ' + str(mp))
 
                 loco_id = str(loco['id'])  # Ensure string ID
@@ -378,60 +681,99 @@ class Track(object):
                 dist_diff = difference between next_mp and actual location
             Note: If next_mp = curr_mp, diff = distance.
                   If no next mp (end of track), returns None.
+            Markers are binary searched, in O(log n). See get_next_mps() for
+            a batch form.
         """
         # If no distance, next_mp is curr_mp
         if distance == 0:
             return curr_mp, distance
 
-        # Working vars
+        mps = self.marker_array
         mp = curr_mp.marker
         target_mp = mp + distance
-        dist_diff = 0
-        next_mp = None
 
-        # Set the location object list to iterate, depending on direction
+        # Find the index of the next mp, in the direction of travel
         if distance > 0:
-            mps = self.marker_linear
-        elif distance < 0:
-            mps = self.marker_linear_rev
-
-        # Find next mp marker, noting unconsumed distance
-        for i, marker in enumerate(mps):
-            if marker == target_mp:
-                next_mp = marker
-                dist_diff = 0
-                break
-            elif (distance > 0 and marker > target_mp) or \
-                 (distance < 0 and marker < target_mp):
-                next_mp = mp
-                if i > 0:
-                    next_mp = mps[i - 1]
-                dist_diff = abs(target_mp - next_mp)
-                break
-
-        # If we didn't find a next mp (i.e. end of track)
-        if not next_mp:
-            return
+            i = int(numpy.searchsorted(mps, target_mp, 'left'))  # >= target
+            if i == len(mps):
+                return  # End of track
+            if mps[i] != target_mp:
+                i -= 1  # Last marker before target
+        else:
+            i = int(numpy.searchsorted(mps, target_mp, 'right')) - 1  # <=
+            if i < 0:
+                return  # End of track
+            if mps[i] != target_mp:
+                i += 1  # First marker after target
+
+        # If target is short of the next marker, stay at curr_mp
+        if i < 0 or i == len(mps):
+            return curr_mp, abs(distance)
+
+        next_mp = self.mileposts_sorted[i]
+        return next_mp, abs(target_mp - next_mp.marker)
+
+    def get_next_mps(self, markers, distances):
+        """ The batch form of _get_next_mp(), for many locos at once.
+            Accepts:
+                markers   = Curr mp markers (array-like of floats)
+                distances = Distances in miles (array-like of floats, neg
+                            dist denotes decreasing DOT)
+            Returns:
+                next_idxs  = numpy array of the index in self.mileposts_sorted
+                             of each next mp, or -1 if none (end of track)
+                dist_diffs = numpy array of each difference between next mp
+                             and actual location (0 if end of track)
+        """
+        mps = self.marker_array
+        markers = numpy.asarray(markers, float)
+        distances = numpy.asarray(distances, float)
+        targets = markers + distances
+        curr_idxs = numpy.searchsorted(mps, markers)
+
+        # Increasing: The target's marker, else the last marker before it
+        i = numpy.searchsorted(mps, targets, 'left')
+        exact = mps[numpy.minimum(i, len(mps) - 1)] == targets
+        inc_idxs = numpy.where(exact, i, i - 1)
+        short = inc_idxs == -1  # Short of the first marker, so stay put
+        inc_idxs[short] = curr_idxs[short]
+        inc_idxs[i == len(mps)] = -1
+
+        # Decreasing: The target's marker, else the first marker after it
+        j = numpy.searchsorted(mps, targets, 'right') - 1
+        exact = mps[numpy.maximum(j, 0)] == targets
+        dec_idxs = numpy.where(exact, j, j + 1)
+        short = dec_idxs == len(mps)  # Short of the last marker, so stay put
+        dec_idxs[short] = curr_idxs[short]
+        dec_idxs[j < 0] = -1
+
+        next_idxs = numpy.where(distances > 0, inc_idxs, dec_idxs)
+        next_idxs[distances == 0] = curr_idxs[distances == 0]
+
+        dist_diffs = numpy.abs(targets - mps[next_idxs])
+        dist_diffs[next_idxs == -1] = 0
+        return next_idxs, dist_diffs
+
+    def get_coverage(self, marker):
+        """ Returns a list of the Bases covering the given marker (a float),
+            in O(log n + k). See get_coverages() for a batch form.
+        """
+        return [self.bases.at(i) for i in self.coverage.covering(marker)]
 
-        # Get mp object associated with next_mp
-        next_mp_obj = self.get_location_at(next_mp)
-        if not next_mp_obj:
-            debug_str = '_get_next_mp failed to find a next location from: '
-            debug_str += str(mps) + '\n'
-            debug_str += 'cur_mp: ' + str(mp) + '\n'
-            debug_str += 'moved : ' + str(distance) + '\n'
-            debug_str += 'tgt_mp: ' + str(target_mp) + '\n'
-            debug_str += 'mp_idx: ' + str(i) + '\n'
-            debug_str += 'nxt_mp: ' + str(next_mp) + '\n'
-            debug_str += 'disdif: ' + str(dist_diff) + '\n'
-            raise Exception(debug_str)
-
-        return next_mp_obj, dist_diff
+    def get_coverages(self, markers):
+        """ The batch form of get_coverage(). Given an array-like of markers,
+            returns a list of the list of Bases covering each.
+        """
+        at = self.bases.at
+        return [[at(i) for i in c]
+                for c in self.coverage.covering_many(markers)]
 
     def get_location_at(self, mile):
         """ Returns the Location at the given track mile (a float) iff exists.
         """
-        return self.mileposts.get(mile, None)
+        i = self.mileposts_sorted.index(mile)
+        if i != -1:
+            return self.mileposts_sorted[i]
 
     def set_lastseen(self, device):
         """ Given a TrackDevice, updates the Track.last_seen with the current
@@ -476,125 +818,219 @@ class Location:
 # Track Sim  #
 ##############
 
-class TrackSim(multiprocessing.Process):
-    """ The Track Simulator. Simulates a locomotives traveling on the track and
-        sending/receiving EMP msgs over on-track communications infrastructure,
-        which is also simulated here.
+class SimClock(object):
+    """ The sim's clock and discrete-event scheduler. Events (callables) are
+        scheduled for given sim times and run in time order, those of the same
+        time in the order they were scheduled, so a run is deterministic.
+        On real time, sim time is wall time and each event waits until due.
+        On virtual time, the clock instead jumps to each event's time as it's
+        run, so the sim runs as fast as the CPU allows.
     """
-    def __init__(self):
-        multiprocessing.Process.__init__(self)
-        self.timeq = multiprocessing.Queue()  # Input queue for "time speed"
-
-    def run(self):
-        track_log.info('Track Sim Starting...')
-        track = Track()  # The track contains all it's devices and locos.
+    def __init__(self, virtual=False, start=None):
+        """ self.virtual : (bool) True if on virtual time, else on real time
+            start        : (float) Virtual start time (Unix time), or None
+                           for now. Unused on real time.
+        """
+        self.virtual = virtual
+        self._now = time() if start is None else start  # Virtual time
+        self._events = []  # Heap of (TIME, SEQ, EVENT)
+        self._seq = count()
 
-        # Start each track componenet-device's simulation thread
-        # These devices exists "on" the track and simulate their own 
-        # operation.
-        # TODO: Bases, Waysides, etc
-        for l in track.locos.values():
-            l.sim.start()
-        
-        # Update sim time and log status at intervals of REFRESH_TIME seconds
-        while True:
-            # Update the time speed,  if an update is waiting
-            try:
-                time_icand = self.timeq.get(timeout=.1)
-                for l in track.locos.values():
-                    l.sim.time_icand = time_icand
-                print('*** Time Multiplier Set:' + str(time_icand))  # debug
-                track_log.info('Time Multiplier Set: ' + str(time_icand))
-            except Queue.Empty:
-                pass
+    def now(self):
+        """ Returns the current sim time (Unix time).
+        """
+        return self._now if self.virtual else time()
 
-            # Log status of each loco, for debug
-            # for l in track.locos.values():
-            #     status_str = 'Loco ' + l.ID + ': '
-            #     status_str += str(l.speed) + ' @ ' + str(l.coords.marker)
-            #     status_str += ' (' + str(l.coords.long) + ',' + str(l.coords.lat) + ')'
-            #     status_str += '. Bases in range: '
-            #     status_str += ', '.join([b.ID for b in l.bases_inrange])
-            #     status_str += ' Conns: '
-            #     status_str += ', '.join([c.conn_to.ID for c in l.conns.values() if c.conn_to])
-            #     track_log.info(status_str)
+    def schedule(self, at, event):
+        """ Schedules the given callable to be run at sim time at.
+        """
+        heappush(self._events, (at, next(self._seq), event))
 
-            sleep(REFRESH_TIME)
+    def run_next(self, until=None):
+        """ Runs the next event, first waiting until it's due (on real time).
+            Returns False, running nothing, if there's no event or, if until is
+            given, none due by sim time until. Else returns True.
+        """
+        if not self._events or (until is not None and
+                                self._events[0][0] > until):
+            return False
+
+        at, _, event = heappop(self._events)
+        if self.virtual:
+            self._now = max(self._now, at)
+        else:
+            sleep(max(0, at - time()))
+        event()
+        return True
+
+
+def _bearings(lats1, longs1, lats2, longs2):
+    """ Returns a numpy array of the compass bearing from each lat1/long1 to
+        the corresponding lat2/long2 (array-likes, in decimal degrees).
+    """
+    lats1 = numpy.radians(lats1)
+    lats2 = numpy.radians(lats2)
+    long_diffs = numpy.radians(numpy.subtract(longs1, longs2))
+
+    a = numpy.cos(lats1) * numpy.sin(lats2)
+    b = numpy.sin(lats1) * numpy.cos(lats2) * numpy.cos(long_diffs)
+    x = numpy.sin(long_diffs) * numpy.cos(lats2)
+    y = a - b
+    degs = numpy.degrees(numpy.arctan2(x, y))
+    return (degs + 360) % 360
+
+
+class FleetEngine(object):
+    """ Simulates the movement and messaging of a fleet of locos, in a single
+        thread ticking every msg_interval secs of sim time (see SimClock),
+        rather than in threads of each loco's own. The fleet's state is kept
+        in numpy arrays, indexed as self.locos, and each tick moves every loco
+        in one vectorized step (see Track.get_next_mps()), then sends their
+        status msgs and fetches their CAD msgs in batches (see
+        Client.send_many()). Each Loco's own attributes are kept in sync with
+        the arrays, for get_6000_msg(), etc.
+    """
+    def __init__(self, locos, track, clock=None, sink=None):
+        """ self.locos      : (list) The fleet's Locos
+            self.track      : (Track) Track object ref
+            self.clock      : (SimClock) The sim's clock. Defaults to real time
+            self.sink       : A function given each tick's status msgs (a
+                              list) in place of sending them, if any. No CAD
+                              msgs are fetched if given. Required on virtual
+                              time, which would otherwise flood the broker.
+            self.time_icand : (float) Time speed up/slow down
+            self.running    : (bool) Thread kill signal
+            self.mp_idxs    : (numpy array) Each loco's location, as an index
+                              into track.mileposts_sorted
+            self.speeds     : (numpy array) Each loco's speed
+            self.headings   : (numpy array) Each loco's compass bearing
+            self.directions : (numpy array) Each loco's direction of travel,
+                              1 for 'increasing' or -1 for 'decreasing'
+            self.makeup     : (numpy array) Each loco's distance traveled past
+                              its location, carried to the next tick
+        """
+        self.locos = list(locos)
+        self.track = track
+        self.clock = clock or SimClock()
+        self.sink = sink
+        self.time_icand = 1
+        self.running = False
+        self._thread = None
+        self._client = Client()
+        self._last_tick = None  # Sim time of the last tick
+
+        if self.clock.virtual and not sink:
+            raise ValueError('A virtual time FleetEngine requires a sink.')
+
+        for loco in self.locos:
+            if not loco.direction or not loco.coords or loco.speed is None:
+                raise ValueError('Cannot simulate an unintialized Locomotive.')
+
+        markers = [l.coords.marker for l in self.locos]
+        self.mp_idxs = numpy.searchsorted(track.marker_array, markers)
+        self.speeds = numpy.array([l.speed for l in self.locos], float)
+        self.headings = numpy.array([l.heading for l in self.locos], float)
+        self.directions = numpy.array([DIRECTIONS[l.direction]
+                                       for l in self.locos])
+        self.makeup = numpy.zeros(len(self.locos))
+
+        coverages = track.get_coverages(markers)
+        for loco, bases in zip(self.locos, coverages):
+            loco.bases_inrange = bases
 
-    @staticmethod
-    def loco_movement(loco):
-        """ Real-time simulation of a locomotive's on-track movement. Also
-            determines base stations in range of locos current position.
-            This function is intended to be run as a Thread.
-        """
-        def _brake():
-            """ Apply the adaptive braking algorithm.
-            """
-            raise NotImplementedError
-
-        def _set_heading(prev_mp, curr_mp):
-                """ Sets loco heading based on current and prev lat/long
-                """
-                lat1 = radians(prev_mp.lat)
-                lat2 = radians(curr_mp.lat)
-
-                long_diff = radians(prev_mp.long - curr_mp.long)
-
-                a = cos(lat1) * sin(lat2)
-                b = (sin(lat1) * cos(lat2) * cos(long_diff))
-                x = sin(long_diff) * cos(lat2)
-                y = a - b
-                deg = degrees(atan2(x, y))
-                compass_bearing = (deg + 360) % 360
-
-                loco.heading = compass_bearing
-
-        # Start
-        makeup_dist = 0
-        if not loco.direction or not loco.coords or loco.speed is None:
-            raise ValueError('Cannot simulate an unintialized Locomotive.')
-
-        while loco.sim.running:
-            sleep(MSG_INTERVAL)  # Sleep for specified interval
-
-            # Move, if at speed
-            if loco.speed > 0:
-                # Determine dist traveled since last iteration, including
-                # makeup distance, if any.
-                hours = REFRESH_TIME / 3600.0  # Seconds to hours, for mph
-                hours = loco.sim.time_icand * hours  # Apply sim time rate
-                dist = loco.speed * hours * 1.0  # distance = speed * time
-                dist += makeup_dist
-
-                # Set sign of dist based on dir of travel
-                if loco.direction == 'decreasing':
-                    dist *= -1
-
-                # Get next location and any makeup distance
-                new_mp, dist = loco.track._get_next_mp(loco.coords, dist)
-                if not new_mp:
-                    err_str = ' - At end of track. Reversing.'
-                    track_log.info(loco.name + err_str)
-                    loco.direction *= -1
-                else:
-                    _set_heading(loco.coords, new_mp)
-                    loco.coords = new_mp
-                    makeup_dist = dist
+    def start(self):
+        """ Starts the simulation thread.
+        """
+        if not self.running:
+            self.running = True
+            self._thread = Thread(target=self.run)
+            self._thread.start()
 
-                    # Determine base stations in range of current position
-                    loco.bases_inrange = [b for b in loco.track.bases.values()
-                                          if b.covers_location(loco.coords)]
+    def stop(self):
+        """ Stops the simulation thread.
+        """
+        if self.running:
+            self.running = False  # Thread poison pill
+            self._thread.join(timeout=config.refresh_time)
 
-    @staticmethod
-    def loco_messaging(loco):
-        """ Real-time simulation of a locomotives's messaging system. Maintains
-            connections to bases in range of loco's position. 
-            # TODO: and sends/fetches msgs over them. 
-            This function is intended to be run as a Thread.
+    def run(self, until=None):
+        """ Runs the simulation's ticks until stopped or, if until is given,
+            until that sim time. Intended to be run as a Thread, by start(),
+            or directly (e.g. on virtual time).
         """
-        while loco.sim.running:
-            sleep(MSG_INTERVAL)  # Sleep for specified interval
+        self.running = True
+        self._last_tick = self.clock.now()
+        self._schedule_tick(self._last_tick + config.msg_interval)
+        while self.running and self.clock.run_next(until):
+            pass
+        self.running = False
 
+    def _schedule_tick(self, at):
+        """ Schedules a tick at the given sim time: Moving and messaging the
+            fleet, then scheduling the next tick msg_interval secs later, or
+            now if that's overdue.
+        """
+        def tick():
+            now = self.clock.now()
+            hours = (now - self._last_tick) / 3600.0  # Secs to hours, for mph
+            self._last_tick = now
+            self.move(hours * self.time_icand)
+            self.message()
+            self._schedule_tick(max(at + config.msg_interval,
+                                    self.clock.now()))
+
+        self.clock.schedule(at, tick)
+
+    def move(self, hours):
+        """ Moves each loco at speed the distance it travels in the given
+            hours (plus any makeup distance), reversing those at end of track,
+            and syncs their Locos.
+        """
+        track = self.track
+        moving = numpy.flatnonzero(self.speeds > 0)
+        dists = self.speeds[moving] * hours + self.makeup[moving]
+        dists *= self.directions[moving]
+        markers = track.marker_array[self.mp_idxs[moving]]
+        next_idxs, dist_diffs = track.get_next_mps(markers, dists)
+
+        # Reverse those at end of track
+        at_end = next_idxs == -1
+        for i in moving[at_end].tolist():
+            self.directions[i] *= -1
+            self.locos[i].direction = DIRECTIONS_REV[self.directions[i]]
+            track_log.info(self.locos[i].name + ' - At end of track. Reversing.')
+
+        # Move the others, updating the heading of those changing location
+        moved = moving[~at_end]
+        next_idxs = next_idxs[~at_end]
+        prev_idxs = self.mp_idxs[moved]
+        self.makeup[moved] = dist_diffs[~at_end]
+        self.mp_idxs[moved] = next_idxs
+
+        changed = next_idxs != prev_idxs
+        moved = moved[changed]
+        self.headings[moved] = _bearings(track.cache.lats[prev_idxs[changed]],
+                                         track.cache.longs[prev_idxs[changed]],
+                                         track.cache.lats[next_idxs[changed]],
+                                         track.cache.longs[next_idxs[changed]])
+
+        # Sync Locos, including the base stations in range of each
+        locations = [track.mileposts_sorted[i]
+                     for i in self.mp_idxs[moved].tolist()]
+        coverages = track.get_coverages([l.marker for l in locations])
+        for i, location, bases in zip(moved.tolist(), locations, coverages):
+            loco = self.locos[i]
+            loco.coords = location
+            loco.heading = float(self.headings[i])
+            loco.bases_inrange = bases
+
+    def message(self):
+        """ Maintains each loco's connections to the bases in range of its
+            location, then sends the status msgs of those with an active
+            connection and fetches their next CAD msgs, in batches.
+        """
+        active = []  # [ (LOCO, ACTIVE_CONNS) ]
+        for loco in self.locos:
             # Drop all out of range base connections and keep alive existing
             # in-range connections
             lconns = loco.conns.values()
@@ -612,46 +1048,143 @@ class TrackSim(multiprocessing.Process):
                         conn.connect(loco.bases_inrange[i])
                 except IndexError:
                     break  # No (or no more) bases in range to consider
-                
+
             # Ensure at least one active connection
             conns = [c for c in lconns if c.connected() is True]
             if not conns:
                 err_str = ' skipping msg send/recv - No active comms.'
                 track_log.warn(loco.name + err_str)
-                continue  # Try again next iteration
+                continue  # Try again next tick
+            active.append((loco, conns))
 
-            # Send status msg over active connections, breaking on first success.
-            status_msg = get_6000_msg(loco)
-            for conn in conns:
+        if not active:
+            return
+
+        # Give status msgs to the sink, if any, or broadcast them, if
+        # multicasting. Else send them in a batch, resending any failed once
+        # (as over a loco's other connection).
+        sent = self.clock.now()
+        status_msgs = [get_6000_msg(loco, sent) for loco, _ in active]
+        if self.sink:
+            self.sink(status_msgs)
+            return
+        elif TrackSim.status_sender:
+            for (loco, _), msg in zip(active, status_msgs):
                 try:
-                    conn.send(status_msg)
-                    info_str = ' - Sent status msg over ' + conn.conn_to.name
-                    track_log.info(loco.name + info_str)
+                    TrackSim.status_sender.send_msg(msg)
+                    track_log.info(loco.name + ' - Broadcast status msg')
                 except Exception as e:
-                    track_log.warn(loco.name + ' send failed: ' + str(e))
-                    
-            # Fetch incoming cad msgs over active connections, breaking on success.
-            for conn in conns:
-                cad_msg = None
+                    track_log.warn(loco.name + ' broadcast failed: ' + str(e))
+        else:
+            failed = self._client.send_many(status_msgs)
+            if failed:
+                failed = self._client.send_many(failed)
+            failed = set(failed)
+            for (loco, conns), msg in zip(active, status_msgs):
+                if msg in failed:
+                    track_log.warn(loco.name + ' send failed.')
+                else:
+                    conns[0].keep_alive()
+                    info_str = ' - Sent status msg over '
+                    track_log.info(loco.name + info_str + conns[0].conn_to.name)
+
+        # Fetch incoming cad msgs in a batch
+        try:
+            cad_msgs = self._client.fetch_next_msgs([loco.emp_addr
+                                                     for loco, _ in active])
+        except Exception:
+            err_str = ' - active connections exist, but msg fetch/recv failed.'
+            [track_log.error(loco.name + err_str) for loco, _ in active]
+            return
+
+        for (loco, conns), cad_msg in zip(active, cad_msgs):
+            conns[0].keep_alive()
+
+            # Process cad msg, if msg and if actually for this loco
+            if cad_msg and cad_msg.payload.get('ID') == loco.ID:
                 try:
-                    cad_msg = conn.fetch(loco.emp_addr)
-                except Queue.Empty:
-                    break  # No msgs (or no more msgs) to receive.
-                except Exception as e:
-                    track_log.warn(loco.name + ' fetch failed: ' + str(e))
-                    continue  # Try the next connecion
-
-                # Process cad msg, if msg and if actually for this loco
-                if cad_msg and cad_msg.payload.get('ID') == loco.ID:
-                    try:
-                        # TODO: Update track restrictions based on msg
-                        track_log.info(loco.name + ' - CAD msg processed.')
-                    except:
-                        track_log.error(loco.name + ' - Received invalid CAD msg.')
-                    break  # Either way, the msg was fetched # TODO: ACK w/broker?
-            else:
-                err_str = ' - active connections exist, but msg fetch/recv failed.'
-                track_log.error(loco.name + err_str)
+                    # TODO: Update track restrictions based on msg
+                    track_log.info(loco.name + ' - CAD msg processed.')
+                except:
+                    track_log.error(loco.name + ' - Received invalid CAD msg.')
+
+
+def add_fleet(track, num_locos):
+    """ Adds num_locos synthetic locos to the given Track, at random mileposts,
+        each connected to a base covering its location (if any). Returns a
+        list of them.
+    """
+    rand = random.Random(FLEET_SEED)
+    fleet = []
+    for i in xrange(num_locos):
+        loco = Loco(str(FLEET_ID_BASE + i), track)
+        location = rand.choice(track.mileposts_sorted)
+        loco.update(speed=rand.uniform(0, 60),
+                    heading=rand.uniform(0, 360),
+                    direction=rand.choice(('increasing', 'decreasing')),
+                    location=location,
+                    bpp=90)
+        if location.covered_by:
+            loco.conns['Radio 1'].connect(location.covered_by[0])
+        track.locos[loco.ID] = loco
+        fleet.append(loco)
+
+    return fleet
+
+
+class TrackSim(multiprocessing.Process):
+    """ The Track Simulator. Simulates a locomotives traveling on the track and
+        sending/receiving EMP msgs over on-track communications infrastructure,
+        which is also simulated here.
+        If given a transport (a ShmTransport), the sim's broker clients use it.
+        If STATUS_MCAST, loco status msgs are broadcast by IP multicast (see
+        McastSender) rather than sent to the broker.
+        The sim runs on real time. See sim_scenario.py for virtual time.
+    """
+    status_sender = None  # The McastSender of loco status msgs, if any
+
+    def __init__(self, transport=None):
+        multiprocessing.Process.__init__(self)
+        self.timeq = multiprocessing.Queue()  # Input queue for "time speed"
+        self.transport = transport
+
+    def run(self):
+        track_log.info('Track Sim Starting...')
+        config.watch(track_log)
+        Client.default_transport = self.transport
+        if STATUS_MCAST:
+            TrackSim.status_sender = McastSender()
+        track = Track()  # The track contains all it's devices and locos.
+
+        # Start the locos' simulation, which moves them on the track and
+        # messages over the on-track devices.
+        # TODO: Bases, Waysides, etc
+        engine = FleetEngine(track.locos.values(), track)
+        engine.start()
+        
+        # Update sim time and log status at intervals of refresh_time seconds
+        while True:
+            # Update the time speed,  if an update is waiting
+            try:
+                time_icand = self.timeq.get(timeout=.1)
+                engine.time_icand = time_icand
+                print('*** Time Multiplier Set:' + str(time_icand))  # debug
+                track_log.info('Time Multiplier Set: ' + str(time_icand))
+            except Queue.Empty:
+                pass
+
+            # Log status of each loco, for debug
+            # for l in track.locos.values():
+            #     status_str = 'Loco ' + l.ID + ': '
+            #     status_str += str(l.speed) + ' @ ' + str(l.coords.marker)
+            #     status_str += ' (' + str(l.coords.long) + ',' + str(l.coords.lat) + ')'
+            #     status_str += '. Bases in range: '
+            #     status_str += ', '.join([b.ID for b in l.bases_inrange])
+            #     status_str += ' Conns: '
+            #     status_str += ', '.join([c.conn_to.ID for c in l.conns.values() if c.conn_to])
+            #     track_log.info(status_str)
+
+            sleep(config.refresh_time)
 
     @staticmethod
     def base_messaging(self):
@@ -41,6 +41,13 @@ INFOBOX = 'infobox-table'
 UP = 'up shuffleable'
 WARN = 'warn shuffleable'
 DOWN = 'down shuffleable'
+QUEUE_OK = 'up'
+QUEUE_WARN = 'warn'
+QUEUE_FULL = 'down'
+
+# Broker queue depth, as a fraction of max depth, at which a queue is flagged
+QUEUE_WARN_LEVEL = 0.5
+QUEUE_FULL_LEVEL = 0.9
 
 
 class Polyline(object):
@@ -363,3 +370,40 @@ def get_status_map(track, tracklines, loco=None):
                      style="height:600px;width:795px;margin:0;",
                      fit_markers_to_bounds=False)
     return status_map
+
+
+def get_broker_table(stats):
+    """ Given the broker's stats (see lib_messaging.BrokerCore.stats), returns
+        an html table of its queues, each flagged by how full it is.
+    """
+    def ms(wait):
+        return '-' if wait is None else '%.1f' % wait
+
+    tbl_headers = ['Queue', 'Depth', 'Subs', 'In/s', 'Out/s',
+                   'Wait p50/p90/p99 (ms)', 'Rejected', 'Dropped', 'Expired']
+    table = WebTable(col_headers=tbl_headers)
+
+    max_depth = stats['max_depth']
+    for addr, q in sorted(stats['queues'].items()):
+        css_class = QUEUE_OK
+        if q['rejected'] or q['dropped']:
+            css_class = QUEUE_FULL
+        if max_depth:
+            if q['depth'] >= max_depth * QUEUE_FULL_LEVEL:
+                css_class = QUEUE_FULL
+            elif q['depth'] >= max_depth * QUEUE_WARN_LEVEL:
+                css_class = QUEUE_WARN
+
+        waits = '/'.join((ms(q['wait_p50']), ms(q['wait_p90']),
+                          ms(q['wait_p99'])))
+        table.add_row([cell(addr),
+                       cell(str(q['depth']), css_class=css_class),
+                       cell(str(q['subscribers'])),
+                       cell('%.1f' % q['enqueue_rate']),
+                       cell('%.1f' % q['dequeue_rate']),
+                       cell(waits),
+                       cell(str(q['rejected'])),
+                       cell(str(q['dropped'])),
+                       cell(str(q['expired']))])
+
+    return table.html()
@@ -16,12 +16,15 @@ from random import randrange
 from threading import Thread
 from multiprocessing import Process
     
-from lib_messaging import MsgBroker, Client, Queue
+from lib_messaging import MsgBroker, Client, Message, Queue
+from lib_messaging import ShmTransport, McastListener
+from lib_messaging import MSG_TRANSPORT, STATUS_MCAST, DIRECTIONS
 from lib_messaging import BOS_EMP
 from lib_app import bos_log, dep_install
-from lib_app import APP_NAME, REFRESH_TIME, WEB_EXPIRE
+from lib_app import config, APP_NAME, WEB_EXPIRE
 from lib_track import Track, TrackSim, Loco, Location
 from lib_web import get_locos_table, get_status_map, get_tracklines, get_loco_connlines
+from lib_web import get_broker_table
 
 
 # Attempt to import 3rd party modules, prompting for install on fail.
@@ -125,6 +128,31 @@ def _home_get_async_content():
                          loco_connlines=conn_lines)
 
 
+@bos_web.route('/broker')
+def broker():
+    """ Serves broker.html, the msg broker's queue monitor.
+    """
+    return flask.render_template('broker.html')
+
+
+@bos_web.route('/_broker_get_async_content', methods=['POST'])
+def _broker_get_async_content():
+    """ Serves the broker's updated stats - its queues table and totals.
+    """
+    bos = bos_sessions[flask.session['bos_id']]
+
+    try:
+        stats = bos.msg_client.fetch_stats()
+    except Exception as e:
+        bos_log.warn('Broker stats unavailable: ' + str(e))
+        return 'error'
+
+    return flask.jsonify(queues_table=get_broker_table(stats),
+                         uptime=int(stats['uptime']),
+                         failed=stats['failed'],
+                         duplicates=stats['duplicates'])
+
+
 @bos_web.route('/_set_sessionvar', methods=['POST'])
 def main_set_sessionvar_async():
     """ Accepts a key value pair via ajax and updates session[key] with the 
@@ -161,70 +189,134 @@ class BOS(Thread):
         messages from the broker over TCP/IP. The BOS also runs the Track and 
         Message Broker sims, but as subprocesses. This is to demonstrate their
         isolation, as well as assure optimal sim performance.
+        If STATUS_MCAST, loco status msgs are instead received by IP multicast.
+        Msgs from both are processed in turn, by the BOS thread, which decodes
+        the status msgs waiting at once in a batch.
     """
     def __init__(self):
         Thread.__init__(self)
         self.track = Track()
         self.msg_client = Client()  # TODO: Random ports, to enable multiple sandboxes
+        self.msgq = Queue.Queue()  # Raw msgs received, to be processed
 
-        # Each BOS gets it's own Message Broker.
-        self.broker_sim = MsgBroker()
+        # Each BOS gets it's own Message Broker. The Track Sim's clients may
+        # reach it over shared memory rather than TCP/IP.
+        transport = ShmTransport() if MSG_TRANSPORT == 'shm' else None
+        self.broker_sim = MsgBroker(transport=transport)
 
         # Each BOS gets it's own Track Sim. Note: The track sim has a
         # multiprocessing queue so we can send it the time multiplicand.
-        self.track_sim = TrackSim()
+        self.track_sim = TrackSim(transport=transport)
 
     def run(self):
-        """ Checks msg broker for new status msgs every REFRESH_TIME sec.
+        """ Starts receiving msgs from the BOS's msg queue at the msg broker
+            (and the loco status msg multicast group, if STATUS_MCAST), and
+            processes each msg as it is received.
         """
         bos_log.info('Starting Sandbox...')
+        config.watch(bos_log)
         self.broker_sim.start()
         self.track_sim.start()
         bos_log.info('BOS Started.')
 
+        receivers = [self._watch_subscription]
+        if STATUS_MCAST:
+            receivers.append(self._watch_status_mcast)
+        for receiver in receivers:
+            thread = Thread(target=receiver)
+            thread.daemon = True
+            thread.start()
+
+        while True:
+            raw_msgs = [self.msgq.get()]
+            try:
+                while True:
+                    raw_msgs.append(self.msgq.get_nowait())
+            except Queue.Empty:
+                pass
+            self._process_msgs(raw_msgs)
+
+    def _watch_subscription(self):
+        """ Subscribes to the BOS's msg queue at the msg broker and queues
+            each msg for processing as it is pushed.
+        """
+        subscriber = self.msg_client.subscribe(BOS_EMP)
         while True:
-            # Fetch the next available msg, if any
-            msg = None
             try:
-                msg = self.msg_client.fetch_next_msg(BOS_EMP)
+                raw_msg = subscriber.next_raw_msg(timeout=config.refresh_time)
             except Queue.Empty:
                 bos_log.info('Msg queue empty.')
-            except Exception:
-                bos_log.warn('Could not connect to broker.')
+                continue
+            except Exception as e:
+                bos_log.warn(str(e))
+                sleep(config.refresh_time)
+                continue
 
-            # Process loco status msg. Msg should be of form given in 
-            # docs/app_messaging_spec.md, Msg ID 6000.
-            if msg and msg.msg_type == 6000:
-                try:
-                    locoID = msg.payload['loco']
-                    location = Location(msg.payload['milepost'],
-                                        msg.payload['lat'],
-                                        msg.payload['long'])
-                    active_conns = eval(msg.payload['conns'])  # evals to dict
-
-                    # Eiter reference or instantiate loco with the given ID
-                    loco = self.track.locos.get(locoID)
-                    if not loco:
-                        loco = Loco(locoID, self.track)
-
-                    # Update the BOS's loco object with status msg params
-                    loco.update(msg.payload['speed'],
-                                msg.payload['heading'],
-                                msg.payload['direction'],
-                                location,
-                                msg.payload['bpp'],
-                                active_conns)
-
-                    # Update the last seen time for this loco
-                    self.track.set_lastseen(loco)
-                    
-                    bos_log.info('Processed status msg for ' + loco.name)
-                except KeyError:
-                    bos_log.error('Malformed status msg: ' + str(msg.payload))
-            elif msg:
-                bos_log.error('Fetched unhandled msg type: ' + str(msg.msg_type))
-                
-            sleep(REFRESH_TIME)
+            self.msgq.put(raw_msg)
+
+    def _watch_status_mcast(self):
+        """ Joins the loco status msg multicast group and queues each msg for
+            processing as it is broadcast.
+        """
+        listener = McastListener(bos_log)
+        while True:
+            try:
+                raw_msg = listener.next_raw_msg(timeout=config.refresh_time)
+            except Queue.Empty:
+                bos_log.info('No status msgs broadcast.')
+                continue
+
+            self.msgq.put(raw_msg)
+
+    def _process_msgs(self, raw_msgs):
+        """ Updates the track with the contents of the given raw msgs, in turn.
+            Loco status msgs (6000s) are decoded in one batch (see
+            Message.decode_6000_many), and any others one at a time.
+        """
+        status_msgs = []
+        for raw_msg in raw_msgs:
+            if Message.msg_type_of(raw_msg) == 6000:
+                status_msgs.append(raw_msg)
+                continue
+            try:
+                msg = Message(raw_msg)
+            except Exception as e:
+                bos_log.error('Malformed msg: ' + str(e))
+                continue
+            bos_log.error('Fetched unhandled msg type: ' + str(msg.msg_type))
+
+        if not status_msgs:
+            return
+
+        # Process loco status msgs. Msgs should be of form given in
+        # docs/app_messaging_spec.md, Msg ID 6000.
+        status, conns = Message.decode_6000_many(status_msgs)
+        if len(status) < len(status_msgs):
+            bos_log.error(str(len(status_msgs) - len(status)) +
+                          ' malformed status msg(s) dropped.')
+
+        for row, active_conns in zip(status.tolist(), conns):
+            locoID, _, speed, heading, bpp, mp, lat, lng, direction = row
+            try:
+                # Eiter reference or instantiate loco with the given ID
+                loco = self.track.locos.get(locoID)
+                if not loco:
+                    loco = Loco(locoID, self.track)
+
+                # Update the BOS's loco object with status msg params
+                loco.update(speed,
+                            heading,
+                            DIRECTIONS[direction],
+                            Location(mp, lat, lng),
+                            bpp,
+                            active_conns)  # { LABEL: BASEID }
+
+                # Update the last seen time for this loco
+                self.track.set_lastseen(loco)
+
+                bos_log.info('Processed status msg for ' + loco.name)
+            except ValueError as e:
+                bos_log.error('Malformed status msg: ' + str(e))
 
 
 class Web(Process):
@@ -0,0 +1,41 @@
+/* The javascript for PTC-Sim's broker.html
+* 
+* Author: Dustin Fast, 2018
+*/
+
+// Globals
+var refresh_interval = 2000     // Async refresh interval
+
+
+// Start async content refresh
+$(document).ready(function () {
+    updateBrokerAsync();
+    setInterval(updateBrokerAsync, refresh_interval);
+});
+
+
+// Refresh the broker's queues table and totals
+function updateBrokerAsync() {
+    $.ajax({
+        url: $SCRIPT_ROOT + '/_broker_get_async_content',
+        type: 'POST',
+        contentType: 'application/json;charset=UTF-8',
+        data: JSON.stringify({}),
+        timeout: 1000,
+
+        error: function (jqXHR, textStatus, errorThrown) {
+            console.warn('Error contacting server for broker stats.');
+        },
+
+        success: function (data) {
+            if (data == 'error') {
+                console.warn('Server-side broker stats error.')
+                return;
+            }
+            $('#queues-table').html(data.queues_table);
+            $('#broker-uptime').text(data.uptime + 's');
+            $('#broker-failed').text(data.failed);
+            $('#broker-duplicates').text(data.duplicates);
+        }
+    });
+}
@@ -0,0 +1,332 @@
+""" Regression tests for the broker's network engines, against a live broker
+    on loopback.
+
+    Usage: python -m unittest discover tests
+
+    Author: Dustin Fast, 2018
+"""
+
+import os
+import sys
+import Queue
+import socket
+import unittest
+from time import time, sleep
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from lib_messaging import BrokerCore, Client, Message, MsgBroker, MsgSocket
+from lib_messaging import MAX_MSG_SIZE, shard_of, shard_ports
+from lib_messaging import FRAMING_BINARY, FRAMING_HEX, msg_to_frame
+
+ENGINES = ('event', 'threaded')
+NUM_CONNS = 200  # Concurrent connections, see EventServerTest
+NUM_SHARDS = 3  # Shards of the broker, see ShardedBrokerTest
+START_TIMEOUT = 5  # Seconds to wait for a broker to accept connections
+
+STATUS = {'sent': 1530000000, 'loco': '1001', 'speed': 25.5,
+          'heading': 12.25, 'direction': 'increasing', 'milepost': 2.02,
+          'lat': 61.2, 'long': -149.9, 'bpp': 90.0, 'conns': {}}
+
+
+def free_port():
+    """ Returns a TCP port on loopback not currently in use.
+    """
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def free_ports(n):
+    """ Returns the first of n consecutive TCP ports on loopback not currently
+        in use.
+    """
+    while True:
+        base = free_port()
+        socks = []
+        try:
+            for port in range(base, base + n):
+                sock = socket.socket()
+                socks.append(sock)
+                sock.bind(('127.0.0.1', port))
+            return base
+        except socket.error:
+            continue
+        finally:
+            for sock in socks:
+                sock.close()
+
+
+def start_broker(engine, shards=1):
+    """ Starts and returns an unjournaled broker of the given engine and
+        number of shards, on free ports, once it accepts connections.
+    """
+    broker = MsgBroker(engine=engine,
+                       journal=False,
+                       shards=shards,
+                       send_port=free_port(),
+                       fetch_port=free_port(),
+                       shard_base_port=free_ports(2 * shards))
+    broker.daemon = True
+    broker.start()
+
+    ports = [broker.send_port, broker.fetch_port]
+    if shards > 1:
+        for shard in range(shards):
+            ports.extend(shard_ports(shard, broker.shard_base_port))
+
+    deadline = time() + START_TIMEOUT
+    for port in ports:
+        while True:
+            try:
+                socket.create_connection(('127.0.0.1', port)).close()
+                break
+            except socket.error:
+                if time() > deadline:
+                    broker.terminate()
+                    raise
+                sleep(0.05)
+    return broker
+
+
+def status_msg(dest='test.q'):
+    """ Returns a new 6000 msg, of the next seq, addressed to dest.
+    """
+    return Message((6000, 'sim.l.1001', dest, STATUS))
+
+
+class BrokerTest(unittest.TestCase):
+    """ Base of tests run against a broker of each engine. Subclasses call
+        self.each_engine(test), which runs test(client) once per engine, with
+        the broker in self.broker.
+    """
+    def each_engine(self, test, engines=ENGINES, shards=1):
+        for engine in engines:
+            self.broker = broker = start_broker(engine, shards)
+            try:
+                test(Client('127.0.0.1', broker.send_port, broker.fetch_port))
+            finally:
+                broker.terminate()
+                broker.join()
+                Client._shard_maps.clear()  # Its ports may be reused
+
+
+class SubscriberTest(BrokerTest):
+    """ Tests subscriptions' acknowledgement and redelivery.
+    """
+    def test_close_acks_received(self):
+        """ Msgs received before close() aren't redelivered, though others
+            pushed but unread are.
+        """
+        def test(client):
+            msgs = [status_msg() for _ in range(20)]
+            self.assertEqual(client.send_many(msgs), [])
+
+            sub = client.subscribe('test.q', window=16)
+            received = [sub.next_msg(timeout=2).seq for _ in range(3)]
+            sleep(0.2)  # So the rest of the window is pushed, but unread
+            sub.close()
+
+            sub = client.subscribe('test.q', window=16)
+            received += [sub.next_msg(timeout=2).seq for _ in range(17)]
+            sub.close()
+            self.assertEqual(received, [m.seq for m in msgs])
+
+        self.each_engine(test)
+
+
+class EventServerTest(BrokerTest):
+    """ Tests the event engine's servicing of many connections at once.
+    """
+    def test_concurrent_conns(self):
+        """ Requests from many connections, each sent before any response is
+            read, are all responded to.
+        """
+        def test(client):
+            conns = []
+            try:
+                for i in range(NUM_CONNS):
+                    framing = (FRAMING_BINARY, FRAMING_HEX)[i % 2]
+                    sock = socket.create_connection(('127.0.0.1',
+                                                     client.send_port))
+                    conns.append(MsgSocket(sock, framing))
+
+                msgs = [status_msg() for _ in conns]
+                for msock, msg in zip(conns, msgs):
+                    msock.send_frame(msg_to_frame(msg.raw_msg, msock.binary))
+                for msock in conns:
+                    msock.sock.settimeout(5)
+                    self.assertEqual(msock.recv_frame(), 'OK')
+            finally:
+                for msock in conns:
+                    msock.close()
+
+            fetched = client.fetch_many('test.q')
+            self.assertEqual(sorted(m.seq for m in fetched),
+                             sorted(m.seq for m in msgs))
+
+        self.each_engine(test, ('event',))
+
+    def test_pipelined(self):
+        """ Pipelined requests over one connection are responded to in
+            order, including a fetch of an empty queue.
+        """
+        def test(client):
+            sock = socket.create_connection(('127.0.0.1', client.fetch_port))
+            msock = MsgSocket(sock, FRAMING_HEX)
+            try:
+                client.send_msg(status_msg())
+                for request in ('test.q', 'test.q', 'STATS'):
+                    msock.send_frame(request)
+                msock.sock.settimeout(5)
+                msg = Message(msock.recv_frame().decode('hex'))
+                self.assertEqual(msg.dest_addr, 'test.q')
+                self.assertEqual(msock.recv_frame(), 'EMPTY')
+                self.assertTrue(msock.recv_frame().startswith('{'))
+            finally:
+                msock.close()
+
+        self.each_engine(test, ('event',))
+
+    def test_push_on_enqueue(self):
+        """ A subscriber waiting on an empty queue is pushed msgs as they
+            are sent.
+        """
+        def test(client):
+            sub = client.subscribe('test.q')
+            try:
+                self.assertRaises(Queue.Empty, sub.next_msg, 0.1)
+                msg = status_msg()
+                client.send_msg(msg)
+                self.assertEqual(sub.next_msg(timeout=2).seq, msg.seq)
+            finally:
+                sub.close()
+
+        self.each_engine(test, ('event',))
+
+
+class FetchManyTest(BrokerTest):
+    """ Tests fetching msgs in batches, with fetch_many.
+    """
+    def test_fetch_many(self):
+        """ Up to max_n msgs are fetched at once, oldest first, in either
+            framing, and none from an empty queue.
+        """
+        def test(client):
+            msgs = [status_msg() for _ in range(10)]
+            self.assertEqual(client.send_many(msgs), [])
+
+            hex_client = Client(client.broker,
+                                client.send_port,
+                                client.fetch_port,
+                                FRAMING_HEX)
+            first = client.fetch_many('test.q', 4)
+            rest = hex_client.fetch_many('test.q')
+            self.assertEqual([m.raw_msg for m in first + rest],
+                             [m.raw_msg for m in msgs])
+            self.assertEqual([len(first), len(rest)], [4, 6])
+            self.assertEqual(client.fetch_many('test.q'), [])
+            self.assertEqual(client.fetch_many('no.such.q'), [])
+
+        self.each_engine(test)
+
+    def test_max_size(self):
+        """ A batch stops short of max_size, leaving the rest queued, and a
+            malformed request fails.
+        """
+        core = BrokerCore(ttl=0)
+        msgs = [status_msg() for _ in range(5)]
+        for msg in msgs:
+            self.assertEqual(core.handle_send(msg.raw_msg, True, ('t', 0)),
+                             'OK')
+
+        max_size = MAX_MSG_SIZE + 2 * len(msgs[0].raw_msg)
+        batch = core.handle_fetch('MANY test.q 0', True, ('t', 0),
+                                  max_size=max_size)
+        self.assertEqual(Message.split_batch(batch),
+                         [m.raw_msg for m in msgs[:3]])
+        self.assertEqual(len(core.outgoing_queues['test.q']), 2)
+        self.assertEqual(core.handle_fetch('MANY test.q', True, ('t', 0)),
+                         'FAIL')
+
+
+class ShardedBrokerTest(BrokerTest):
+    """ Tests a sharded broker's partitioning of queues, and its routing.
+    """
+    queue_names = ['test.q' + str(i) for i in range(12)]
+
+    def test_direct(self):
+        """ Client sends each msg to, and fetches it from, the shard owning
+            its queue, and the broker's stats combine those of all shards.
+        """
+        def test(client):
+            base_port = self.broker.shard_base_port
+            msgs = [status_msg(q) for q in self.queue_names]
+            self.assertEqual(client.send_many(msgs), [])
+            client.send_msg(status_msg('test.q0'))
+
+            for shard in range(NUM_SHARDS):
+                shard_client = Client(client.broker,
+                                      *shard_ports(shard, base_port))
+                self.assertEqual(
+                    sorted(shard_client.fetch_stats()['queues']),
+                    sorted(q for q in self.queue_names
+                           if shard_of(q, NUM_SHARDS) == shard))
+
+            self.assertEqual(sorted(client.fetch_stats()['queues']),
+                             sorted(self.queue_names))
+            fetched = client.fetch_next_msgs(self.queue_names)
+            self.assertEqual([m.raw_msg for m in fetched],
+                             [m.raw_msg for m in msgs])
+            self.assertEqual(len(client.fetch_many('test.q0')), 1)
+
+            sub = client.subscribe('test.q1')
+            try:
+                msg = status_msg('test.q1')
+                client.send_msg(msg)
+                self.assertEqual(sub.next_msg(timeout=2).seq, msg.seq)
+            finally:
+                sub.close()
+
+        self.each_engine(test, shards=NUM_SHARDS)
+
+    def test_routed(self):
+        """ Requests made to the broker's own ports, as by clients unaware of
+            its shards, are routed to the shard owning the queue.
+        """
+        def test(client):
+            msgs = [status_msg(q) for q in self.queue_names]
+            sock = socket.create_connection(('127.0.0.1', client.send_port))
+            sender = MsgSocket(sock, FRAMING_HEX)
+            sock = socket.create_connection(('127.0.0.1', client.fetch_port))
+            fetcher = MsgSocket(sock, FRAMING_HEX)
+            try:
+                shard_map = (NUM_SHARDS, self.broker.shard_base_port)
+                fetcher.send_frame('SHARDS')
+                self.assertEqual(fetcher.recv_frame(),
+                                 'SHARDS %d %d' % shard_map)
+                for msg in msgs:
+                    sender.send_frame(msg_to_frame(msg.raw_msg, False))
+                    self.assertEqual(sender.recv_frame(), 'OK')
+                for msg in msgs:
+                    fetcher.send_frame(msg.dest_addr)
+                    raw_msg = fetcher.recv_frame().decode('hex')
+                    self.assertEqual(raw_msg, msg.raw_msg)
+                fetcher.send_frame('test.q0')
+                self.assertEqual(fetcher.recv_frame(), 'EMPTY')
+            finally:
+                sender.close()
+                fetcher.close()
+
+        self.each_engine(test, ('event',), NUM_SHARDS)
+
+    def test_no_shm(self):
+        """ A sharded broker can't serve the shared memory transport.
+        """
+        self.assertRaises(ValueError, MsgBroker, shards=NUM_SHARDS,
+                          transport=object())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,261 @@
+""" Regression tests for the EMP msg codec.
+
+    Usage: python -m unittest discover tests
+
+    Author: Dustin Fast, 2018
+"""
+
+import os
+import sys
+import socket
+import unittest
+from binascii import crc32
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import lib_messaging
+from lib_messaging import Message, MsgSocket, msg_to_frame, frame_to_msg
+from lib_messaging import DIRECTIONS, STATUS_FIELDS
+from lib_messaging import EventConn, FRAMING_BINARY, FRAMING_HEX
+from lib_messaging import FRAME_PREAMBLE, FRAME_LEN, MAX_FRAME_SIZE
+from lib_messaging import EMP_HEAD, EMP_CRC, BODY_6000
+
+STATUS = {'sent': 1530000000, 'loco': '1001', 'speed': 25.5,
+          'heading': 12.25, 'direction': 'increasing', 'milepost': 2.02,
+          'lat': 61.2, 'long': -149.9, 'bpp': 90.0,
+          'conns': {'Radio 1': '2', 'Radio 2': '3'}}
+RESTRICT = {'sent': 1530000000, 'ID': '1001',
+            'Children': {'Restrict': [(1.0, 2.5)], 'LocoLocate': [3.25]}}
+WAYSIDE = {'sent': 1530000000, 'ID': 'w.1',
+           'Children': {'Switch 1': 'Normal', 'Switch 2': 'Reverse'}}
+GENERIC = {'none': None, 'flag': True, 'n': -7, 'x': 2.5, 'text': 'a\nb',
+           'items': [1, 'two', [3.0], {'four': 4}]}
+MSG_TUPLES = [(6000, 'sim.l.1001', 'sim.bos', STATUS),
+              (6001, 'sim.w.1', 'sim.bos', WAYSIDE),
+              (6002, 'sim.b', 'sim.l.1001', RESTRICT),
+              (7000, 'sim.b', 'sim.l.1001', GENERIC)]
+
+
+def socket_pair():
+    """ Returns a connected pair of loopback TCP sockets, as (connecting,
+        accepting).
+    """
+    listener = socket.socket()
+    listener.bind(('127.0.0.1', 0))
+    listener.listen(1)
+    client_sock = socket.create_connection(listener.getsockname())
+    server_sock = listener.accept()[0]
+    listener.close()
+    return client_sock, server_sock
+
+
+def status_msgs(n):
+    """ Returns n raw 6000 msgs of differing payloads.
+    """
+    msgs = []
+    for i in range(n):
+        status = dict(STATUS,
+                      loco=str(1001 + i),
+                      speed=i * 1.5,
+                      milepost=i / 10.0,
+                      direction=DIRECTIONS[i % 2],
+                      conns={'Radio 1': str(i)} if i % 3 else {})
+        msgs.append(Message((6000, 'sim.l.' + str(1001 + i), 'sim.bos',
+                             status)).raw_msg)
+    return msgs
+
+
+class CodecTest(unittest.TestCase):
+    """ Tests that msgs of each type survive encoding and decoding, singly
+        and in batches.
+    """
+    def test_round_trip(self):
+        for msg_tuple in MSG_TUPLES:
+            msg = Message(msg_tuple)
+            self.assertEqual(Message._to_tuple(msg.raw_msg), msg_tuple)
+
+            decoded = Message(msg.raw_msg)
+            self.assertEqual((decoded.ttl, decoded.qos, decoded.seq),
+                             (msg.ttl, msg.qos, msg.seq))
+
+    def test_corrupt_rejected(self):
+        raw_msg = Message(MSG_TUPLES[0]).raw_msg
+        corrupt = raw_msg[:20] + chr(ord(raw_msg[20]) ^ 1) + raw_msg[21:]
+        for bad in (corrupt, raw_msg[:-1], raw_msg[:10], ''):
+            self.assertRaises(Exception, Message._to_tuple, bad)
+
+    def test_encode_many_matches_encode(self):
+        """ encode_many() packs each msg as Message would, reusing buff.
+        """
+        buff = bytearray(65536)
+        batch_buff, size = Message.encode_many(MSG_TUPLES, buff)
+        self.assertIs(batch_buff, buff)
+
+        raw_msgs = Message.split_batch(str(buff[:size]))
+        self.assertEqual(len(raw_msgs), len(MSG_TUPLES))
+        for raw_msg, msg_tuple in zip(raw_msgs, MSG_TUPLES):
+            msg = Message(raw_msg)
+            self.assertEqual(Message._to_tuple(raw_msg), msg_tuple)
+            self.assertEqual(raw_msg, Message._to_raw(msg_tuple,
+                                                      msg.ttl,
+                                                      msg.qos,
+                                                      msg.seq))
+
+        # A buffer too small is replaced
+        small = bytearray(10)
+        batch_buff, size = Message.encode_many(MSG_TUPLES, small)
+        self.assertIsNot(batch_buff, small)
+        self.assertEqual(len(Message.split_batch(str(batch_buff[:size]))),
+                         len(MSG_TUPLES))
+
+    def test_decode_many_matches_to_tuple(self):
+        raw_msgs = [Message(t).raw_msg for t in MSG_TUPLES]
+        batch = ''.join(raw_msgs)
+        expected = [Message._to_tuple(r) for r in raw_msgs]
+        self.assertEqual(Message.decode_many(batch), expected)
+
+        buff, size = Message.encode_many(MSG_TUPLES)
+        self.assertEqual(Message.decode_many(buff, size), MSG_TUPLES)
+        self.assertEqual(Message.decode_many(''), [])
+
+    def test_decode_many_malformed(self):
+        """ A corrupt or truncated msg fails the batch, as it fails Message.
+        """
+        buff, size = Message.encode_many(MSG_TUPLES)
+        batch = str(buff[:size])
+        for bad in (batch[:-1], batch[:30] + chr(ord(batch[30]) ^ 1) +
+                    batch[31:]):
+            self.assertRaises(Exception, Message.decode_many, bad)
+
+        status = dict(STATUS, loco='x' * 256)
+        self.assertRaises(Exception, Message.encode_many,
+                          [(6000, 'sim.l.1001', 'sim.bos', status)])
+
+    def test_split_batch(self):
+        raw_msgs = [Message(t).raw_msg for t in MSG_TUPLES]
+        batch = ''.join(raw_msgs)
+        self.assertEqual(Message.split_batch(batch), raw_msgs)
+        self.assertEqual(Message.split_batch(''), [])
+        for bad in (batch[:-1], batch + batch[:10]):
+            self.assertRaises(Exception, Message.split_batch, bad)
+            self.assertRaises(Exception, Message.decode_many, bad)
+
+
+class FramingTest(unittest.TestCase):
+    """ Tests that frames cross a MsgSocket intact, in either framing, with
+        the accepting side detecting the framing.
+    """
+    def exchange(self, framing, frames):
+        client_sock, server_sock = socket_pair()
+        client = MsgSocket(client_sock, framing)
+        server = MsgSocket(server_sock)
+        try:
+            for frame in frames:
+                client.send_frame(msg_to_frame(frame, client.binary))
+                received = server.recv_frame()
+                self.assertEqual(frame_to_msg(received, server.binary), frame)
+            self.assertEqual(server.binary, framing == FRAMING_BINARY)
+
+            server.send_frame('OK')
+            self.assertEqual(client.recv_frame(), 'OK')
+
+            client.close()
+            self.assertIsNone(server.recv_frame())  # Peer closed
+        finally:
+            client.close()
+            server.close()
+
+    def test_binary(self):
+        raw_msgs = [Message(t).raw_msg for t in MSG_TUPLES]
+        self.exchange(FRAMING_BINARY, raw_msgs + ['\n\x00\n'])
+
+    def test_hex(self):
+        raw_msgs = [Message(t).raw_msg for t in MSG_TUPLES]
+        self.exchange(FRAMING_HEX, raw_msgs + ['\n\x00\n'])
+
+    def test_oversize_frames(self):
+        """ A binary frame over MAX_FRAME_SIZE, or hex framed data over
+            MAX_HEX_FRAME_SIZE without a newline, is refused by both a
+            MsgSocket and an EventConn.
+        """
+        hex_limit = lib_messaging.MAX_HEX_FRAME_SIZE
+        lib_messaging.MAX_HEX_FRAME_SIZE = 1000
+        client_sock, server_sock = socket_pair()
+        try:
+            oversize = {FRAMING_BINARY: (FRAME_PREAMBLE +
+                                         FRAME_LEN.pack(MAX_FRAME_SIZE + 1)),
+                        FRAMING_HEX: 'ab' * 1000}
+            for framing, data in oversize.items():
+                conn = EventConn(server_sock, ('127.0.0.1', 0), 0)
+                conn.inbuf += data
+                self.assertRaises(socket.error, conn.frames)
+
+                client_sock.sendall(data)
+                server = MsgSocket(server_sock)
+                self.assertRaises(socket.error, server.recv_frame)
+                client_sock.close()
+                server_sock.close()
+                client_sock, server_sock = socket_pair()
+        finally:
+            lib_messaging.MAX_HEX_FRAME_SIZE = hex_limit
+            client_sock.close()
+            server_sock.close()
+
+
+class Decode6000ManyTest(unittest.TestCase):
+    """ Tests that Message.decode_6000_many() agrees with Message._to_tuple().
+    """
+    def assertMatches(self, row, conns, raw_msg):
+        payload = Message._to_tuple(raw_msg)[3]
+        self.assertEqual(row['loco'], payload['loco'])
+        for name, _ in STATUS_FIELDS:
+            value = row[name].item()
+            if name == 'direction':
+                value = DIRECTIONS[value]
+            self.assertEqual(value, payload[name], name)
+        self.assertEqual(conns, payload['conns'])
+
+    def test_matches_to_tuple(self):
+        raw_msgs = status_msgs(10)
+        status, conns = Message.decode_6000_many(raw_msgs)
+
+        self.assertEqual(len(status), len(raw_msgs))
+        for row, row_conns, raw_msg in zip(status, conns, raw_msgs):
+            self.assertMatches(row, row_conns, raw_msg)
+
+    def test_malformed_dropped(self):
+        """ Corrupt, truncated and non-6000 msgs are dropped, and the rest
+            decoded in order.
+        """
+        good = status_msgs(3)
+        corrupt = good[0][:-1] + chr(ord(good[0][-1]) ^ 1)
+        restrict = Message((6002, 'sim.b', 'sim.l.1001', RESTRICT)).raw_msg
+        raw_msgs = [good[0], corrupt, good[1][:30], restrict, good[2], '']
+        status, conns = Message.decode_6000_many(raw_msgs)
+
+        self.assertEqual(len(status), 2)
+        self.assertMatches(status[0], conns[0], good[0])
+        self.assertMatches(status[1], conns[1], good[2])
+
+    def test_bad_direction_dropped(self):
+        """ A 6000 of a valid CRC but an unknown direction is dropped, as
+            Message() rejects it.
+        """
+        good = status_msgs(2)
+        raw_msg = good[0]
+        pos = EMP_HEAD.size + EMP_HEAD.unpack_from(raw_msg)[6]
+        pos += BODY_6000.size - 1  # Direction, the body's last fixed field
+        bad = raw_msg[:pos] + chr(7) + raw_msg[pos + 1:-EMP_CRC.size]
+        bad += EMP_CRC.pack(crc32(bad))
+        self.assertRaises(Exception, Message, bad)
+
+        status, conns = Message.decode_6000_many([bad, good[1]])
+        self.assertEqual(len(status), 1)
+        self.assertMatches(status[0], conns[0], good[1])
+
+    def test_empty(self):
+        status, conns = Message.decode_6000_many([])
+        self.assertEqual((len(status), conns), (0, []))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,107 @@
+""" Regression tests for AppConfig's hot reload of tunable values.
+
+    Usage: python -m unittest discover tests
+
+    Author: Dustin Fast, 2018
+"""
+
+import os
+import re
+import sys
+import shutil
+import logging
+import tempfile
+import unittest
+from time import time, sleep
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from lib_app import AppConfig, CONFIG_FILE
+from lib_messaging import BrokerCore, MsgQueue
+
+log = logging.getLogger('test_config')
+log.addHandler(logging.NullHandler())
+
+
+class AppConfigTest(unittest.TestCase):
+    """ Tests that modified tunables are reloaded, and listeners told.
+    """
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'config.dat')
+        shutil.copy(CONFIG_FILE, self.path)
+        self.config = AppConfig(self.path)
+        self.mtime = os.path.getmtime(self.path)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def set_value(self, key, value):
+        """ Sets the given key's value in the config file, and advances its
+            modified time.
+        """
+        with open(self.path) as f:
+            text = f.read()
+        text = re.sub(r'(?m)^' + key + r'( *)= *\S+',
+                      key + r'\1= ' + str(value),
+                      text)
+        with open(self.path, 'w') as f:
+            f.write(text)
+        self.mtime += 1
+        os.utime(self.path, (self.mtime, self.mtime))
+
+    def test_reload(self):
+        """ Only changed tunables are reloaded, typed, and given to listeners,
+            and only once the file is modified.
+        """
+        heard = []
+        self.config.add_listener(heard.append)
+        self.assertEqual(self.config.reload(), {})
+
+        self.set_value('network_timeout', 7.5)
+        self.set_value('max_queue_depth', 99)
+        changed = {'network_timeout': 7.5, 'max_queue_depth': 99}
+        self.assertEqual(self.config.reload(), changed)
+        self.assertEqual(heard, [changed])
+        self.assertEqual(self.config.network_timeout, 7.5)
+        self.assertEqual(self.config.getint('messaging', 'max_queue_depth'),
+                         99)
+
+        self.assertEqual(self.config.reload(), {})
+        self.set_value('pool_size', 2)  # Not tunable, so not given
+        self.assertEqual(self.config.reload(), {})
+        self.assertEqual(heard, [changed])
+
+    def test_malformed(self):
+        """ A malformed file leaves all values unchanged, and is retried.
+        """
+        refresh_time = self.config.refresh_time
+        self.set_value('refresh_time', 'soon')
+        self.assertRaises(Exception, self.config.reload)
+        self.assertEqual(self.config.refresh_time, refresh_time)
+
+        self.set_value('refresh_time', refresh_time + 1)
+        self.assertEqual(self.config.reload(),
+                         {'refresh_time': refresh_time + 1})
+
+    def test_watch_retunes_broker(self):
+        """ A watched config applies queue tunables to a BrokerCore's queues,
+            both existing and new.
+        """
+        core = BrokerCore(ttl=10, max_depth=0, overflow='drop_oldest')
+        core.outgoing_queues['q'] = MsgQueue(*core.queue_args)
+        self.config.add_listener(core.retune)
+        self.config.watch(log, interval=0.05)
+
+        self.set_value('max_queue_depth', 3)
+        self.set_value('queue_overflow', 'reject')
+        deadline = time() + 5
+        while core.queue_args[1:] != (3, 'reject') and time() < deadline:
+            sleep(0.05)
+
+        self.assertEqual(core.queue_args, (10, 3, 'reject'))
+        queue = core.outgoing_queues['q']
+        self.assertEqual((queue.max_depth, queue.overflow), (3, 'reject'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,126 @@
+""" Regression tests for the SimClock and the FleetEngine's simulation of a
+    fleet on virtual time.
+
+    Usage: python -m unittest discover tests
+
+    Author: Dustin Fast, 2018
+"""
+
+import os
+import sys
+import unittest
+from time import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from lib_app import config
+from lib_track import Track, FleetEngine, SimClock, add_fleet
+from lib_messaging import Message
+
+SIM_START = 1530000000  # Virtual start time
+NUM_LOCOS = 20
+TICKS = 10
+
+
+class SimClockTest(unittest.TestCase):
+    """ Tests SimClock's event order and time keeping.
+    """
+    def test_virtual(self):
+        """ Events run in time order, ties in the order scheduled, and the
+            clock jumps to each event's time.
+        """
+        clock = SimClock(virtual=True, start=100)
+        ran = []
+        for at, name in ((105, 'c'), (101, 'a'), (105, 'd'), (103, 'b')):
+            clock.schedule(at, lambda n=name: ran.append((n, clock.now())))
+
+        self.assertFalse(clock.run_next(until=100))
+        self.assertEqual(clock.now(), 100)
+        while clock.run_next(until=104):
+            pass
+        self.assertEqual(ran, [('a', 101), ('b', 103)])
+
+        clock.schedule(102, lambda: ran.append(('late', clock.now())))
+        while clock.run_next():
+            pass
+        self.assertEqual(ran[2:], [('late', 103), ('c', 105), ('d', 105)])
+        self.assertFalse(clock.run_next())
+
+    def test_real(self):
+        """ On real time, an event waits until due.
+        """
+        clock = SimClock()
+        start = time()
+        clock.schedule(start + 0.1, lambda: None)
+        self.assertTrue(clock.run_next())
+        self.assertTrue(time() - start >= 0.1)
+
+
+class FleetEngineTest(unittest.TestCase):
+    """ Tests FleetEngine's ticks, movement and determinism on virtual time.
+    """
+    def run_fleet(self):
+        """ Runs a fresh fleet for TICKS ticks of virtual time and returns
+            the status msgs given to its sink, by tick.
+        """
+        track = Track()
+        fleet = add_fleet(track, NUM_LOCOS)
+        clock = SimClock(virtual=True, start=SIM_START)
+        Message.seed_seqs(SIM_START)
+        ticks = []
+        engine = FleetEngine(fleet, track, clock, ticks.append)
+        try:
+            engine.run(until=SIM_START + TICKS * config.msg_interval)
+        finally:
+            Message.seed_seqs(None)
+        return ticks
+
+    def test_ticks(self):
+        """ Each tick, msg_interval secs of sim time apart, gives the status
+            of the locos in range of a base, as of that tick. Runs are
+            deterministic.
+        """
+        ticks = self.run_fleet()
+        self.assertEqual(len(ticks), TICKS)
+        for i, msgs in enumerate(ticks):
+            self.assertTrue(0 < len(msgs) <= NUM_LOCOS)
+            sent = set(m.payload['sent'] for m in msgs)
+            self.assertEqual(sent, set([int(SIM_START + (i + 1) *
+                                            config.msg_interval)]))
+
+        self.assertEqual([[m.raw_msg for m in msgs] for msgs in ticks],
+                         [[m.raw_msg for m in msgs]
+                          for msgs in self.run_fleet()])
+
+    def test_move(self):
+        """ Locos move at speed, in their direction, and reverse at end of
+            track.
+        """
+        track = Track()
+        fleet = add_fleet(track, 2)
+        markers = track.marker_array
+        mileposts = track.mileposts_sorted
+        fleet[0].update(speed=60, direction='increasing',
+                        location=mileposts[len(mileposts) / 2])
+        fleet[1].update(speed=60, direction='increasing',
+                        location=mileposts[-1])
+
+        start = fleet[0].coords.marker
+        engine = FleetEngine(fleet, track, SimClock(True), lambda msgs: None)
+        engine.move(1 / 60.0)  # One mile, at 60 mph
+        moved = fleet[0].coords.marker + engine.makeup[0] - start
+        self.assertAlmostEqual(moved, 1.0)
+        self.assertEqual(markers[engine.mp_idxs[0]], fleet[0].coords.marker)
+        self.assertEqual(fleet[1].direction, 'decreasing')
+        self.assertEqual(fleet[1].coords.marker, markers[-1])
+
+    def test_requires_sink(self):
+        """ A fleet on virtual time must be given a sink.
+        """
+        track = Track()
+        fleet = add_fleet(track, 1)
+        self.assertRaises(ValueError, FleetEngine, fleet, track,
+                          SimClock(virtual=True))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,99 @@
+""" Regression tests for the broker's MsgJournal.
+
+    Usage: python -m unittest discover tests
+
+    Author: Dustin Fast, 2018
+"""
+
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from lib_messaging import BrokerCore, MsgJournal, Message
+
+STATUS = {'loco': '1001', 'speed': 25.0, 'heading': 12.5,
+          'direction': 'increasing', 'milepost': 2.02, 'lat': 61.2,
+          'long': -149.9, 'bpp': 90.0, 'conns': {}}
+RESTRICT = {'ID': '1001', 'Children': {'Restrict': [], 'LocoLocate': []}}
+CLIENT = ('127.0.0.1', 0)
+
+
+class MsgJournalTest(unittest.TestCase):
+    """ Tests that the msgs left queued at a broker's exit are restored.
+    """
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.path, True)
+
+    def broker(self, segment_size=1 << 16):
+        """ Returns a new BrokerCore, journaling (synced every write) to
+            self.path.
+        """
+        core = BrokerCore(ttl=0, max_depth=0)
+        core.attach_journal(MsgJournal(self.path, segment_size, 0, 0))
+        return core
+
+    @staticmethod
+    def send(core, msg_type, payload):
+        return core.handle_send(
+            Message((msg_type, 'sim.b', 'sim.l.1001', payload)).raw_msg,
+            True, CLIENT)
+
+    def queued_types(self, core):
+        """ Returns the msg types queued for sim.l.1001 at the given broker,
+            in the order served.
+        """
+        types = []
+        while True:
+            frame = core.handle_fetch('sim.l.1001', True, CLIENT)
+            if frame == 'EMPTY':
+                return types
+            types.append(Message(frame).msg_type)
+
+    def test_priority_fetch(self):
+        """ A higher priority msg fetched first doesn't consume one before it.
+        """
+        core = self.broker()
+        self.send(core, 6000, STATUS)
+        self.send(core, 6002, RESTRICT)
+        frame = core.handle_fetch('sim.l.1001', True, CLIENT)
+        self.assertEqual(Message(frame).msg_type, 6002)
+
+        self.assertEqual(self.queued_types(self.broker()), [6000])
+
+    def test_priority_fetch_many(self):
+        """ As above, for a batch fetch ending with a higher priority msg.
+        """
+        core = self.broker()
+        for _ in range(3):
+            self.send(core, 6000, STATUS)
+        self.send(core, 6002, RESTRICT)
+        core.handle_fetch('MANY sim.l.1001 2', True, CLIENT)
+
+        self.assertEqual(self.queued_types(self.broker()), [6000, 6000])
+
+    def test_segment_purge(self):
+        """ Acks of msgs in a remaining segment survive the deletion of the
+            segment holding them.
+        """
+        core = self.broker(segment_size=4096)
+        for _ in range(20):
+            self.send(core, 6000, STATUS)
+        for _ in range(60):
+            self.send(core, 6002, RESTRICT)
+        for _ in range(60):
+            core.handle_fetch('sim.l.1001', True, CLIENT)
+        core.journal.sync()  # Deletes all but the first and active segments
+        self.assertEqual(len(os.listdir(self.path)), 2)
+
+        self.assertEqual(self.queued_types(self.broker(segment_size=4096)),
+                         [6000] * 20)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,115 @@
+""" Regression tests for McastSender and McastListener, over loopback.
+
+    Usage: python -m unittest discover tests
+
+    Author: Dustin Fast, 2018
+"""
+
+import os
+import sys
+import Queue
+import socket
+import logging
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from lib_messaging import Message, McastSender, McastListener
+from lib_messaging import MCAST_SEQ_WINDOW
+
+STATUS = {'sent': 1530000000, 'loco': '1001', 'speed': 25.5,
+          'heading': 12.25, 'direction': 'increasing', 'milepost': 2.02,
+          'lat': 61.2, 'long': -149.9, 'bpp': 90.0, 'conns': {}}
+
+log = logging.getLogger('test_mcast')
+log.addHandler(logging.NullHandler())
+
+
+def free_udp_port():
+    """ Returns a UDP port not currently in use.
+    """
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.bind(('', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+class McastTest(unittest.TestCase):
+    """ Tests McastListener's sequencing, and msgs sent by McastSender.
+    """
+    def setUp(self):
+        self.port = free_udp_port()
+        self.listener = McastListener(log, port=self.port)
+
+    def tearDown(self):
+        self.listener.close()
+
+    def test_gap(self):
+        """ Msgs skipped in a sender's seqs are counted as lost.
+        """
+        seq = self.listener._sequence
+        self.assertTrue(seq('a', 10))
+        self.assertTrue(seq('a', 13))
+        self.assertTrue(seq('b', 100))  # Seqs are per sender
+        self.assertEqual(self.listener.lost, 2)
+
+        # Seqs wrap at 32 bits
+        self.assertTrue(seq('c', 0xFFFFFFFF))
+        self.assertTrue(seq('c', 0))
+        self.assertEqual(self.listener.lost, 2)
+
+    def test_duplicate(self):
+        """ Msgs at or behind a sender's last seq are dropped.
+        """
+        seq = self.listener._sequence
+        self.assertTrue(seq('a', 10))
+        self.assertTrue(seq('a', 11))
+        self.assertFalse(seq('a', 11))
+        self.assertFalse(seq('a', 10))
+        self.assertTrue(seq('a', 12))
+        self.assertEqual((self.listener.dropped, self.listener.lost), (2, 0))
+
+    def test_sender_restart(self):
+        """ A seq far behind or ahead of the sender's last, as from a
+            restarted sender, restarts its sequence without counting losses.
+        """
+        seq = self.listener._sequence
+        self.assertTrue(seq('a', 5000))
+        self.assertTrue(seq('a', 5000 - MCAST_SEQ_WINDOW - 1))
+        self.assertFalse(seq('a', 5000 - MCAST_SEQ_WINDOW - 1))
+        self.assertTrue(seq('a', 5000 - MCAST_SEQ_WINDOW))
+        self.assertTrue(seq('a', 1 << 20))
+        self.assertEqual((self.listener.dropped, self.listener.lost), (1, 0))
+
+    def test_loopback(self):
+        """ Msgs sent are received in order. Duplicates, msgs without seqs
+            and malformed datagrams are dropped.
+        """
+        sender = McastSender(port=self.port)
+        msgs = [Message((6000, 'sim.l.1001', 'sim.bos', STATUS), seq=seq)
+                for seq in (7, 8, 10)]
+        no_seq = Message(Message._to_raw((6000, 'sim.l.1001', 'sim.bos',
+                                          STATUS)))
+        try:
+            sender.send_msg(msgs[0])
+            sender.send_msg(msgs[0])
+            sender._sock.sendto('garbage', (sender.group, sender.port))
+            sender._sock.sendto(no_seq.raw_msg, (sender.group, sender.port))
+            sender.send_msg(msgs[1])
+            sender.send_msg(msgs[2])
+            self.assertRaises(Exception, sender.send_msg, no_seq)
+
+            received = [self.listener.next_msg(2) for _ in msgs]
+            self.assertEqual([m.raw_msg for m in received],
+                             [m.raw_msg for m in msgs])
+            self.assertRaises(Queue.Empty, self.listener.next_msg, 0.1)
+        finally:
+            sender._sock.close()
+
+        self.assertEqual(self.listener.received, 3)
+        self.assertEqual(self.listener.dropped, 3)
+        self.assertEqual(self.listener.lost, 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
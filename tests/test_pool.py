@@ -0,0 +1,147 @@
+""" Regression tests for ConnPool's connection reuse and eviction, against a
+    stand-in broker on loopback.
+
+    Usage: python -m unittest discover tests
+
+    Author: Dustin Fast, 2018
+"""
+
+import os
+import sys
+import socket
+import unittest
+from time import sleep
+from threading import Thread
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from lib_messaging import ConnPool, MsgSocket, FRAMING_BINARY, FRAMING_HEX
+
+
+class EchoServer(Thread):
+    """ A stand-in broker, responding to each request frame with the frame
+        itself, except to a CLOSE request, which closes the connection
+        unanswered.
+        self.conns: (list) The accepted connections, as MsgSockets
+    """
+    def __init__(self):
+        Thread.__init__(self)
+        self.daemon = True
+        self.conns = []
+        self._sock = socket.socket()
+        self._sock.bind(('127.0.0.1', 0))
+        self._sock.listen(16)
+        self.address = self._sock.getsockname()
+
+    def run(self):
+        while True:
+            try:
+                sock = self._sock.accept()[0]
+            except socket.error:
+                return  # Closed
+            msock = MsgSocket(sock)
+            self.conns.append(msock)
+            serve = Thread(target=self._serve, args=(msock,))
+            serve.daemon = True
+            serve.start()
+
+    def _serve(self, msock):
+        try:
+            while True:
+                frame = msock.recv_frame()
+                if frame is None or frame == 'CLOSE':
+                    break
+                msock.send_frame(frame)
+        except socket.error:
+            pass
+        msock.close()
+
+    def drop(self, msock):
+        """ Closes the given connection, shutting it down first, so that its
+            serving thread's recv returns. Else close() would leave it open.
+        """
+        try:
+            msock.sock.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+        msock.close()
+
+    def close(self):
+        self._sock.close()
+        for msock in self.conns:
+            self.drop(msock)
+
+
+class ConnPoolTest(unittest.TestCase):
+    """ Tests ConnPool's reuse, bounds and eviction of connections.
+    """
+    def setUp(self):
+        self.server = EchoServer()
+        self.server.start()
+
+    def tearDown(self):
+        self.server.close()
+
+    def test_get_pool(self):
+        """ A process has one pool per address and framing.
+        """
+        address = self.server.address
+        pool = ConnPool.get_pool(address, FRAMING_BINARY)
+        self.assertIs(ConnPool.get_pool(address, FRAMING_BINARY), pool)
+        self.assertIsNot(ConnPool.get_pool(address, FRAMING_HEX), pool)
+
+    def test_reuse(self):
+        """ Sequential requests, and pipelined ones, share one connection.
+        """
+        pool = ConnPool(self.server.address, FRAMING_BINARY, max_size=2)
+        for i in range(10):
+            self.assertEqual(pool.request('req' + str(i)), 'req' + str(i))
+        frames = ['many' + str(i) for i in range(100)]
+        self.assertEqual(pool.request_many(frames), frames)
+        self.assertEqual(len(self.server.conns), 1)
+
+    def test_max_size(self):
+        """ Connections are opened as needed, up to max_size, and an acquire
+            beyond that waits for a release.
+        """
+        pool = ConnPool(self.server.address, FRAMING_HEX, max_size=2)
+        first, second = pool.acquire(), pool.acquire()
+        self.assertIsNot(first, second)
+
+        acquired = []
+        waiter = Thread(target=lambda: acquired.append(pool.acquire()))
+        waiter.start()
+        sleep(0.1)
+        self.assertEqual(acquired, [])
+
+        pool.release(second)
+        waiter.join(2)
+        self.assertEqual(acquired, [second])
+        pool.release(first)
+        pool.release(second)
+        self.assertEqual(len(self.server.conns), 2)
+
+    def test_evicts_closed(self):
+        """ An idle connection the broker closed is evicted and the request
+            made over a new one.
+        """
+        pool = ConnPool(self.server.address, FRAMING_BINARY, max_size=2)
+        self.assertEqual(pool.request('a'), 'a')
+        self.server.drop(self.server.conns[0])
+        sleep(0.1)
+        self.assertEqual(pool.request('b'), 'b')
+        self.assertEqual(len(self.server.conns), 2)
+
+    def test_no_retry_once_sent(self):
+        """ A request whose connection fails once it's sent is raised, not
+            retried, and the connection discarded.
+        """
+        pool = ConnPool(self.server.address, FRAMING_BINARY, max_size=1)
+        self.assertEqual(pool.request('a'), 'a')
+        self.assertRaises(socket.error, pool.request, 'CLOSE')
+        self.assertEqual(len(self.server.conns), 1)
+        self.assertEqual(pool.request('b'), 'b')  # Its slot was released
+        self.assertEqual(len(self.server.conns), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
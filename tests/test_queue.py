@@ -0,0 +1,155 @@
+""" Regression tests for the broker's MsgQueue.
+
+    Usage: python -m unittest discover tests
+
+    Author: Dustin Fast, 2018
+"""
+
+import os
+import sys
+import Queue
+import unittest
+from time import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from lib_messaging import Message, MsgQueue, DedupIndex
+from lib_messaging import QOS_ROUTINE, QOS_ELEVATED, QOS_CRITICAL
+
+STATUS = {'sent': 1530000000, 'loco': '1001', 'speed': 25.5,
+          'heading': 12.25, 'direction': 'increasing', 'milepost': 2.02,
+          'lat': 61.2, 'long': -149.9, 'bpp': 90.0, 'conns': {}}
+
+
+def status_msg(ttl=0, qos=QOS_ROUTINE):
+    """ Returns a new 6000 msg, of the next seq, with the given network TTL
+        (0 = forever) and QoS.
+    """
+    return Message((6000, 'sim.l.1001', 'sim.bos', STATUS), ttl=ttl, qos=qos)
+
+
+class MsgQueueTest(unittest.TestCase):
+    """ Tests MsgQueue's order, expiry and stats.
+    """
+    def test_priority_order(self):
+        """ Msgs are served highest priority first, then oldest first.
+        """
+        queue = MsgQueue(ttl=0, max_depth=0)
+        msgs = [status_msg(qos=q) for q in (QOS_ROUTINE, QOS_CRITICAL,
+                                            QOS_ROUTINE, QOS_ELEVATED,
+                                            QOS_CRITICAL)]
+        for msg in msgs:
+            queue.put(msg)
+        self.assertEqual(len(queue), 5)
+
+        order = [queue.get() for _ in msgs]
+        self.assertEqual(order, [msgs[1], msgs[4], msgs[3], msgs[0], msgs[2]])
+        self.assertRaises(Queue.Empty, queue.get)
+        self.assertEqual(queue.stats.dequeued, 5)
+
+    def test_ttl_expiry(self):
+        """ Msgs expire after the queue's TTL or their own, if sooner.
+        """
+        queue = MsgQueue(ttl=10, max_depth=0)
+        now = time()
+        old = status_msg()
+        own_ttl = status_msg(ttl=1)
+        fresh = status_msg(ttl=1)
+        self.assertEqual(queue.put(old, now - 11)[0], now - 1)
+        self.assertEqual(queue.put(own_ttl, now - 2)[0], now - 1)
+        self.assertEqual(queue.put(fresh, now)[0], now + 1)
+        self.assertIsNone(MsgQueue(ttl=0).put(status_msg())[0])
+
+        self.assertIs(queue.get(), fresh)
+        self.assertEqual(queue.stats.expired, 2)
+        self.assertEqual(len(queue), 0)
+
+    def test_expire(self):
+        queue = MsgQueue(ttl=0, max_depth=0)
+        first, second = status_msg(), status_msg()
+        queue.put(first)
+        queue.put(second)
+        self.assertFalse(queue.expire(second))  # Not at the head
+        self.assertTrue(queue.expire(first))
+        self.assertEqual((len(queue), queue.stats.expired), (1, 1))
+
+    def test_overflow_drop_oldest(self):
+        queue = MsgQueue(ttl=0, max_depth=2, overflow='drop_oldest')
+        msgs = [status_msg() for _ in range(3)]
+        queue.put(msgs[0])
+        queue.put(msgs[1])
+        self.assertIs(queue.put(msgs[2])[1], msgs[0])
+        self.assertEqual([queue.get(), queue.get()], msgs[1:])
+        self.assertEqual(queue.stats.dropped, 1)
+
+        # A full queue rejects a put of lower priority than all its msgs
+        queue.put(status_msg(qos=QOS_CRITICAL))
+        queue.put(status_msg(qos=QOS_CRITICAL))
+        self.assertRaises(Queue.Full, queue.put, status_msg())
+        self.assertEqual(queue.stats.rejected, 1)
+
+    def test_overflow_reject(self):
+        queue = MsgQueue(ttl=0, max_depth=1, overflow='reject')
+        first = status_msg()
+        queue.put(first)
+        self.assertRaises(Queue.Full, queue.put, status_msg(qos=QOS_CRITICAL))
+        self.assertIs(queue.get(), first)
+        self.assertEqual((queue.stats.enqueued, queue.stats.rejected), (1, 1))
+
+    def test_requeue_uncounts_wait_time(self):
+        """ A requeued msg's wait time is counted once, when next dequeued.
+        """
+        queue = MsgQueue(ttl=0, max_depth=0)
+        msg = status_msg()
+        queue.put(msg, enqueued=1)
+        self.assertIs(queue.get(), msg)
+        queue.requeue(msg)
+
+        self.assertEqual(queue.stats.dequeued, 0)
+        self.assertEqual(queue.stats.wait_times.total, 0)
+        self.assertEqual(sum(queue.stats.wait_times.counts), 0)
+
+        self.assertIs(queue.get(), msg)
+        self.assertEqual(queue.stats.dequeued, 1)
+        self.assertEqual(queue.stats.wait_times.total, 1)
+        self.assertEqual(msg.enqueued, 1)  # Counted from its first enqueue
+
+
+class DedupIndexTest(unittest.TestCase):
+    """ Tests DedupIndex's duplicate detection and its bounds.
+    """
+    def test_seen(self):
+        index = DedupIndex(window=4, max_senders=10)
+        self.assertFalse(index.seen('a', 1))
+        self.assertTrue(index.seen('a', 1))
+        self.assertFalse(index.seen('b', 1))  # Seqs are per sender
+
+    def test_window(self):
+        index = DedupIndex(window=2, max_senders=10)
+        for seq in (1, 2, 3):
+            index.seen('a', seq)
+        self.assertFalse(index.seen('a', 1))  # Evicted, as the oldest
+        self.assertTrue(index.seen('a', 3))
+
+    def test_max_senders(self):
+        index = DedupIndex(window=4, max_senders=2)
+        index.seen('a', 1)
+        index.seen('b', 1)
+        index.seen('a', 2)  # So 'b' is the least recently heard from
+        index.seen('c', 1)
+        self.assertTrue(index.seen('a', 1))
+        self.assertFalse(index.seen('b', 1))
+
+    def test_forget(self):
+        index = DedupIndex(window=4, max_senders=10)
+        for seq in (1, 2, 3):
+            index.seen('a', seq)
+        index.forget('a', 3)
+        index.forget('a', 1)
+        index.forget('z', 1)  # Unknown sender, ignored
+        self.assertFalse(index.seen('a', 3))
+        self.assertFalse(index.seen('a', 1))
+        self.assertTrue(index.seen('a', 2))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,117 @@
+""" Regression tests for the shared memory transport's ShmRing and
+    ShmTransport.
+
+    Usage: python -m unittest discover tests
+
+    Author: Dustin Fast, 2018
+"""
+
+import os
+import sys
+import Queue
+import unittest
+from time import time
+from threading import Thread
+from multiprocessing import Process
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from lib_messaging import ShmRing, ShmTransport, SHM_REQ, SHM_REC_LEN
+
+PRODUCERS = 4
+RECORDS = 500  # Records put per producer
+
+
+def produce(ring, producer):
+    """ Puts RECORDS records to the given ring, each of the form
+        'producer:i', waiting as long as needed for room.
+    """
+    for i in xrange(RECORDS):
+        ring.put(str(producer) + ':' + str(i), 10)
+
+
+class ShmRingTest(unittest.TestCase):
+    """ Tests ShmRing's ordering, wraparound and overflow.
+    """
+    def test_multi_producer(self):
+        """ Records from producer processes are each got once, and each
+            producer's in the order put, through a ring too small to hold
+            them all at once.
+        """
+        ring = ShmRing(1024)
+        procs = [Process(target=produce, args=(ring, p))
+                 for p in range(PRODUCERS)]
+        for proc in procs:
+            proc.start()
+
+        got = dict((p, []) for p in range(PRODUCERS))
+        for _ in xrange(PRODUCERS * RECORDS):
+            producer, i = ring.get(10).split(':')
+            got[int(producer)].append(int(i))
+        for proc in procs:
+            proc.join()
+
+        self.assertRaises(Queue.Empty, ring.get, 0)
+        for p in range(PRODUCERS):
+            self.assertEqual(got[p], range(RECORDS))
+
+    def test_wraparound(self):
+        """ Records split across the ring's end are got intact.
+        """
+        ring = ShmRing(64)
+        for i in xrange(100):
+            record = chr(65 + i % 26) * (i % 40)
+            ring.put(record, 0)
+            self.assertEqual(ring.get(0), record)
+        self.assertEqual(ring._idx[0], ring._idx[1])
+        self.assertTrue(ring._idx[0] > 10 * ring.size)
+
+    def test_full_times_out(self):
+        """ A put to a full ring raises Queue.Full after its timeout, and
+            succeeds once a record is got.
+        """
+        ring = ShmRing(64)
+        record = 'x' * (32 - SHM_REC_LEN.size)
+        ring.put(record, 0)
+        ring.put(record, 0)
+
+        start = time()
+        self.assertRaises(Queue.Full, ring.put, 'y', 0.1)
+        self.assertTrue(time() - start >= 0.1)
+
+        self.assertEqual(ring.get(0), record)
+        ring.put('y' * (32 - SHM_REC_LEN.size), 0)
+        self.assertRaises(ValueError, ring.put, 'z' * 64, 0)
+
+
+class ShmTransportTest(unittest.TestCase):
+    """ Tests ShmTransport's request/response matching.
+    """
+    def test_stale_responses_skipped(self):
+        """ A response to an earlier request, as when it timed out, is
+            skipped in favor of the current request's.
+        """
+        transport = ShmTransport(channels=1, ring_size=4096)
+
+        def respond():
+            request = transport.requests.get(5)
+            chan, _, seq = SHM_REQ.unpack_from(request)
+            transport.respond(chan, seq - 1, 'stale')
+            transport.respond(chan, seq, request[SHM_REQ.size:].upper())
+
+        for frame in ('first', 'second'):
+            responder = Thread(target=respond)
+            responder.start()
+            self.assertEqual(transport.request(frame, False), frame.upper())
+            responder.join()
+
+    def test_respond_full(self):
+        """ A response to a channel whose ring is full is refused, rather
+            than waited on.
+        """
+        transport = ShmTransport(channels=1, ring_size=64)
+        transport.respond(0, 1, 'x' * 40)
+        self.assertRaises(Queue.Full, transport.respond, 0, 2, 'x' * 40)
+
+
+if __name__ == '__main__':
+    unittest.main()
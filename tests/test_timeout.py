@@ -0,0 +1,76 @@
+""" Regression tests for the TimeoutService and Connection timeouts.
+
+    Usage: python -m unittest discover tests
+
+    Author: Dustin Fast, 2018
+"""
+
+import os
+import sys
+import unittest
+from time import sleep
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from lib_messaging import TimeoutService, Connection
+
+
+class TimeoutServiceTest(unittest.TestCase):
+    """ Tests that timers fire once, and are replaced rather than added to.
+    """
+    def setUp(self):
+        self.service = TimeoutService()
+        self.service.start()
+        self.fired = []
+
+    def test_reschedule_replaces(self):
+        for _ in range(100):
+            self.service.schedule('key', .1, lambda: self.fired.append(1))
+        self.assertEqual(len(self.service._heap), 1)
+        self.assertEqual(len(self.service), 1)
+
+        sleep(.3)
+        self.assertEqual(self.fired, [1])
+        self.assertEqual(len(self.service), 0)
+
+    def test_cancel_reschedule_reuses(self):
+        for _ in range(100):
+            self.service.schedule('key', .1, lambda: self.fired.append(1))
+            self.service.cancel('key')
+        self.assertEqual(len(self.service._heap), 1)
+        self.assertEqual(len(self.service), 0)
+
+        sleep(.3)
+        self.assertEqual(self.fired, [])
+        self.assertEqual(self.service._timers, {})
+
+    def test_keep_alive(self):
+        self.service.schedule('key', .2, lambda: self.fired.append(1))
+        for _ in range(4):
+            sleep(.1)
+            self.service.keep_alive('key')
+        self.assertEqual(self.fired, [])
+
+        sleep(.4)
+        self.assertEqual(self.fired, [1])
+
+
+class ConnectionTest(unittest.TestCase):
+    """ Tests that a stale timeout doesn't drop a re-established connection.
+    """
+    def test_stale_timeout(self):
+        conn = Connection('Radio 1', timeout=60)
+        conn.connect('base 1')
+        stale = conn._conn_count
+        conn.disconnect()
+        conn.connect('base 2')
+
+        conn._timed_out(stale)  # As if fired just before the reconnect
+        self.assertEqual(conn.conn_to, 'base 2')
+
+        conn._timed_out(conn._conn_count)
+        self.assertFalse(conn.connected())
+        self.assertFalse(conn.active)
+
+
+if __name__ == '__main__':
+    unittest.main()
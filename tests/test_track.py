@@ -0,0 +1,214 @@
+""" Regression tests for the Track's milepost and coverage searches, against
+    the linear scans they replaced.
+
+    Usage: python -m unittest discover tests
+
+    Author: Dustin Fast, 2018
+"""
+
+import os
+import sys
+import json
+import random
+import shutil
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from lib_track import Track, TrackCache, CoverageIndex
+
+TEST_SEED = 2018  # Random seed, so cases are the same from run to run
+TEST_CASES = 2000
+
+
+def linear_next_mp(markers, mp, distance):
+    """ Returns the (marker, dist_diff) of the next mp from mp, by the linear
+        scan Track._get_next_mp() once did, or None if end of track.
+    """
+    if distance == 0:
+        return mp, distance
+
+    target_mp = mp + distance
+    mps = markers if distance > 0 else markers[::-1]
+    for i, marker in enumerate(mps):
+        if marker == target_mp:
+            return marker, 0
+        elif (distance > 0 and marker > target_mp) or \
+             (distance < 0 and marker < target_mp):
+            next_mp = mps[i - 1] if i > 0 else mp
+            return next_mp, abs(target_mp - next_mp)
+
+
+class TrackTest(unittest.TestCase):
+    """ Tests Track's milepost searches, singly and in batches.
+    """
+    @classmethod
+    def setUpClass(cls):
+        cls.track = Track()
+        cls.markers = cls.track.marker_array.tolist()
+
+    def cases(self):
+        """ Returns a list of (mp index, distance) cases: Random distances,
+            distances to exact markers, past either end, and of 0.
+        """
+        rand = random.Random(TEST_SEED)
+        markers = self.markers
+        last = len(markers) - 1
+        cases = []
+        for _ in xrange(TEST_CASES):
+            i = rand.randint(0, last)
+            j = rand.randint(0, last)
+            cases.append((i, rand.uniform(-5, 5)))
+            cases.append((i, markers[j] - markers[i]))
+        cases.extend([(0, -1.0), (last, 1.0), (0, 0.0), (last, -0.0001),
+                      (0, markers[-1] - markers[0] + 1), (last, 0)])
+        return cases
+
+    def test_get_next_mp_matches_linear(self):
+        mileposts = self.track.mileposts_sorted
+        for i, distance in self.cases():
+            expected = linear_next_mp(self.markers, self.markers[i], distance)
+            result = self.track._get_next_mp(mileposts[i], distance)
+            if expected is None:
+                self.assertIsNone(result, (i, distance))
+                continue
+            self.assertEqual(result[0].marker, expected[0], (i, distance))
+            self.assertAlmostEqual(result[1], expected[1])
+
+    def test_get_next_mps_matches_linear(self):
+        cases = self.cases()
+        next_idxs, dist_diffs = self.track.get_next_mps(
+            [self.markers[i] for i, _ in cases], [d for _, d in cases])
+
+        for (i, distance), idx, diff in zip(cases, next_idxs, dist_diffs):
+            expected = linear_next_mp(self.markers, self.markers[i], distance)
+            if expected is None:
+                self.assertEqual(idx, -1, (i, distance))
+                continue
+            self.assertEqual(self.markers[idx], expected[0], (i, distance))
+            self.assertAlmostEqual(diff, expected[1])
+
+    def test_mileposts(self):
+        """ Mileposts are built on demand, once each, from the cache.
+        """
+        mileposts = self.track.mileposts_sorted
+        self.assertEqual(len(mileposts), len(self.markers))
+        self.assertIs(mileposts[5], mileposts[5])
+        self.assertIs(mileposts[-1], mileposts[len(mileposts) - 1])
+        self.assertRaises(IndexError, lambda: mileposts[len(mileposts)])
+
+        location = self.track.get_location_at(self.markers[7])
+        self.assertIs(location, mileposts[7])
+        self.assertIsNone(self.track.get_location_at(self.markers[7] + 1e-6))
+        self.assertEqual(location.covered_by,
+                         self.track.get_coverage(location.marker))
+
+
+class CoverageIndexTest(unittest.TestCase):
+    """ Tests CoverageIndex against a linear scan of its intervals.
+    """
+    def test_matches_linear(self):
+        rand = random.Random(TEST_SEED)
+        intervals = []
+        for _ in xrange(50):
+            start = round(rand.uniform(0, 100), 1)
+            intervals.append((start, start + round(rand.uniform(0, 20), 1)))
+        intervals.append((30.0, 30.0))  # A single point
+        index = CoverageIndex(intervals)
+
+        markers = [round(rand.uniform(-5, 125), 1) for _ in xrange(1000)]
+        markers.extend(b for i in intervals for b in i)  # On the boundaries
+        expected = [tuple(n for n, (start, end) in enumerate(intervals)
+                          if start <= m <= end) for m in markers]
+
+        self.assertEqual([index.covering(m) for m in markers], expected)
+        self.assertEqual(index.covering_many(markers), expected)
+
+    def test_items(self):
+        index = CoverageIndex([(1.0, 2.0), (1.5, 3.0)], ['a', 'b'])
+        self.assertEqual(index.covering(1.75), ('a', 'b'))
+        self.assertEqual(index.covering(3.0), ('b',))
+        self.assertEqual(index.covering(0.5), ())
+        self.assertEqual(CoverageIndex([]).covering_many([1.0]), [()])
+
+
+class TrackCacheTest(unittest.TestCase):
+    """ Tests TrackCache's compiling, and its recompiling when stale.
+    """
+    RAILS = [{'milemarker': 2.0, 'lat': 60.2, 'long': -149.2},
+             {'milemarker': 1.0, 'lat': 60.1, 'long': -149.1},
+             {'milemarker': 3.0, 'lat': 60.3, 'long': -149.3},
+             {'milemarker': 2.0, 'lat': 60.25, 'long': -149.25}]
+    BASES = [{'id': '7', 'coverage': [0, 2.5], 'lat': 61.0, 'long': -150.0},
+             {'id': '8', 'coverage': [1.5, 9], 'lat': 62.0, 'long': -151.0}]
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.files = [os.path.join(self.dir, name)
+                      for name in ('track.cache', 'rails.json', 'bases.json')]
+        self.write(self.RAILS, self.BASES)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def write(self, rails, bases, mtime=None):
+        """ Writes the given rails and bases to the JSON files, with the
+            given modified time, if any.
+        """
+        for path, data in zip(self.files[1:], (rails, bases)):
+            with open(path, 'w') as f:
+                f.write(json.dumps(data))
+            if mtime:
+                os.utime(path, (mtime, mtime))
+
+    def test_compile(self):
+        """ A missing cache is compiled, with markers ascending (the last of
+            any repeated), and later shared from the file.
+        """
+        self.assertTrue(TrackCache.is_stale(*self.files))
+        cache = TrackCache(*self.files)
+        self.assertFalse(TrackCache.is_stale(*self.files))
+
+        self.assertEqual(cache.markers.tolist(), [1.0, 2.0, 3.0])
+        self.assertEqual(cache.lats.tolist(), [60.1, 60.25, 60.3])
+        self.assertEqual(cache.bases['id'].tolist(), ['7', '8'])
+        covering = [cache.cov_bases[cache.cov_index[i]:
+                                    cache.cov_index[i + 1]].tolist()
+                    for i in range(3)]
+        self.assertEqual(covering, [[0], [0, 1], [1]])
+
+        shared = TrackCache(*self.files)
+        self.assertIsNotNone(shared._map)
+        self.assertEqual(shared.markers.tolist(), cache.markers.tolist())
+        self.assertEqual(shared.bases.tolist(), cache.bases.tolist())
+
+    def test_recompile_when_stale(self):
+        """ A cache is recompiled once its JSON files change, or if it's
+            corrupt.
+        """
+        TrackCache(*self.files)
+        rails = self.RAILS + [{'milemarker': 4.0, 'lat': 60.4, 'long': -149.4}]
+        self.write(rails, self.BASES, os.path.getmtime(self.files[1]) + 1)
+        self.assertTrue(TrackCache.is_stale(*self.files))
+        self.assertEqual(TrackCache(*self.files).markers.tolist(),
+                         [1.0, 2.0, 3.0, 4.0])
+        self.assertFalse(TrackCache.is_stale(*self.files))
+
+        with open(self.files[0], 'r+b') as f:
+            f.write('XXXX')
+        self.assertTrue(TrackCache.is_stale(*self.files))
+        self.assertEqual(len(TrackCache(*self.files).markers), 4)
+        self.assertFalse(TrackCache.is_stale(*self.files))
+
+    def test_malformed(self):
+        """ Malformed JSON files fail the compile, leaving no cache.
+        """
+        self.write(self.RAILS, self.BASES + self.BASES[:1])
+        self.assertRaises(Exception, TrackCache, *self.files)
+        self.write([{'milemarker': 'x', 'lat': 0, 'long': 0}], self.BASES)
+        self.assertRaises(ValueError, TrackCache, *self.files)
+        self.assertFalse(os.path.exists(self.files[0]))
+
+
+if __name__ == '__main__':
+    unittest.main()